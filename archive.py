@@ -0,0 +1,141 @@
+import os
+import logging
+import argparse
+from datetime import date
+import pandas as pd
+import psycopg
+from psycopg import sql
+from model import HISTORY_TABLES, create_history_partitions
+
+log = logging.getLogger()
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s:%(levelname)s %(message)s')
+handler.setFormatter(formatter)
+log.addHandler(handler)
+log.setLevel(logging.INFO)
+
+DB_CONN_STRING = os.environ.get("TRADEBOT_DB_CONN")
+ARCHIVE_DIR = os.environ.get("TRADEBOT_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"))
+RETENTION_MONTHS = int(os.environ.get("TRADEBOT_RETENTION_MONTHS", 12))
+RUN_ERROR_RETENTION_DAYS = int(os.environ.get("TRADEBOT_RUN_ERROR_RETENTION_DAYS", 30))
+# Chatter never shows more than this much of a run's error
+RUN_ERROR_MAX_LENGTH = 1000
+PARTITION_MONTHS_AHEAD = 3
+
+def month_partitions(cursor, table):
+    records = cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        INNER JOIN pg_class c ON c.oid = i.inhrelid
+        INNER JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s
+    """, (table,))
+    partitions = []
+    prefix = table + "_p"
+    for record in records:
+        name = record[0]
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            partitions.append((date(int(suffix[:4]), int(suffix[4:]), 1), name))
+    return sorted(partitions)
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def can_archive(cursor, table, partition):
+    # Open orders and runs chatter hasn't told anyone about yet are still hot
+    if table == "portfolio_order":
+        query = "SELECT COUNT(*) FROM {} WHERE status = 'open'"
+    elif table == "portfolio_run":
+        query = "SELECT COUNT(*) FROM {} WHERE NOT notified"
+    else:
+        return True
+    record = cursor.execute(sql.SQL(query).format(sql.Identifier(partition))).fetchone()
+    return record[0] == 0
+
+def carry_forward_balances(cursor, table, partition, month):
+    """
+    Cash and positions are sums over all of history, so before dropping a month fold it into
+    'balance' rows at the start of the following month
+    """
+    if table == "portfolio_cash":
+        query = """
+            INSERT INTO portfolio_cash (portfolio_id, event, event_timestamp, amount, order_id)
+            SELECT portfolio_id, 'balance', %s, SUM(amount), NULL
+            FROM {}
+            GROUP BY portfolio_id
+            HAVING SUM(amount) <> 0
+        """
+    elif table == "portfolio_position":
+        query = """
+            INSERT INTO portfolio_position (portfolio_id, event, event_timestamp, ticker, amount, order_id)
+            SELECT portfolio_id, 'balance', %s, ticker, SUM(amount), NULL
+            FROM {}
+            GROUP BY portfolio_id, ticker
+            HAVING SUM(amount) <> 0
+        """
+    else:
+        return
+    cursor.execute(sql.SQL(query).format(sql.Identifier(partition)), (next_month(month),))
+
+def export_partition(cursor, table, partition, month):
+    cursor.execute(sql.SQL("SELECT * FROM {}").format(sql.Identifier(partition)))
+    frame = pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+    directory = os.path.join(ARCHIVE_DIR, table)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{month:%Y%m}.parquet")
+    # Write then rename so a crash never leaves a partial archive next to a dropped partition
+    frame.to_parquet(path + ".tmp", compression="zstd", index=False)
+    os.replace(path + ".tmp", path)
+    return path, len(frame)
+
+def archive_partition(conn, table, partition, month):
+    with conn.transaction():
+        with conn.cursor() as cursor:
+            if not can_archive(cursor, table, partition):
+                log.info(f"{partition} still has hot rows, keeping it")
+                return False
+            carry_forward_balances(cursor, table, partition, month)
+            path, count = export_partition(cursor, table, partition, month)
+            cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(sql.Identifier(table), sql.Identifier(partition)))
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+    log.info(f"Archived {count} rows of {partition} to {path}")
+    return True
+
+def ensure_partitions(conn, months_ahead=PARTITION_MONTHS_AHEAD):
+    with conn.cursor() as cursor:
+        create_history_partitions(cursor, months_ahead)
+
+def apply_run_retention(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE portfolio_run
+            SET error = left(error, %s)
+            WHERE notified
+            AND timestamp < (now() AT TIME ZONE 'UTC') - %s * interval '1 day'
+            AND length(error) > %s
+        """, (RUN_ERROR_MAX_LENGTH, RUN_ERROR_RETENTION_DAYS, RUN_ERROR_MAX_LENGTH))
+        log.info(f"Truncated the errors of {cursor.rowcount} notified runs")
+
+def archive(conn, retention_months=RETENTION_MONTHS):
+    today = date.today()
+    cutoff = date(today.year, today.month, 1)
+    for i in range(retention_months):
+        cutoff = date(cutoff.year - (cutoff.month == 1), (cutoff.month - 2) % 12 + 1, 1)
+
+    ensure_partitions(conn)
+    apply_run_retention(conn)
+    with conn.cursor() as cursor:
+        partitions = {table: month_partitions(cursor, table) for table in HISTORY_TABLES}
+    for table in HISTORY_TABLES:
+        for month, partition in partitions[table]:
+            if month < cutoff:
+                archive_partition(conn, table, partition, month)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create upcoming history partitions and archive old ones to Parquet. Run daily.")
+    parser.add_argument("--retention-months", type=int, default=RETENTION_MONTHS, help="months of history to keep in the DB, besides the current one")
+    args = parser.parse_args()
+
+    with psycopg.connect(DB_CONN_STRING, autocommit=True) as conn:
+        archive(conn, args.retention_months)
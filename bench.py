@@ -0,0 +1,176 @@
+import os
+import sys
+import gc
+import json
+import time
+import zlib
+import argparse
+import importlib
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STRATEGIES_DIR = os.path.join(REPO_DIR, "strategies")
+sys.path.append(STRATEGIES_DIR)
+import util
+
+BASELINE_PATH = os.path.join(REPO_DIR, "bench_baseline.json")
+# Synthetic bars end here so every run benchmarks exactly the same data
+BARS_END = pd.Timestamp("2024-01-01", tz="UTC")
+RESOLUTIONS = {"1h": "1h", "1m": "1min"}
+STAGES = ["load", "signals", "simulate", "records"]
+
+def strategy_modules():
+    names = []
+    for filename in sorted(os.listdir(STRATEGIES_DIR)):
+        name, ext = os.path.splitext(filename)
+        if ext == ".py" and name != "util" and not name.startswith("_"):
+            names.append(name)
+    return names
+
+def synthetic_fetcher(years, freq):
+    """
+    Returns a fetcher that ignores the requested range and serves a seeded random walk of
+    the given length instead. Crypto trades around the clock, everything else only during
+    weekday market hours. Bars are generated once so the load stage doesn't time the stub.
+    """
+    generated = {}
+    def fetcher(ticker, timeframe, start, end, **kwargs):
+        if ticker not in generated:
+            generated[ticker] = generate_bars(ticker, years, freq, kwargs.get("client_type") == "crypto")
+        return generated[ticker]
+    return fetcher
+
+def generate_bars(ticker, years, freq, crypto):
+    index = pd.date_range(end=BARS_END, periods=int(years * 365 * pd.Timedelta("1D") / pd.Timedelta(freq)), freq=freq, name="Open time")
+    if not crypto:
+        minutes = index.hour * 60 + index.minute
+        index = index[(index.dayofweek < 5) & (minutes >= 13 * 60 + 30) & (minutes < 20 * 60)]
+    rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.002, len(index))))
+    spread = np.abs(rng.normal(0, 0.001, len(index))) * close
+    return pd.DataFrame({
+        "Open": np.roll(close, 1),
+        "High": close + spread,
+        "Low": close - spread,
+        "Close": close,
+        "Volume": rng.integers(1, 1000, len(index)).astype(float),
+    }, index=index)
+
+def run_stages(pf_module, params):
+    """
+    Runs a strategy the way a live run does, returning each stage's name and the callable for it
+    """
+    state = {}
+
+    def load():
+        util.clear_bar_cache()
+        state["close"] = pf_module.load_data(params)
+
+    def signals():
+        # Not every strategy splits its signals out, those only get the simulate stage
+        if hasattr(pf_module, "signals"):
+            state["signals"] = pf_module.signals(state["close"], params)
+
+    def simulate():
+        # Only time the simulation itself where the strategy can take the signals computed above
+        if "signals" in state and hasattr(pf_module, "create_portfolio_from_signals"):
+            state["pf"] = pf_module.create_portfolio_from_signals(params, state["close"], state["signals"])
+        else:
+            state["pf"] = pf_module.create_portfolio(params, state["close"])
+
+    def records():
+        state["pf"].orders.records_readable
+
+    return [("load", load), ("signals", signals), ("simulate", simulate), ("records", records)]
+
+def benchmark(pf_module, years, resolution, repeat):
+    """
+    Returns {stage: {"seconds": ..., "peak_memory": ...}}. Seconds is the best of repeat runs,
+    peak memory comes from one extra run under tracemalloc so tracing doesn't skew the timings.
+    """
+    freq = RESOLUTIONS[resolution]
+    util.set_fetcher(synthetic_fetcher(years, freq))
+    # The live signal helpers select the candle the clock is in, so put it at the last bar
+    util.set_clock(lambda: BARS_END.floor(freq))
+    # Strategies default to their own start date, which would cut the longer cases short
+    params = {"live": True, "start": BARS_END - pd.Timedelta(days=365 * years)}
+    results = {stage: {"seconds": None, "peak_memory": None} for stage in STAGES}
+    try:
+        for i in range(repeat):
+            for stage, fn in run_stages(pf_module, params):
+                gc.collect()
+                start = time.perf_counter()
+                fn()
+                seconds = time.perf_counter() - start
+                best = results[stage]["seconds"]
+                results[stage]["seconds"] = seconds if best is None else min(best, seconds)
+
+        tracemalloc.start()
+        for stage, fn in run_stages(pf_module, params):
+            gc.collect()
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+            fn()
+            results[stage]["peak_memory"] = tracemalloc.get_traced_memory()[1] - start_memory
+        tracemalloc.stop()
+    finally:
+        util.set_fetcher(None)
+        util.set_clock(None)
+        util.clear_bar_cache()
+    return results
+
+def compare(key, result, baseline, tolerance, memory_tolerance, min_seconds):
+    regressions = []
+    for stage, measured in result.items():
+        expected = baseline.get(stage)
+        if expected is None:
+            continue
+        if measured["seconds"] > max(expected["seconds"] * (1 + tolerance), min_seconds):
+            regressions.append(f"{key} {stage}: {measured['seconds']:.3f}s vs {expected['seconds']:.3f}s baseline")
+        if expected["peak_memory"] and measured["peak_memory"] > expected["peak_memory"] * (1 + memory_tolerance):
+            regressions.append(f"{key} {stage}: {measured['peak_memory'] / 2**20:.1f}MB vs {expected['peak_memory'] / 2**20:.1f}MB baseline")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark strategy modules against synthetic bars and compare with stored baselines")
+    parser.add_argument("modules", nargs="*", default=strategy_modules())
+    parser.add_argument("--years", type=float, nargs="+", default=[1, 3, 10])
+    parser.add_argument("--resolutions", nargs="+", default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the fastest is kept")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fraction a stage may be slower than its baseline")
+    parser.add_argument("--memory-tolerance", type=float, default=0.2, help="fraction a stage's peak memory may be over its baseline")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="never flag stages faster than this, they're mostly noise")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baselines")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    print(f"{'case':<45} {'stage':<10} {'seconds':>9} {'peak MB':>9}")
+    for module in args.modules:
+        pf_module = importlib.import_module(module)
+        for resolution in args.resolutions:
+            for years in args.years:
+                key = f"{module}/{years:g}y/{resolution}"
+                result = benchmark(pf_module, years, resolution, args.repeat)
+                for stage, measured in result.items():
+                    print(f"{key:<45} {stage:<10} {measured['seconds']:>9.3f} {measured['peak_memory'] / 2**20:>9.1f}")
+                if key in baselines:
+                    regressions += compare(key, result, baselines[key], args.tolerance, args.memory_tolerance, args.min_seconds)
+                if args.save:
+                    baselines[key] = result
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved baselines to {args.baseline}")
+
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    sys.exit(1 if regressions and not args.save else 0)
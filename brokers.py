@@ -1,11 +1,23 @@
 from collections import namedtuple
 from decimal import Decimal
-from alpaca.trading.client import TradingClient
-from alpaca.trading.requests import MarketOrderRequest
-from alpaca.trading.enums import OrderSide, OrderStatus, TimeInForce
-import alpaca_trade_api as tradeapi
-import pandas as pd
+import asyncio
+from lazy import lazy_import
 from model import PortfolioOrder
+from ratelimit import SUBMIT, RECONCILE, RetryableError, error_info, parse_retry_after, limiter_for
+
+# Loaded on first use, the trader only needs them once a portfolio has a broker to talk to
+aiohttp = lazy_import("aiohttp")
+tradeapi = lazy_import("alpaca_trade_api")
+pd = lazy_import("pandas")
+
+# Values of alpaca.trading.enums.OrderStatus after which an order won't change anymore
+RESOLVED_STATUSES = ("filled", "canceled", "expired", "rejected")
+
+class NotFoundError(Exception):
+    """
+    The broker API answered 404, e.g. for an order it has never heard of
+    """
+    status = 404
 
 class Broker:
     def __init__(self, log, credentials):
@@ -20,7 +32,46 @@ class Broker:
     
     def submit_orders(self, portfolio, orders):
         raise NotImplementedError()
-    
+
+class AsyncBroker:
+    def __init__(self, log, credentials):
+        self.log = log
+        self.credentials = credentials
+
+    async def positions(self, portfolio):
+        raise NotImplementedError()
+
+    async def resolve_orders(self, portfolio, open_orders):
+        raise NotImplementedError()
+
+    async def submit_orders(self, portfolio, orders):
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+class SyncBrokerAdapter(AsyncBroker):
+    """
+    Runs the blocking calls of a synchronous Broker in a thread executor so they
+    can be awaited alongside AsyncBroker calls
+    """
+    def __init__(self, broker, executor=None):
+        super().__init__(broker.log, broker.credentials)
+        self.broker = broker
+        self.executor = executor
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def positions(self, portfolio):
+        return await self.run(self.broker.positions, portfolio)
+
+    async def resolve_orders(self, portfolio, open_orders):
+        return await self.run(self.broker.resolve_orders, portfolio, open_orders)
+
+    async def submit_orders(self, portfolio, orders):
+        return await self.run(self.broker.submit_orders, portfolio, orders)
+
 AlpacaOrderShim = namedtuple("OrderShim", ["symbol", "client_order_id", "side", "filled_qty", "filled_avg_price", "status"])
 def to_order(order_series):
     return AlpacaOrderShim(
@@ -31,21 +82,100 @@ def to_order(order_series):
         order_series.loc["filled_avg_price"],
         order_series.loc["status"],
     )
+
+def alpaca_base_url(credentials):
+    return "https://paper-api.alpaca.markets" if credentials["paper"] else "https://api.alpaca.markets"
+
+def alpaca_stream_url(credentials):
+    return alpaca_base_url(credentials).replace("https://", "wss://") + "/stream"
+
+def client_order_prefix(portfolio):
+    return "%s_%d" % (portfolio.shortname, portfolio.id)
+
+def client_order_id(portfolio, order):
+    return "%s_%d" % (client_order_prefix(portfolio), order.id)
+
+def parse_client_order_id(client_order_id):
+    """
+    Inverse of client_order_id, returns (shortname, portfolio id, order id) or None if the
+    order wasn't placed by us
+    """
+    parts = client_order_id.rsplit("_", 2)
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return parts[0], int(parts[1]), int(parts[2])
+
+def positions_from_orders(orders):
+    positions = {}
+    for order in orders:
+        if order.status not in ("filled", "partially_filled"):
+            continue
+        ticker = order.symbol
+        if ticker not in positions:
+            positions[ticker] = Decimal(0)
+        if order.side == "buy":
+            positions[ticker] += Decimal(order.filled_qty)
+        elif order.side == "sell":
+            positions[ticker] -= Decimal(order.filled_qty)
+    return positions
+
+def resolve_order(open_order, alpaca_order):
+    is_resolved = alpaca_order is None or (alpaca_order.status in RESOLVED_STATUSES)
+    if not is_resolved:
+        return None
+    if alpaca_order is None or (alpaca_order.filled_qty is None or alpaca_order.filled_qty == "" or float(alpaca_order.filled_qty) == 0):
+        status = "unfilled"
+        fill_timestamp = None
+        fill_quantity = None
+        fill_price = None
+        fill_fee = None
+        alpaca_id = None
+    else:
+        status = "filled"
+        fill_timestamp = alpaca_order.filled_at
+        fill_quantity = alpaca_order.filled_qty
+        fill_price = alpaca_order.filled_avg_price
+        fill_fee = "0"
+        alpaca_id = str(alpaca_order.id)
+
+    return PortfolioOrder(
+        open_order.id,
+        open_order.portfolio_id,
+        open_order.run_id,
+        status,
+        open_order.ticker,
+        open_order.side,
+        open_order.create_timestamp,
+        open_order.notional,
+        open_order.quantity,
+        fill_timestamp,
+        fill_quantity,
+        fill_price,
+        fill_fee,
+        alpaca_id,
+        False
+    )
+
 class AlpacaBroker(Broker):
-    def __init__(self, log, credentials):
+    def __init__(self, log, credentials, limiter=None):
         super().__init__(log, credentials)
+        from alpaca.trading.client import TradingClient
+        self.limiter = limiter if limiter else limiter_for(credentials)
         self.trading_client = TradingClient(credentials["api_key"], credentials["secret_key"], paper=credentials["paper"])
         self.rest_api = tradeapi.REST(
             credentials["api_key"], 
             credentials["secret_key"], 
-            "https://paper-api.alpaca.markets" if credentials["paper"] else "https://api.alpaca.markets"
+            alpaca_base_url(credentials)
         )
+        # The limiter does the retrying, the SDKs' own 429/504 retries would go around it
+        self.trading_client._retry = 0
+        self.rest_api._retry = 0
         
     def client_order_prefix(self, portfolio):
-        return "%s_%d" % (portfolio.shortname, portfolio.id)
+        return client_order_prefix(portfolio)
 
     def client_order_id(self, portfolio, order):
-        return "%s_%d" % (self.client_order_prefix(portfolio), order.id)
+        return client_order_id(portfolio, order)
     
     # From: https://alpaca.markets/learn/get-all-orders/
     def all_orders(self):
@@ -56,7 +186,8 @@ class AlpacaBroker(Broker):
 
         while check_for_more_orders:
             # Fetch a 'chunk' of orders and append it to our list
-            api_orders = self.rest_api.list_orders(
+            api_orders = self.limiter.call(
+                self.rest_api.list_orders,
                 status='all',
                 until=start_time.isoformat(),
                 direction='desc',
@@ -93,16 +224,7 @@ class AlpacaBroker(Broker):
         return list(filter(lambda order: order.status in ("filled", "partially_filled"), self.orders(portfolio)))
 
     def positions(self, portfolio):
-        positions = {}
-        for order in self.filled_orders(portfolio):
-            ticker = order.symbol
-            if ticker not in positions:
-                positions[ticker] = Decimal(0)
-            if order.side == OrderSide.BUY:
-                positions[ticker] += Decimal(order.filled_qty)
-            elif order.side == OrderSide.SELL:
-                positions[ticker] -= Decimal(order.filled_qty)
-        return positions
+        return positions_from_orders(self.filled_orders(portfolio))
 
     def resolve_orders(self, portfolio, open_orders):
         resolved_orders = []
@@ -110,47 +232,21 @@ class AlpacaBroker(Broker):
             client_order_id = self.client_order_id(portfolio, open_order)
             try:
                 self.log.info(f"Looking up order {client_order_id} on Alpaca...")
-                alpaca_order = self.trading_client.get_order_by_client_id(client_order_id)
-            except: 
-                self.log.exception(f"Exception looking up order {client_order_id}!")
+                alpaca_order = self.limiter.call(self.trading_client.get_order_by_client_id, client_order_id)
+            except Exception as e:
+                # Only an order Alpaca has never heard of is unfilled, anything else is retried next tick
+                if error_info(e)[0] != 404:
+                    self.log.exception(f"Exception looking up order {client_order_id}, leaving it open!")
+                    continue
                 alpaca_order = None
-            is_resolved = alpaca_order is None or (alpaca_order.status in (OrderStatus.FILLED, OrderStatus.CANCELED, OrderStatus.EXPIRED, OrderStatus.REJECTED))
-            if is_resolved:
-                if alpaca_order is None or (alpaca_order.filled_qty is None or alpaca_order.filled_qty == "" or float(alpaca_order.filled_qty) == 0):
-                    status = "unfilled"
-                    fill_timestamp = None
-                    fill_quantity = None
-                    fill_price = None
-                    fill_fee = None
-                    alpaca_id = None
-                else:
-                    status = "filled"
-                    fill_timestamp = alpaca_order.filled_at
-                    fill_quantity = alpaca_order.filled_qty
-                    fill_price = alpaca_order.filled_avg_price
-                    fill_fee = "0"
-                    alpaca_id = str(alpaca_order.id)
-
-                resolved_orders.append(PortfolioOrder(
-                    open_order.id,
-                    open_order.portfolio_id,
-                    open_order.run_id,
-                    status,
-                    open_order.ticker,
-                    open_order.side,
-                    open_order.create_timestamp,
-                    open_order.notional,
-                    open_order.quantity,
-                    fill_timestamp,
-                    fill_quantity,
-                    fill_price,
-                    fill_fee,
-                    alpaca_id,
-                    False
-                ))
+            resolved_order = resolve_order(open_order, alpaca_order)
+            if resolved_order is not None:
+                resolved_orders.append(resolved_order)
         return resolved_orders
 
     def submit_orders(self, portfolio, orders):
+        from alpaca.trading.requests import MarketOrderRequest
+        from alpaca.trading.enums import OrderSide, TimeInForce
         for order in orders:
             client_order_id = self.client_order_id(portfolio, order)
             self.log.info(f"Submitting order {client_order_id} to Alpaca...")
@@ -172,4 +268,129 @@ class AlpacaBroker(Broker):
                     time_in_force=TimeInForce.DAY,
                     client_order_id=client_order_id
                 )
-            self.trading_client.submit_order(order_data=order_data)
\ No newline at end of file
+            self.limiter.call(self.trading_client.submit_order, order_data=order_data, priority=SUBMIT, idempotent=False)
+
+AlpacaOrderJson = namedtuple("AlpacaOrderJson", ["id", "symbol", "client_order_id", "side", "status", "filled_at", "filled_qty", "filled_avg_price", "submitted_at"])
+def from_order_json(order_json):
+    filled_at = order_json.get("filled_at")
+    return AlpacaOrderJson(
+        order_json["id"],
+        order_json["symbol"],
+        order_json["client_order_id"],
+        order_json["side"],
+        order_json["status"],
+        pd.to_datetime(filled_at).to_pydatetime() if filled_at else None,
+        order_json.get("filled_qty"),
+        order_json.get("filled_avg_price"),
+        order_json.get("submitted_at"),
+    )
+
+class AsyncAlpacaBroker(AsyncBroker):
+    def __init__(self, log, credentials, base_url=None, session=None, limiter=None):
+        super().__init__(log, credentials)
+        self.base_url = base_url if base_url else alpaca_base_url(credentials)
+        self.session = session
+        self.owns_session = session is None
+        self.limiter = limiter if limiter else limiter_for(credentials)
+
+    def headers(self):
+        return {
+            "APCA-API-KEY-ID": self.credentials["api_key"],
+            "APCA-API-SECRET-KEY": self.credentials["secret_key"],
+        }
+
+    async def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        if self.owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def send(self, method, path, **kwargs):
+        session = await self.get_session()
+        try:
+            async with session.request(method, self.base_url + path, headers=self.headers(), **kwargs) as response:
+                if response.status == 404:
+                    raise NotFoundError(f"{method} {path} returned 404")
+                if response.status == 429 or response.status >= 500:
+                    raise RetryableError(f"{method} {path} returned {response.status}", response.status, parse_retry_after(response.headers))
+                response.raise_for_status()
+                return await response.json()
+        except aiohttp.ClientConnectionError as e:
+            raise RetryableError(f"{method} {path} failed: {e}") from e
+
+    async def request(self, method, path, priority=RECONCILE, idempotent=True, **kwargs):
+        return await self.limiter.call_async(self.send, method, path, priority=priority, idempotent=idempotent, **kwargs)
+
+    async def all_orders(self):
+        CHUNK_SIZE = 500
+        all_orders = {}
+        until = pd.to_datetime('now', utc=True).isoformat()
+        while True:
+            api_orders = await self.request("GET", "/v2/orders", params={
+                "status": "all",
+                "until": until,
+                "direction": "desc",
+                "limit": CHUNK_SIZE,
+                "nested": "false",
+            })
+            for order_json in api_orders:
+                all_orders[order_json["id"]] = from_order_json(order_json)
+            if len(api_orders) < CHUNK_SIZE:
+                break
+            # Same overlap hack as AlpacaBroker.all_orders, duplicates are dropped by id
+            until = api_orders[-3]["submitted_at"]
+        return list(all_orders.values())
+
+    async def orders(self, portfolio):
+        prefix = client_order_prefix(portfolio)
+        return [order for order in await self.all_orders() if order.client_order_id.startswith(prefix)]
+
+    async def positions(self, portfolio):
+        return positions_from_orders(await self.orders(portfolio))
+
+    async def lookup_order(self, portfolio, open_order):
+        order_id = client_order_id(portfolio, open_order)
+        self.log.info(f"Looking up order {order_id} on Alpaca...")
+        try:
+            order_json = await self.request("GET", "/v2/orders:by_client_order_id", params={"client_order_id": order_id})
+        except NotFoundError:
+            # Only an order Alpaca has never heard of is unfilled
+            return None
+        return from_order_json(order_json)
+
+    async def resolve_orders(self, portfolio, open_orders):
+        alpaca_orders = await asyncio.gather(*[self.lookup_order(portfolio, open_order) for open_order in open_orders], return_exceptions=True)
+        resolved_orders = []
+        for open_order, alpaca_order in zip(open_orders, alpaca_orders):
+            if isinstance(alpaca_order, BaseException):
+                if not isinstance(alpaca_order, Exception):
+                    raise alpaca_order
+                # Leave it open rather than calling it unfilled, it's retried next tick
+                self.log.error(f"Exception looking up order {client_order_id(portfolio, open_order)}, leaving it open!", exc_info=alpaca_order)
+                continue
+            resolved_order = resolve_order(open_order, alpaca_order)
+            if resolved_order is not None:
+                resolved_orders.append(resolved_order)
+        return resolved_orders
+
+    async def submit_orders(self, portfolio, orders):
+        for order in orders:
+            order_id = client_order_id(portfolio, order)
+            self.log.info(f"Submitting order {order_id} to Alpaca...")
+            order_data = {
+                "symbol": order.ticker,
+                "side": order.side,
+                "type": "market",
+                "time_in_force": "day",
+                "client_order_id": order_id,
+            }
+            # Buy the notional ($) amount, sell the quantity (shares) amount
+            if order.side == "buy":
+                order_data["notional"] = str(order.notional)
+            elif order.side == "sell":
+                order_data["qty"] = str(order.quantity)
+            await self.request("POST", "/v2/orders", priority=SUBMIT, idempotent=False, json=order_data)
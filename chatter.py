@@ -1,8 +1,8 @@
 import discord
 from discord.ext import tasks
-import psycopg
 import os
 import logging
+from lazy import lazy_import
 from model import (
     PortfolioRun,
     PortfolioOrder, 
@@ -10,9 +10,13 @@ from model import (
     update_order,
     fetch_enabled_portfolios,
     fetch_runs,
-    fetch_orders_by_status
+    fetch_orders_by_status,
+    fetch_latest_snapshot
 )
 
+# Not needed until the bot is connected and the first notification tick runs
+psycopg = lazy_import("psycopg")
+
 log = logging.getLogger()
 handler = logging.StreamHandler()
 formatter = logging.Formatter('%(asctime)s:%(levelname)s %(message)s')
@@ -35,11 +39,14 @@ def broker_summary(b):
 def portfolio_short_summary(p):
     return f"ID: {p.id}\nName: {p.name}\n"
 
-def portfolio_summary(p):
-    return f"ID: {p.id}\nName: {p.name}\nEnabled: {p.enabled}\nModule: {p.module}\nSchedule: {p.schedule}\nStart: {p.start_timestamp}\nLast Run: {p.last_run_timestamp}\n"
+def portfolio_summary(p, snapshot=None):
+    summary = f"ID: {p.id}\nName: {p.name}\nEnabled: {p.enabled}\nModule: {p.module}\nSchedule: {p.schedule}\nStart: {p.start_timestamp}\nLast Run: {p.last_run_timestamp}\n"
+    if snapshot is not None:
+        summary += f"Equity: ${snapshot.equity:.2f} (Cash: ${snapshot.cash:.2f}) as of {snapshot.timestamp}\n"
+    return summary
 
 def run_summary(r):
-    return f"Run ID: {r.id} - {r.status}" + (f"\n{r.error[:1000]}" if r.error else "")
+    return f"Run ID: {r.id} - {r.status}" + (" (cached)" if r.cache_hit else "") + (f"\n{r.error[:1000]}" if r.error else "")
 
 def order_summary(o):
     summary = f"Order ID: {o.id} - {o.side.upper()} " + (f"${o.notional} of {o.ticker}" if o.side == "buy" else f"{o.quantity} of {o.ticker}")
@@ -60,10 +67,11 @@ async def notify_orders():
                 channel = await author.create_dm()
 
                 with conn.cursor() as cursor:
+                    snapshot = fetch_latest_snapshot(cursor, portfolio.id)
                     new_runs = list(filter(lambda r: not r.notified, fetch_runs(cursor, portfolio.id)))
                     if new_runs:
                         run_descs = [run_summary(r) for r in new_runs]
-                        await channel.send("```\n"+portfolio_summary(portfolio)+"\n\nNew Runs:\n- "+"\n- ".join(run_descs)+"```")
+                        await channel.send("```\n"+portfolio_summary(portfolio, snapshot)+"\n\nNew Runs:\n- "+"\n- ".join(run_descs)+"```")
                         
                         for run in new_runs:
                             run_list = list(run)
@@ -76,7 +84,7 @@ async def notify_orders():
                     ))
                     if new_orders:
                         order_descs = [order_summary(o) for o in new_orders]
-                        await channel.send("```\n"+portfolio_summary(portfolio)+"\n\nNew Orders:\n- "+"\n- ".join(order_descs)+"```")
+                        await channel.send("```\n"+portfolio_summary(portfolio, snapshot)+"\n\nNew Orders:\n- "+"\n- ".join(order_descs)+"```")
                         
                         for order in new_orders:
                             order_list = list(order)
@@ -87,5 +95,6 @@ async def notify_orders():
                 log.exception(f"Exception thrown in 'notify_orders' for portfolio {portfolio.id}")
                 
                     
-notify_orders.start()
-bot.run(DISCORD_TOKEN)
+if __name__ == "__main__":
+    notify_orders.start()
+    bot.run(DISCORD_TOKEN)
@@ -0,0 +1,53 @@
+import sys
+import types
+import threading
+import importlib.util
+
+class LockedLazyModule(importlib.util._LazyModule):
+    """
+    Before Python 3.12 a lazy module isn't thread-safe: it stops being lazy as soon as one thread
+    starts executing it, so other threads (e.g. the heartbeat thread or a broker executor thread)
+    see it half loaded. This one only stops being lazy once it's loaded, under a per-module lock
+    that threads arriving meanwhile wait on.
+    """
+    def __getattribute__(self, attr):
+        spec = object.__getattribute__(self, "__spec__")
+        loader_state = spec.loader_state
+        with loader_state["lock"]:
+            if type(self) is LockedLazyModule:
+                # The module looking itself up while it executes, in the thread loading it
+                if loader_state["is_loading"]:
+                    return object.__getattribute__(self, attr)
+                loader_state["is_loading"] = True
+                try:
+                    # Like the stock lazy module, keep what was set on the module before it loaded
+                    attrs_then = loader_state["__dict__"]
+                    attrs_now = object.__getattribute__(self, "__dict__")
+                    attrs_updated = {key: value for key, value in attrs_now.items() if key not in attrs_then or value is not attrs_then[key]}
+                    spec.loader.exec_module(self)
+                    attrs_now.update(attrs_updated)
+                    self.__class__ = types.ModuleType
+                finally:
+                    loader_state["is_loading"] = False
+        return getattr(self, attr)
+
+def lazy_import(name):
+    """
+    Returns a module that's only actually imported on first attribute access, so heavy dependencies
+    don't slow down process startup when they aren't needed right away
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    if sys.version_info < (3, 12):
+        spec.loader_state["lock"] = threading.RLock()
+        spec.loader_state["is_loading"] = False
+        module.__class__ = LockedLazyModule
+    return module
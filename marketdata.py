@@ -0,0 +1,178 @@
+import os
+import uuid
+import threading
+from collections import namedtuple
+from multiprocessing import shared_memory
+from lazy import lazy_import
+
+# Only the strategy worker touches the bars themselves, the trader just passes descriptors along
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# Everything a worker process needs to map a stored bar frame, small enough to pickle into each task.
+# The number of bars in use is kept in the index block itself since bars are appended in place.
+SharedBars = namedtuple("SharedBars", [
+    "key",
+    "start",
+    "index_name",
+    "values_name",
+    "capacity",
+    "columns",
+    "tz"
+])
+
+HEADER_BYTES = 8
+# Room for new bars on top of what's fetched, so refreshes append in place instead of copying the frame
+HEADROOM = 0.25
+MIN_HEADROOM = 1024
+
+# Workers started by the trader share its resource tracker, so blocks outlive the worker that
+# created them and whatever is left is unlinked when the trader itself exits
+def create_block(prefix, size):
+    return shared_memory.SharedMemory(create=True, size=max(size, 1), name=f"{prefix}{uuid.uuid4().hex}")
+
+def open_block(name):
+    return shared_memory.SharedMemory(name=name)
+
+def close_block(block):
+    try:
+        block.close()
+    except BufferError:
+        # Frames handed out are still alive, the mapping goes away once they're collected
+        pass
+
+class SharedBarStore:
+    """
+    Keeps fetched bar frames in shared memory blocks that outlive the strategy worker, so a recycled
+    worker maps the bars the last one fetched and only has to fetch the newest ones.
+
+    Blocks are sized with headroom and refreshes write the new bars in place, from the first one
+    that changed, before bumping the bar count. A frame is only copied into bigger blocks once the
+    headroom runs out. Frames handed out are read-only views of the blocks, taken at the count of
+    the time, so the (possibly still forming) last bar may change under a view from an earlier tick.
+    """
+    def __init__(self, prefix, descriptors=None):
+        self.prefix = prefix
+        self.bars = {}
+        self.blocks = {}
+        self.lock = threading.Lock()
+        for key, bars in (descriptors or {}).items():
+            try:
+                self.blocks[key] = (open_block(bars.index_name), open_block(bars.values_name))
+                self.bars[key] = bars
+            except FileNotFoundError:
+                # Replaced by a worker that died before it could report the new blocks
+                pass
+
+    def length(self, key):
+        return int(np.ndarray((1,), dtype=np.int64, buffer=self.blocks[key][0].buf)[0])
+
+    def view(self, key):
+        bars = self.bars[key]
+        index_block, values_block = self.blocks[key]
+        length = self.length(key)
+        index_values = np.ndarray((length,), dtype=np.int64, buffer=index_block.buf, offset=HEADER_BYTES)
+        values = np.ndarray((length, len(bars.columns)), dtype=np.float64, buffer=values_block.buf)
+        index_values.flags.writeable = False
+        values.flags.writeable = False
+        index = pd.DatetimeIndex(index_values.view("datetime64[ns]"), name="Open time")
+        if bars.tz is not None:
+            index = index.tz_localize("UTC").tz_convert(bars.tz)
+        return pd.DataFrame(values, index=index, columns=bars.columns, copy=False)
+
+    def get(self, key):
+        """
+        Returns (start the bars were fetched from, frame) or None
+        """
+        with self.lock:
+            if key not in self.bars:
+                return None
+            return self.bars[key].start, self.view(key)
+
+    def write(self, key, position, frame):
+        index_block, values_block = self.blocks[key]
+        index_values = np.ndarray((self.bars[key].capacity,), dtype=np.int64, buffer=index_block.buf, offset=HEADER_BYTES)
+        values = np.ndarray((self.bars[key].capacity, len(self.bars[key].columns)), dtype=np.float64, buffer=values_block.buf)
+        index_values[position:position + len(frame)] = frame.index.values.astype("datetime64[ns]").view(np.int64)
+        values[position:position + len(frame)] = frame.to_numpy(dtype=np.float64)
+        # Last, so the new bars are all in place before they're counted
+        np.ndarray((1,), dtype=np.int64, buffer=index_block.buf)[0] = position + len(frame)
+
+    def put(self, key, frame, start):
+        """
+        Stores a freshly fetched frame in new blocks and returns a view of it. Frames that can't be
+        stored (e.g. non-numeric columns) are returned as they are.
+        """
+        try:
+            frame.to_numpy(dtype=np.float64)
+        except (TypeError, ValueError):
+            return frame
+        with self.lock:
+            capacity = len(frame) + max(int(len(frame) * HEADROOM), MIN_HEADROOM)
+            tz = str(frame.index.tz) if getattr(frame.index, "tz", None) is not None else None
+            blocks = (
+                create_block(self.prefix, HEADER_BYTES + capacity * 8),
+                create_block(self.prefix, capacity * len(frame.columns) * 8),
+            )
+            self.remove(key)
+            self.bars[key] = SharedBars(key, start, blocks[0].name, blocks[1].name, capacity, list(frame.columns), tz)
+            self.blocks[key] = blocks
+            self.write(key, 0, frame)
+            return self.view(key)
+
+    def append(self, key, previous, frame, start):
+        """
+        Adds bars fetched from the last previous one onwards, writing them in place over the stored
+        bars from the first new timestamp when there's room, and returns a view of the whole frame
+        """
+        with self.lock:
+            stored = self.bars.get(key)
+            if stored is not None and list(frame.columns) == stored.columns:
+                current = self.view(key)
+                position = int(current.index.searchsorted(frame.index[0])) if not frame.empty else len(current)
+                if position + len(frame) <= stored.capacity:
+                    self.write(key, position, frame)
+                    return self.view(key)
+        if not frame.empty:
+            previous = previous[previous.index < frame.index[0]]
+        return self.put(key, pd.concat([previous, frame]), start)
+
+    def remove(self, key):
+        self.bars.pop(key, None)
+        for block in self.blocks.pop(key, ()):
+            close_block(block)
+            block.unlink()
+
+    def descriptors(self):
+        with self.lock:
+            return dict(self.bars)
+
+    def close(self):
+        for blocks in self.blocks.values():
+            for block in blocks:
+                close_block(block)
+        self.bars = {}
+        self.blocks = {}
+
+def unlink(names):
+    for name in names:
+        try:
+            block = open_block(name)
+        except FileNotFoundError:
+            continue
+        block.close()
+        block.unlink()
+
+def sweep(prefix, keep=()):
+    """
+    Unlinks blocks starting with prefix other than the ones to keep, e.g. the ones a worker created
+    but died before reporting. Only works where shared memory shows up under /dev/shm.
+    """
+    try:
+        names = os.listdir("/dev/shm")
+    except OSError:
+        return
+    unlink([name for name in names if name.startswith(prefix) and name not in set(keep)])
+
+def block_names(descriptors):
+    return [name for bars in descriptors.values() for name in (bars.index_name, bars.values_name)]
@@ -1,5 +1,6 @@
 from collections import namedtuple
 from decimal import Decimal
+import json
     
 Broker = namedtuple("Broker", [
     "id", 
@@ -26,7 +27,11 @@ PortfolioRun = namedtuple("PortfolioRun", [
     "status",
     "timestamp",
     "error",
-    "notified"
+    "notified",
+    "fingerprint",
+    "cache_hit",
+    "peak_memory",
+    "cpu_seconds"
 ])
 PortfolioOrder = namedtuple("PortfolioOrder", [
     "id", 
@@ -62,6 +67,23 @@ PortfolioPosition = namedtuple("PortfolioPosition", [
     "amount",
     "order_id"
 ])
+PortfolioRunMemo = namedtuple("PortfolioRunMemo", [
+    "portfolio_id",
+    "fingerprint",
+    "timestamp",
+    "result"
+])
+PortfolioSnapshot = namedtuple("PortfolioSnapshot", [
+    "id",
+    "portfolio_id",
+    "timestamp",
+    "cash",
+    "equity",
+    "market_values"
+])
+
+# Range partitioned by month, see sql/schema.sql and archive.py
+HISTORY_TABLES = ["portfolio_run", "portfolio_order", "portfolio_cash", "portfolio_position"]
 
 def to_columnselect(namedtuple_type, prefix=""):
     columns = namedtuple_type._fields
@@ -97,6 +119,17 @@ def fetch_brokers(cursor, author):
         brokers.append(Broker(*record))
     return brokers
 
+def fetch_brokers_by_type(cursor, type):    
+    records = cursor.execute(f"""
+        SELECT {to_columnselect(Broker)}
+        FROM broker
+        WHERE type = %s
+    """, (type,))
+    brokers = []
+    for record in records:
+        brokers.append(Broker(*record))
+    return brokers
+
 def fetch_cash_history(cursor, pf_id):
     records = cursor.execute(f"""
         SELECT {to_columnselect(PortfolioCash, prefix="pfc")}         
@@ -159,6 +192,15 @@ def fetch_runs(cursor, pf_id):
         runs.append(PortfolioRun(*record))
     return runs
 
+def fetch_run_memo(cursor, pf_id, fingerprint):
+    record = cursor.execute(f"""
+        SELECT {to_columnselect(PortfolioRunMemo, prefix="pfrm")}
+        FROM portfolio_run_memo pfrm
+        WHERE pfrm.portfolio_id = %s
+        AND pfrm.fingerprint = %s
+    """, (int(pf_id), fingerprint)).fetchone()
+    return None if record is None else PortfolioRunMemo(*record)
+
 def fetch_orders_by_status(cursor, pf_id, status):
     records = cursor.execute(f"""
         SELECT {to_columnselect(PortfolioOrder, prefix="pfo")}         
@@ -172,6 +214,38 @@ def fetch_orders_by_status(cursor, pf_id, status):
         orders.append(PortfolioOrder(*record))
     return orders
 
+def fetch_order(cursor, id):
+    record = cursor.execute(f"""
+        SELECT {to_columnselect(PortfolioOrder, prefix="pfo")}         
+        FROM portfolio_order pfo
+        WHERE pfo.id = %s
+    """, (int(id),)).fetchone()
+    return None if record is None else PortfolioOrder(*record)
+
+def fetch_snapshots(cursor, pf_id, start=None, end=None):
+    records = cursor.execute(f"""
+        SELECT {to_columnselect(PortfolioSnapshot, prefix="pfs")}
+        FROM portfolio_snapshot pfs
+        WHERE pfs.portfolio_id = %s
+        AND (%s::timestamp IS NULL OR pfs.timestamp >= %s::timestamp)
+        AND (%s::timestamp IS NULL OR pfs.timestamp <= %s::timestamp)
+        ORDER BY pfs.timestamp ASC
+    """, (int(pf_id), start, start, end, end))
+    snapshots = []
+    for record in records:
+        snapshots.append(PortfolioSnapshot(*record))
+    return snapshots
+
+def fetch_latest_snapshot(cursor, pf_id):
+    record = cursor.execute(f"""
+        SELECT {to_columnselect(PortfolioSnapshot, prefix="pfs")}
+        FROM portfolio_snapshot pfs
+        WHERE pfs.portfolio_id = %s
+        ORDER BY pfs.timestamp DESC
+        LIMIT 1
+    """, (int(pf_id),)).fetchone()
+    return None if record is None else PortfolioSnapshot(*record)
+
 def fetch_portfolio(cursor, author, id):
     record = cursor.execute(f"""
         SELECT {to_columnselect(Portfolio)}   
@@ -180,6 +254,14 @@ def fetch_portfolio(cursor, author, id):
     """, (int(id), str(author))).fetchone()
     return Portfolio(*record)
 
+def fetch_portfolio_by_id(cursor, id):
+    record = cursor.execute(f"""
+        SELECT {to_columnselect(Portfolio)}
+        FROM portfolio
+        WHERE id = %s
+    """, (int(id),)).fetchone()
+    return Portfolio(*record) if record else None
+
 def fetch_portfolios(cursor, author):    
     records = cursor.execute(f"""
         SELECT {to_columnselect(Portfolio)}
@@ -272,9 +354,13 @@ def insert_run(cursor, run):
             status,
             timestamp,
             error,
-            notified
+            notified,
+            fingerprint,
+            cache_hit,
+            peak_memory,
+            cpu_seconds
         )
-        VALUES (%s, %s, %s, %s, %s)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
         RETURNING id
     """, 
     (
@@ -282,10 +368,48 @@ def insert_run(cursor, run):
         run.status, 
         run.timestamp, 
         run.error, 
-        bool(run.notified)
+        bool(run.notified),
+        run.fingerprint,
+        bool(run.cache_hit),
+        int(run.peak_memory) if run.peak_memory is not None else None,
+        float(run.cpu_seconds) if run.cpu_seconds is not None else None
     )).fetchone()
     return record[0]
 
+def insert_run_memo(cursor, memo):
+    cursor.execute("""
+        INSERT INTO portfolio_run_memo
+        (
+            portfolio_id,
+            fingerprint,
+            timestamp,
+            result
+        )
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (portfolio_id, fingerprint) DO UPDATE
+            SET timestamp = EXCLUDED.timestamp,
+                result = EXCLUDED.result
+    """, 
+    (
+        int(memo.portfolio_id), 
+        memo.fingerprint,
+        memo.timestamp,
+        json.dumps(memo.result)
+    ))
+
+def delete_old_run_memos(cursor, pf_id, keep):
+    cursor.execute("""
+        DELETE FROM portfolio_run_memo
+        WHERE portfolio_id = %s
+        AND fingerprint NOT IN (
+            SELECT fingerprint
+            FROM portfolio_run_memo
+            WHERE portfolio_id = %s
+            ORDER BY timestamp DESC
+            LIMIT %s
+        )
+    """, (int(pf_id), int(pf_id), int(keep)))
+
 def insert_order(cursor, order):
     record = cursor.execute("""
         INSERT INTO portfolio_order
@@ -328,6 +452,18 @@ def update_run(cursor, run):
         int(run.id)
     ))
     
+def update_run_submit_latency(cursor, run_id, submit_latency):
+    cursor.execute("""
+        UPDATE portfolio_run
+        SET
+            submit_latency = %s
+        WHERE id = %s
+    """,
+    (
+        float(submit_latency),
+        int(run_id)
+    ))
+
 def update_order(cursor, order):
     cursor.execute("""
         UPDATE portfolio_order
@@ -373,3 +509,165 @@ def insert_cash(cursor, cash):
         int(cash.order_id) if cash.order_id is not None else None
     )).fetchone()
     return record[0]
+
+def insert_snapshot(cursor, snapshot):
+    record = cursor.execute("""
+        INSERT INTO portfolio_snapshot
+        (
+            portfolio_id,
+            timestamp,
+            cash,
+            equity,
+            market_values
+        )
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (portfolio_id, timestamp) DO UPDATE
+            SET cash = EXCLUDED.cash,
+                equity = EXCLUDED.equity,
+                market_values = EXCLUDED.market_values
+        RETURNING id
+    """, 
+    (
+        int(snapshot.portfolio_id), 
+        snapshot.timestamp,
+        snapshot.cash,
+        snapshot.equity,
+        json.dumps(snapshot.market_values)
+    )).fetchone()
+    return record[0]
+
+def update_node_heartbeat(cursor, node_id):
+    cursor.execute("""
+        INSERT INTO trader_node
+        (
+            id,
+            heartbeat_timestamp
+        )
+        VALUES (%s, now() AT TIME ZONE 'UTC')
+        ON CONFLICT (id) DO UPDATE
+            SET heartbeat_timestamp = EXCLUDED.heartbeat_timestamp
+    """, (str(node_id),))
+
+def delete_node(cursor, node_id):
+    cursor.execute("""
+        DELETE FROM portfolio_lease
+        WHERE node_id = %s
+    """, (str(node_id),))
+    cursor.execute("""
+        DELETE FROM trader_node
+        WHERE id = %s
+    """, (str(node_id),))
+
+def fetch_live_node_count(cursor, ttl_seconds):
+    record = cursor.execute("""
+        SELECT COUNT(*)
+        FROM trader_node
+        WHERE heartbeat_timestamp > (now() AT TIME ZONE 'UTC') - %s * interval '1 second'
+    """, (int(ttl_seconds),)).fetchone()
+    return int(record[0])
+
+def fetch_leased_portfolio_ids(cursor, node_id):
+    records = cursor.execute("""
+        SELECT portfolio_id
+        FROM portfolio_lease
+        WHERE node_id = %s
+        AND expire_timestamp > now() AT TIME ZONE 'UTC'
+    """, (str(node_id),))
+    return [record[0] for record in records]
+
+def claim_portfolio(cursor, pf_id, node_id, ttl_seconds):
+    """
+    Take or extend the lease on a portfolio. Only succeeds if nobody else holds an unexpired lease.
+    """
+    record = cursor.execute("""
+        INSERT INTO portfolio_lease AS pfl
+        (
+            portfolio_id,
+            node_id,
+            expire_timestamp
+        )
+        VALUES (%s, %s, (now() AT TIME ZONE 'UTC') + %s * interval '1 second')
+        ON CONFLICT (portfolio_id) DO UPDATE
+            SET node_id = EXCLUDED.node_id,
+                expire_timestamp = EXCLUDED.expire_timestamp
+            WHERE pfl.node_id = EXCLUDED.node_id
+            OR pfl.expire_timestamp <= now() AT TIME ZONE 'UTC'
+        RETURNING portfolio_id
+    """, (int(pf_id), str(node_id), int(ttl_seconds))).fetchone()
+    return record is not None
+
+def renew_leases(cursor, node_id, ttl_seconds):
+    records = cursor.execute("""
+        UPDATE portfolio_lease
+        SET expire_timestamp = (now() AT TIME ZONE 'UTC') + %s * interval '1 second'
+        WHERE node_id = %s
+        AND expire_timestamp > now() AT TIME ZONE 'UTC'
+        RETURNING portfolio_id
+    """, (int(ttl_seconds), str(node_id)))
+    return [record[0] for record in records]
+
+def release_portfolio(cursor, pf_id, node_id):
+    cursor.execute("""
+        DELETE FROM portfolio_lease
+        WHERE portfolio_id = %s
+        AND node_id = %s
+    """, (int(pf_id), str(node_id)))
+
+def take_rate_limit_token(cursor, account, rate, capacity, reserve):
+    """
+    Take a token from an account's shared bucket if more than reserve would be left.
+    Returns (taken, seconds to wait before trying again).
+    """
+    cursor.execute("""
+        INSERT INTO broker_rate_limit (account, tokens, update_timestamp)
+        VALUES (%s, %s, now() AT TIME ZONE 'UTC')
+        ON CONFLICT (account) DO NOTHING
+    """, (str(account), float(capacity)))
+    record = cursor.execute("""
+        WITH refilled AS (
+            SELECT
+                account,
+                LEAST(%s, tokens + EXTRACT(EPOCH FROM (now() AT TIME ZONE 'UTC') - update_timestamp) * %s) AS tokens,
+                GREATEST(0, COALESCE(EXTRACT(EPOCH FROM blocked_until - (now() AT TIME ZONE 'UTC')), 0)) AS blocked_seconds
+            FROM broker_rate_limit
+            WHERE account = %s
+            FOR UPDATE
+        )
+        UPDATE broker_rate_limit brl
+        SET tokens = CASE WHEN r.blocked_seconds = 0 AND r.tokens >= 1 + %s THEN r.tokens - 1 ELSE r.tokens END,
+            update_timestamp = now() AT TIME ZONE 'UTC'
+        FROM refilled r
+        WHERE brl.account = r.account
+        RETURNING r.tokens, r.blocked_seconds
+    """, (float(capacity), float(rate), str(account), float(reserve))).fetchone()
+    tokens, blocked_seconds = float(record[0]), float(record[1])
+    if blocked_seconds > 0:
+        return False, blocked_seconds
+    if tokens >= 1 + reserve:
+        return True, 0
+    return False, (1 + reserve - tokens) / rate
+
+def block_rate_limit(cursor, account, seconds):
+    """
+    Stop every process taking tokens for an account for the given number of seconds, e.g. after a 429
+    """
+    cursor.execute("""
+        UPDATE broker_rate_limit
+        SET tokens = 0,
+            update_timestamp = now() AT TIME ZONE 'UTC',
+            blocked_until = GREATEST(
+                COALESCE(blocked_until, now() AT TIME ZONE 'UTC'),
+                (now() AT TIME ZONE 'UTC') + %s * interval '1 second'
+            )
+        WHERE account = %s
+    """, (float(seconds), str(account)))
+
+def create_history_partitions(cursor, months_ahead):
+    """
+    Create the monthly partitions of the history tables up to months_ahead from now, moving any rows
+    for those months out of the default partitions (see create_monthly_partitions in schema.sql)
+    """
+    for table in HISTORY_TABLES:
+        cursor.execute("""
+            SELECT create_monthly_partitions(%s, CURRENT_DATE, (CURRENT_DATE + %s * interval '1 month')::date)
+        """, (table, int(months_ahead)))
@@ -0,0 +1,344 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+import threading
+from email.utils import parsedate_to_datetime
+import model
+
+log = logging.getLogger()
+
+# Alpaca allows 200 requests a minute per account, stay a little under that
+RATE_LIMIT_PER_MINUTE = int(os.environ.get("TRADEBOT_BROKER_RATE_LIMIT", 190))
+BURST = int(os.environ.get("TRADEBOT_BROKER_BURST", 10))
+# Tokens the lower lanes leave in the bucket so order submissions from any process can still go out
+SUBMIT_RESERVE = 3
+RETRY_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 0.5
+RETRY_MAX_SECONDS = 30
+
+# Priority lanes, lower goes first
+SUBMIT = 0
+RECONCILE = 1
+
+class RetryableError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def parse_retry_after(headers):
+    """
+    Seconds the server asked us to wait, from Retry-After (seconds or an HTTP date) or
+    Alpaca's X-RateLimit-Reset (a unix timestamp), or None
+    """
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    value = headers.get("X-RateLimit-Reset")
+    if value:
+        try:
+            return max(0, float(value) - time.time())
+        except ValueError:
+            pass
+    return None
+
+def error_info(e):
+    """
+    Returns (HTTP status, seconds to wait) for the errors raised by the Alpaca SDKs, aiohttp and urllib
+    """
+    if isinstance(e, RetryableError):
+        return e.status, e.retry_after
+    status = None
+    headers = None
+    # The SDK errors look these up on the wrapped HTTP error, which may be missing
+    for name in ("status_code", "status", "code"):
+        try:
+            value = getattr(e, name, None)
+        except Exception:
+            value = None
+        if isinstance(value, int):
+            status = value
+            break
+    try:
+        headers = getattr(e, "headers", None) or getattr(getattr(e, "response", None), "headers", None)
+    except Exception:
+        headers = None
+    return status, parse_retry_after(headers)
+
+def retry_delay(e, attempt, idempotent):
+    """
+    Seconds to wait before retrying a failed call, or None if it shouldn't be retried.
+    Calls that aren't idempotent (order submission) are only retried when the server rejected
+    them for the rate limit, since anything else may have gone through.
+    """
+    if attempt + 1 >= RETRY_ATTEMPTS:
+        return None
+    status, retry_after = error_info(e)
+    if status == 429:
+        retryable = True
+    elif not idempotent:
+        retryable = False
+    elif status is not None:
+        retryable = status >= 500
+    else:
+        retryable = isinstance(e, (RetryableError, OSError, TimeoutError, asyncio.TimeoutError))
+    if not retryable:
+        return None
+    # Full jitter so callers that failed together don't retry together
+    delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+class LocalBucket:
+    """
+    Token bucket shared by the threads of this process
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.update_time = time.monotonic()
+        self.blocked_until = 0
+
+    def take(self, reserve):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.update_time) * self.rate)
+        self.update_time = now
+        if now < self.blocked_until:
+            return False, self.blocked_until - now
+        if self.tokens >= 1 + reserve:
+            self.tokens -= 1
+            return True, 0
+        return False, (1 + reserve - self.tokens) / self.rate
+
+    def block(self, seconds):
+        self.tokens = 0
+        self.update_time = time.monotonic()
+        self.blocked_until = max(self.blocked_until, self.update_time + seconds)
+
+class DbBucket:
+    """
+    Token bucket shared by every process using the same DB, kept in the broker_rate_limit table.
+    Falls back to limiting this process alone while the DB can't be reached.
+    """
+    def __init__(self, conn_string, account, rate, capacity):
+        self.conn_string = conn_string
+        self.account = account
+        self.rate = rate
+        self.capacity = capacity
+        self.conn = None
+        self.fallback = LocalBucket(rate, capacity)
+
+    def execute(self, fn, *args):
+        import psycopg
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg.connect(self.conn_string, autocommit=True)
+            with self.conn.cursor() as cursor:
+                return fn(cursor, self.account, *args)
+        except psycopg.Error as e:
+            log.warning(f"Shared rate limit unavailable, limiting this process only: {e}")
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            return None
+
+    def take(self, reserve):
+        result = self.execute(model.take_rate_limit_token, self.rate, self.capacity, reserve)
+        return result if result is not None else self.fallback.take(reserve)
+
+    def block(self, seconds):
+        self.fallback.block(seconds)
+        self.execute(model.block_rate_limit, seconds)
+
+class RateLimiter:
+    """
+    Hands out a bucket's tokens to waiting callers in priority order, and wraps broker calls
+    with jittered retries that honour Retry-After.
+    """
+    def __init__(self, bucket, reserve=SUBMIT_RESERVE):
+        self.bucket = bucket
+        self.reserve = reserve
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.tickets = itertools.count()
+
+    def acquire(self, priority=RECONCILE):
+        ticket = (priority, next(self.tickets))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            self.condition.notify_all()
+            try:
+                while True:
+                    wait = None
+                    if self.waiting[0] == ticket:
+                        taken, wait = self.bucket.take(0 if priority == SUBMIT else self.reserve)
+                        if taken:
+                            return
+                    self.condition.wait(wait)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def block(self, seconds):
+        with self.condition:
+            self.bucket.block(seconds)
+
+    def backoff(self, e, attempt, idempotent):
+        delay = retry_delay(e, attempt, idempotent)
+        if delay is None:
+            return None
+        status, retry_after = error_info(e)
+        if status == 429:
+            # Our idea of the quota was off, stop everyone on this account rather than just this caller
+            self.block(retry_after if retry_after is not None else delay)
+        log.warning(f"Broker call failed ({status if status else type(e).__name__}), retrying in {delay:.2f}s...")
+        return delay
+
+    def call(self, fn, *args, priority=RECONCILE, idempotent=True, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire(priority)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.backoff(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, fn, *args, priority=RECONCILE, idempotent=True, **kwargs):
+        attempt = 0
+        while True:
+            await asyncio.get_running_loop().run_in_executor(None, self.acquire, priority)
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.backoff(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+# One limiter per broker account in this process
+limiters = {}
+limiters_lock = threading.Lock()
+shared_conn_string = None
+
+def share_via_db(conn_string):
+    """
+    Make limiters created from now on share their buckets with other processes through the DB
+    """
+    global shared_conn_string
+    shared_conn_string = conn_string
+
+def limiter_for(credentials):
+    account = credentials.get("api_key", "")
+    rate = RATE_LIMIT_PER_MINUTE / 60
+    with limiters_lock:
+        if account not in limiters:
+            if shared_conn_string:
+                bucket = DbBucket(shared_conn_string, account, rate, BURST)
+            else:
+                bucket = LocalBucket(rate, BURST)
+            limiters[account] = RateLimiter(bucket)
+        return limiters[account]
+
+def serve_stand_in(quota, window):
+    """
+    Starts a local HTTP server that allows quota requests per window seconds and answers
+    everything over it with a 429 and Retry-After, like a broker enforcing its quota
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    lock = threading.Lock()
+    state = {"window_start": time.monotonic(), "count": 0, "rejected": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                now = time.monotonic()
+                if now - state["window_start"] >= window:
+                    state["window_start"] = now
+                    state["count"] = 0
+                state["count"] += 1
+                allowed = state["count"] <= quota
+                retry_after = window - (now - state["window_start"])
+                if not allowed:
+                    state["rejected"] += 1
+            if allowed:
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"{}")
+            else:
+                self.send_response(429)
+                self.send_header("Retry-After", f"{max(1, round(retry_after))}")
+                self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+if __name__ == "__main__":
+    import urllib.request
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Drive the rate limiter against a local stand-in that returns 429s over its quota")
+    parser.add_argument("--quota", type=int, default=20, help="requests the stand-in allows per window")
+    parser.add_argument("--window", type=float, default=5, help="seconds per stand-in window")
+    parser.add_argument("--rate", type=float, default=None, help="requests per window to limit to, defaults to the quota")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=60)
+    args = parser.parse_args()
+
+    server, state = serve_stand_in(args.quota, args.window)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    limiter = RateLimiter(LocalBucket((args.rate if args.rate else args.quota) / args.window, BURST))
+    counter = itertools.count()
+    failures = []
+
+    def get():
+        with urllib.request.urlopen(url) as response:
+            return response.read()
+
+    def client():
+        while next(counter) < args.requests:
+            try:
+                limiter.call(get, priority=random.choice([SUBMIT, RECONCILE]))
+            except Exception as e:
+                failures.append(e)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    server.shutdown()
+
+    print(f"{args.requests - len(failures)} requests succeeded and {len(failures)} failed in {elapsed:.1f}s")
+    print(f"{state['rejected']} rejected with 429, throughput {(args.requests - len(failures)) / elapsed * args.window:.1f} per {args.window:g}s window (quota {args.quota})")
@@ -0,0 +1,278 @@
+import logging
+import argparse
+import importlib
+from contextlib import nullcontext
+from decimal import Decimal
+from datetime import timedelta, timezone
+import pandas as pd
+from model import Broker, Portfolio, PortfolioRun, PortfolioOrder, PortfolioCash, PortfolioPosition
+import brokers
+import trader
+import util
+
+log = logging.getLogger()
+
+class MemoryConnection:
+    def cursor(self):
+        return nullcontext(None)
+
+class MemoryLedger:
+    """
+    In-memory stand-in for the model module, exposing the same functions the trader calls
+    (the cursor argument is ignored). Filled orders update cash and positions the same way
+    the update_cash_and_position trigger does in the DB.
+    """
+    def __init__(self, broker, portfolio):
+        self.broker = broker
+        self.portfolio = portfolio
+        self.runs = []
+        self.orders = []
+        self.cash = []
+        self.positions = []
+        self.snapshots = []
+        self.run_memos = {}
+        self.submit_latencies = {}
+
+    def fetch_portfolio_broker(self, cursor, pf_id):
+        return self.broker
+
+    def fetch_available_cash(self, cursor, pf_id):
+        return sum((cash.amount for cash in self.cash), Decimal(0))
+
+    def fetch_positions(self, cursor, pf_id):
+        positions = {}
+        for position in self.positions:
+            positions[position.ticker] = positions.get(position.ticker, Decimal(0)) + position.amount
+        return positions
+
+    def fetch_orders_by_status(self, cursor, pf_id, status):
+        return [order for order in self.orders if order.status == status]
+
+    def insert_run(self, cursor, run):
+        run = PortfolioRun(len(self.runs) + 1, *list(run)[1:])
+        self.runs.append(run)
+        return run.id
+
+    def delete_old_run_memos(self, cursor, pf_id, keep):
+        memos = sorted((memo for memo in self.run_memos.values() if memo.portfolio_id == pf_id), key=lambda memo: memo.timestamp, reverse=True)
+        for memo in memos[keep:]:
+            del self.run_memos[(memo.portfolio_id, memo.fingerprint)]
+
+    def update_run_submit_latency(self, cursor, run_id, submit_latency):
+        self.submit_latencies[run_id] = submit_latency
+
+    def fetch_run_memo(self, cursor, pf_id, fingerprint):
+        return self.run_memos.get((pf_id, fingerprint))
+
+    def insert_run_memo(self, cursor, memo):
+        self.run_memos[(memo.portfolio_id, memo.fingerprint)] = memo
+
+    def update_portfolio(self, cursor, portfolio):
+        # The DB stores naive UTC timestamps
+        last_run_timestamp = portfolio.last_run_timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        self.portfolio = self.portfolio._replace(enabled=portfolio.enabled, last_run_timestamp=last_run_timestamp)
+
+    def insert_order(self, cursor, order):
+        order = PortfolioOrder(len(self.orders) + 1, *list(order)[1:])
+        self.orders.append(order)
+        return order.id
+
+    def update_order(self, cursor, order):
+        self.orders[order.id - 1] = order
+        if order.status != "filled":
+            return
+        quantity = Decimal(order.fill_quantity)
+        value = quantity * Decimal(order.fill_price)
+        fee = Decimal(order.fill_fee)
+        if order.side == "buy":
+            self.positions.append(PortfolioPosition(len(self.positions) + 1, order.portfolio_id, "purchase", order.fill_timestamp, order.ticker, quantity, order.id))
+            self.cash.append(PortfolioCash(len(self.cash) + 1, order.portfolio_id, "purchase", order.fill_timestamp, -(value + fee), order.id))
+        elif order.side == "sell":
+            self.positions.append(PortfolioPosition(len(self.positions) + 1, order.portfolio_id, "sale", order.fill_timestamp, order.ticker, -quantity, order.id))
+            self.cash.append(PortfolioCash(len(self.cash) + 1, order.portfolio_id, "sale", order.fill_timestamp, value - fee, order.id))
+
+    def fetch_latest_snapshot(self, cursor, pf_id):
+        return self.snapshots[-1] if self.snapshots else None
+
+    def insert_snapshot(self, cursor, snapshot):
+        snapshot = snapshot._replace(id=len(self.snapshots) + 1)
+        self.snapshots.append(snapshot)
+        return snapshot.id
+
+    def deposit(self, amount, timestamp):
+        self.cash.append(PortfolioCash(len(self.cash) + 1, self.portfolio.id, "deposit", timestamp, Decimal(amount), None))
+
+def bars_at(close, opens, now, timeframe):
+    """
+    What the trader could have known at now: the closes of completed bars, plus the bar in progress
+    with only its open. A historical bar's close is only final once the bar is over.
+    """
+    current = pd.Timestamp(now).floor(timeframe)
+    completed = close.loc[:current - pd.Timedelta(timeframe)]
+    if current not in opens.index:
+        return completed
+    return pd.concat([completed, opens.loc[[current]]])
+
+class ReplayBroker(brokers.Broker):
+    """
+    Fills every submitted order on the next trader tick, at the open of the bar then in progress
+    """
+    def __init__(self, log, ledger, close, opens, timeframe, clock):
+        super().__init__(log, {})
+        self.ledger = ledger
+        self.close = close
+        self.opens = opens
+        self.timeframe = timeframe
+        self.clock = clock
+        self.submitted = set()
+
+    def price(self, ticker):
+        return Decimal(str(bars_at(self.close, self.opens, self.clock(), self.timeframe)[ticker].dropna().iloc[-1]))
+
+    def positions(self, portfolio):
+        return self.ledger.fetch_positions(None, portfolio.id)
+
+    def resolve_orders(self, portfolio, open_orders):
+        resolved_orders = []
+        for open_order in open_orders:
+            if open_order.id not in self.submitted:
+                continue
+            price = self.price(open_order.ticker)
+            quantity = open_order.quantity if open_order.side == "sell" else open_order.notional / price
+            resolved_orders.append(open_order._replace(
+                status="filled",
+                fill_timestamp=self.clock().replace(tzinfo=None),
+                fill_quantity=quantity,
+                fill_price=price,
+                fill_fee=Decimal(0),
+                broker_order_id=str(open_order.id),
+            ))
+        return resolved_orders
+
+    def submit_orders(self, portfolio, orders):
+        for order in orders:
+            self.submitted.add(order.id)
+
+def load_replay_data(pf_module, data_params):
+    """
+    Returns the module's bars (closes) along with each bar's open. Strategies only load closes, so
+    the opens are taken from the bars fetched along the way, falling back to the previous close.
+    """
+    fetched = {}
+    fetcher = util.default_fetcher
+    def recording_fetcher(ticker, timeframe, start, end, **kwargs):
+        bars = fetcher(ticker, timeframe, start, end, **kwargs)
+        if "Open" in bars:
+            fetched[ticker] = bars["Open"]
+        return bars
+
+    util.set_fetcher(recording_fetcher)
+    try:
+        close = pf_module.load_data(data_params)
+    finally:
+        util.set_fetcher(fetcher)
+    opens = pd.DataFrame({
+        column: fetched[column].reindex(close.index) if column in fetched else close[column].shift()
+        for column in close.columns
+    }, index=close.index)
+    return close, opens
+
+def replay(module, schedule, start, end=None, init_cash=10000, lag=timedelta(seconds=1), params=None, timeframe="1h"):
+    """
+    Run the real trader scheduling and order generation against historical bars, jumping the
+    simulated clock straight from one schedule fire time (or open order poll) to the next.
+    Each run only sees the bars completed by then (see bars_at), timeframe being the bars' length.
+
+    Returns the ledger holding every run and order the trader would have made, and the bars used.
+    """
+    pf_module = importlib.import_module(module)
+    data_params = {**(params if params else {}), "start": start, "end": end}
+    close, opens = load_replay_data(pf_module, data_params)
+    start = pd.Timestamp(start, tz="UTC")
+    end = close.index.max() if end is None else pd.Timestamp(end, tz="UTC")
+
+    now = start.to_pydatetime()
+    clock = lambda: now
+    util.set_clock(clock)
+
+    portfolio = Portfolio(0, "replay", True, 0, module, "replay", module, schedule, start.to_pydatetime().replace(tzinfo=None), None)
+    ledger = MemoryLedger(Broker(0, "replay", "replay", "replay", None), portfolio)
+    ledger.deposit(init_cash, portfolio.start_timestamp)
+    broker = ReplayBroker(log, ledger, close, opens, timeframe, clock)
+    conn = MemoryConnection()
+
+    try:
+        while now <= end:
+            trader.tick_portfolio(conn, ledger.portfolio, now=now, ledger=ledger, broker_factory=lambda record: broker, data=bars_at(close, opens, now, timeframe))
+            if ledger.fetch_orders_by_status(None, portfolio.id, "open"):
+                now = now + timedelta(seconds=trader.POLL_SECONDS)
+            else:
+                now = trader.next_scheduled_run_time(ledger.portfolio, now) + lag
+    finally:
+        util.set_clock(None)
+    return ledger, close
+
+def divergence_report(module, ledger, close, init_cash=10000, timeframe="H"):
+    """
+    Compare the orders the replayed trader made against a plain backtest of the same module
+    over the same bars. Orders are matched on bar, ticker and side.
+    """
+    pf_module = importlib.import_module(module)
+    pf = pf_module.create_portfolio({"pf_kwargs": {"init_cash": init_cash}}, close)
+
+    backtest = pf.orders.records_readable
+    backtest = pd.DataFrame({
+        "bar": pd.to_datetime(backtest["Timestamp"], utc=True).dt.floor(timeframe),
+        "ticker": backtest["Column"].map(trader.column_to_ticker),
+        "side": backtest["Side"].str.lower(),
+        "backtest_size": backtest["Size"].astype(float),
+        "backtest_price": backtest["Price"].astype(float),
+    })
+    live = pd.DataFrame([order._asdict() for order in ledger.orders if order.status == "filled"], columns=PortfolioOrder._fields)
+    live = pd.DataFrame({
+        "bar": pd.to_datetime(live["create_timestamp"], utc=True).dt.floor(timeframe),
+        "ticker": live["ticker"],
+        "side": live["side"],
+        "live_size": live["fill_quantity"].astype(float),
+        "live_price": live["fill_price"].astype(float),
+        "live_fill_timestamp": pd.to_datetime(live["fill_timestamp"], utc=True),
+    })
+
+    report = backtest.merge(live, on=["bar", "ticker", "side"], how="outer", indicator=True)
+    report["_merge"] = report["_merge"].map({"both": "matched", "left_only": "backtest_only", "right_only": "live_only"})
+    report = report.rename(columns={"_merge": "match"}).sort_values(by="bar").reset_index(drop=True)
+
+    cash = ledger.fetch_available_cash(None, ledger.portfolio.id)
+    positions = ledger.fetch_positions(None, ledger.portfolio.id)
+    live_value = float(cash) + sum(float(amount) * float(close[ticker].dropna().iloc[-1]) for ticker, amount in positions.items())
+    summary = {
+        "matched": int((report["match"] == "matched").sum()),
+        "backtest_only": int((report["match"] == "backtest_only").sum()),
+        "live_only": int((report["match"] == "live_only").sum()),
+        "failed_runs": sum(1 for run in ledger.runs if run.status == "failed"),
+        "backtest_final_value": float(pf.final_value),
+        "live_final_value": live_value,
+    }
+    return report, summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the live trader loop for a strategy module against historical bars")
+    parser.add_argument("module", help="strategy module name, e.g. bitcoin_market_open_arb")
+    parser.add_argument("schedule", help="cron schedule in America/New_York, e.g. '0 12 * * 1-5'")
+    parser.add_argument("--start", required=True)
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--cash", type=float, default=10000)
+    parser.add_argument("--timeframe", default="1h", help="length of the module's bars")
+    parser.add_argument("--output", default=None, help="path of a CSV file to write the divergence report to")
+    parser.add_argument("--verbose", action="store_true", help="keep the trader's per tick logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        log.setLevel(logging.WARNING)
+    ledger, close = replay(args.module, args.schedule, args.start, args.end, init_cash=args.cash, timeframe=args.timeframe)
+    report, summary = divergence_report(args.module, ledger, close, init_cash=args.cash)
+    if args.output:
+        report.to_csv(args.output, index=False)
+    print(report.to_string())
+    for key, value in summary.items():
+        print(f"{key}: {value}")
@@ -0,0 +1,95 @@
+import os
+import logging
+import argparse
+from decimal import Decimal
+import pandas as pd
+import psycopg
+import vectorbtpro as vbt
+from model import (
+    fetch_cash_history,
+    fetch_position_history,
+    insert_snapshot,
+    PortfolioSnapshot
+)
+
+log = logging.getLogger()
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s:%(levelname)s %(message)s')
+handler.setFormatter(formatter)
+log.addHandler(handler)
+log.setLevel(logging.INFO)
+
+DB_CONN_STRING = os.environ.get("TRADEBOT_DB_CONN")
+
+def fetch_daily_closes(tickers, start, end):
+    closes = {}
+    for ticker in tickers:
+        # Alpaca crypto pairs are the only tickers with a slash in them
+        kwargs = {"client_type": "crypto"} if "/" in ticker else {}
+        close = vbt.AlpacaData.fetch(ticker, timeframe="1 day", adjustment="all", start=start, end=end, **kwargs).get("Close")
+        closes[ticker] = close.tz_convert(None) if close.index.tz is not None else close
+    return pd.DataFrame(closes)
+
+def daily_snapshots(pf_id, cash_history, position_history, closes, freq="D"):
+    """
+    Rebuild end-of-period snapshots by replaying the cash and position ledgers against
+    historical closes. Timestamps are naive UTC, matching the rest of the DB.
+    """
+    cash = [(c.event_timestamp, Decimal(c.amount)) for c in cash_history if c.event_timestamp is not None]
+    positions = pd.DataFrame([p._asdict() for p in position_history if p.event_timestamp is not None])
+
+    start = min([timestamp for timestamp, amount in cash] + ([positions["event_timestamp"].min()] if not positions.empty else []))
+    periods = pd.date_range(start=pd.Timestamp(start).ceil(freq), end=pd.Timestamp.utcnow().tz_localize(None).floor(freq), freq=freq)
+    closes = closes.reindex(closes.index.union(periods)).ffill().reindex(periods)
+
+    snapshots = []
+    for period in periods:
+        period_cash = sum((amount for timestamp, amount in cash if timestamp <= period), Decimal(0))
+        market_values = {}
+        if not positions.empty:
+            held = positions[positions["event_timestamp"] <= period].groupby("ticker")["amount"].sum()
+            for ticker, amount in held.items():
+                amount = Decimal(amount)
+                if amount == 0 or pd.isna(closes.loc[period, ticker]):
+                    continue
+                price = Decimal(str(closes.loc[period, ticker]))
+                market_values[ticker] = {"amount": str(amount), "price": str(price), "value": str(amount * price)}
+        snapshots.append(PortfolioSnapshot(
+            0,
+            pf_id,
+            period.to_pydatetime(),
+            period_cash,
+            period_cash + sum((Decimal(value["value"]) for value in market_values.values()), Decimal(0)),
+            market_values
+        ))
+    return snapshots
+
+def backfill(conn, pf_id, freq="D"):
+    with conn.cursor() as cursor:
+        cash_history = fetch_cash_history(cursor, pf_id)
+        position_history = fetch_position_history(cursor, pf_id)
+    if not cash_history:
+        log.info(f"Portfolio {pf_id} has no cash history, nothing to backfill")
+        return 0
+
+    tickers = sorted(set(p.ticker for p in position_history))
+    start = min(c.event_timestamp for c in cash_history if c.event_timestamp is not None)
+    closes = fetch_daily_closes(tickers, start, None) if tickers else pd.DataFrame()
+    snapshots = daily_snapshots(pf_id, cash_history, position_history, closes, freq)
+
+    with conn.cursor() as cursor:
+        for snapshot in snapshots:
+            insert_snapshot(cursor, snapshot)
+    return len(snapshots)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill portfolio_snapshot from the cash and position history")
+    parser.add_argument("portfolio_id", type=int, nargs="+")
+    parser.add_argument("--freq", default="D", help="snapshot frequency as a pandas offset alias")
+    args = parser.parse_args()
+
+    with psycopg.connect(DB_CONN_STRING) as conn:
+        for pf_id in args.portfolio_id:
+            log.info(f"Backfilling snapshots for portfolio {pf_id}...")
+            count = backfill(conn, pf_id, args.freq)
+            log.info(f"Wrote {count} snapshots for portfolio {pf_id}")
@@ -0,0 +1,208 @@
+-- Migrates an existing database to the monthly partitioned history tables in schema.sql.
+-- Run with: psql "$TRADEBOT_DB_CONN" -f sql/partition_history.sql
+-- Stop the trader, chatter and streamer first, the tables are rewritten.
+
+-- New enum values can't be used in the transaction that adds them, so add them up front
+ALTER TYPE cash_event ADD VALUE IF NOT EXISTS 'balance';
+ALTER TYPE position_event ADD VALUE IF NOT EXISTS 'balance';
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION create_monthly_partitions(parent TEXT, from_month DATE, to_month DATE)
+  RETURNS VOID
+AS
+$$
+  DECLARE
+    month DATE := date_trunc('month', from_month);
+    month_partition TEXT;
+    default_partition TEXT;
+    partition_key TEXT;
+  BEGIN
+    -- Trader nodes and archive.py all create upcoming months
+    PERFORM pg_advisory_xact_lock(hashtext('create_monthly_partitions'), hashtext(parent));
+    SELECT d.relname, a.attname INTO default_partition, partition_key
+    FROM pg_partitioned_table p
+    INNER JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+    LEFT JOIN pg_class d ON d.oid = p.partdefid
+    WHERE p.partrelid = parent::regclass;
+    WHILE month <= to_month LOOP
+        month_partition := parent || '_p' || to_char(month, 'YYYYMM');
+        IF to_regclass(quote_ident(month_partition)) IS NULL THEN
+            -- Rows for a month that had no partition yet sit in the default one, which can't be
+            -- attached next to while it has them. Move them over before attaching the new month.
+            EXECUTE format('CREATE TABLE %I (LIKE %I)', month_partition, parent);
+            IF default_partition IS NOT NULL THEN
+                EXECUTE format('LOCK TABLE %I IN SHARE ROW EXCLUSIVE MODE', default_partition);
+                EXECUTE format(
+                    'WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                    default_partition, partition_key, month, partition_key, month + interval '1 month', month_partition
+                );
+            END IF;
+            EXECUTE format(
+                'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                parent, month_partition, month, month + interval '1 month'
+            );
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+  END;
+$$
+LANGUAGE plpgsql;
+
+-- Columns added since the original schema, in case this database predates them
+ALTER TABLE portfolio_run ADD COLUMN IF NOT EXISTS fingerprint TEXT;
+ALTER TABLE portfolio_run ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE portfolio_run ADD COLUMN IF NOT EXISTS peak_memory BIGINT;
+ALTER TABLE portfolio_run ADD COLUMN IF NOT EXISTS cpu_seconds DOUBLE PRECISION;
+ALTER TABLE portfolio_run ADD COLUMN IF NOT EXISTS submit_latency DOUBLE PRECISION;
+
+ALTER TABLE portfolio_run RENAME TO portfolio_run_unpartitioned;
+ALTER TABLE portfolio_order RENAME TO portfolio_order_unpartitioned;
+ALTER TABLE portfolio_cash RENAME TO portfolio_cash_unpartitioned;
+ALTER TABLE portfolio_position RENAME TO portfolio_position_unpartitioned;
+
+-- Renaming a table keeps its identity sequence's name, drop the identities to free the names up
+ALTER TABLE portfolio_run_unpartitioned ALTER COLUMN id DROP IDENTITY;
+ALTER TABLE portfolio_order_unpartitioned ALTER COLUMN id DROP IDENTITY;
+ALTER TABLE portfolio_cash_unpartitioned ALTER COLUMN id DROP IDENTITY;
+ALTER TABLE portfolio_position_unpartitioned ALTER COLUMN id DROP IDENTITY;
+
+CREATE SEQUENCE portfolio_run_id_seq AS INT;
+CREATE SEQUENCE portfolio_order_id_seq AS INT;
+CREATE SEQUENCE portfolio_cash_id_seq AS INT;
+CREATE SEQUENCE portfolio_position_id_seq AS INT;
+
+CREATE TABLE portfolio_run (
+    id INT NOT NULL DEFAULT nextval('portfolio_run_id_seq'),
+    portfolio_id INT NOT NULL,
+    status run_status NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    error TEXT,
+    notified BOOLEAN NOT NULL,
+    fingerprint TEXT,
+    cache_hit BOOLEAN NOT NULL DEFAULT FALSE,
+    peak_memory BIGINT, -- bytes
+    cpu_seconds DOUBLE PRECISION,
+    submit_latency DOUBLE PRECISION, -- seconds from the scheduled run time to the order being submitted
+
+    PRIMARY KEY(id, timestamp),
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (timestamp);
+CREATE INDEX ON portfolio_run (portfolio_id, notified);
+
+CREATE TABLE portfolio_order (
+    id INT NOT NULL DEFAULT nextval('portfolio_order_id_seq'),
+    portfolio_id INT NOT NULL,
+    run_id INT NOT NULL,
+    status order_status NOT NULL,
+    ticker TEXT NOT NULL,
+    side order_side NOT NULL,
+    create_timestamp TIMESTAMP WITHOUT TIME ZONE,
+    notional DECIMAL,
+    quantity DECIMAL,
+    fill_timestamp TIMESTAMP WITHOUT TIME ZONE,
+    fill_quantity DECIMAL,
+    fill_price DECIMAL,
+    fill_fee DECIMAL,
+    broker_order_id TEXT,
+    notified BOOLEAN NOT NULL,
+
+    -- No primary key since it would have to include the nullable create_timestamp
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (create_timestamp);
+CREATE INDEX ON portfolio_order (id);
+CREATE INDEX ON portfolio_order (portfolio_id, status);
+
+CREATE TABLE portfolio_cash (
+    id INT NOT NULL DEFAULT nextval('portfolio_cash_id_seq'),
+    portfolio_id INT NOT NULL,
+    event cash_event NOT NULL,
+    event_timestamp TIMESTAMP WITHOUT TIME ZONE,
+    amount DECIMAL NOT NULL,
+    order_id INT,
+
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (event_timestamp);
+CREATE INDEX ON portfolio_cash (id);
+CREATE INDEX ON portfolio_cash (portfolio_id);
+CREATE INDEX ON portfolio_cash (order_id);
+
+CREATE TABLE portfolio_position (
+    id INT NOT NULL DEFAULT nextval('portfolio_position_id_seq'),
+    portfolio_id INT NOT NULL,
+    event position_event NOT NULL,
+    event_timestamp TIMESTAMP WITHOUT TIME ZONE,
+    ticker TEXT NOT NULL,
+    amount DECIMAL NOT NULL,
+    order_id INT,
+
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (event_timestamp);
+CREATE INDEX ON portfolio_position (id);
+CREATE INDEX ON portfolio_position (portfolio_id, ticker);
+CREATE INDEX ON portfolio_position (order_id);
+
+ALTER SEQUENCE portfolio_run_id_seq OWNED BY portfolio_run.id;
+ALTER SEQUENCE portfolio_order_id_seq OWNED BY portfolio_order.id;
+ALTER SEQUENCE portfolio_cash_id_seq OWNED BY portfolio_cash.id;
+ALTER SEQUENCE portfolio_position_id_seq OWNED BY portfolio_position.id;
+
+CREATE TABLE portfolio_run_default PARTITION OF portfolio_run DEFAULT;
+CREATE TABLE portfolio_order_default PARTITION OF portfolio_order DEFAULT;
+CREATE TABLE portfolio_cash_default PARTITION OF portfolio_cash DEFAULT;
+CREATE TABLE portfolio_position_default PARTITION OF portfolio_position DEFAULT;
+
+-- Create every month that has history, plus a few ahead, before copying so nothing lands in the defaults
+SELECT create_monthly_partitions('portfolio_run', COALESCE((SELECT MIN(timestamp) FROM portfolio_run_unpartitioned)::date, CURRENT_DATE), (CURRENT_DATE + interval '3 months')::date);
+SELECT create_monthly_partitions('portfolio_order', COALESCE((SELECT MIN(create_timestamp) FROM portfolio_order_unpartitioned)::date, CURRENT_DATE), (CURRENT_DATE + interval '3 months')::date);
+SELECT create_monthly_partitions('portfolio_cash', COALESCE((SELECT MIN(event_timestamp) FROM portfolio_cash_unpartitioned)::date, CURRENT_DATE), (CURRENT_DATE + interval '3 months')::date);
+SELECT create_monthly_partitions('portfolio_position', COALESCE((SELECT MIN(event_timestamp) FROM portfolio_position_unpartitioned)::date, CURRENT_DATE), (CURRENT_DATE + interval '3 months')::date);
+
+-- The trigger is dropped with the old portfolio_order table, so copying orders doesn't touch cash or positions
+INSERT INTO portfolio_run SELECT id, portfolio_id, status, timestamp, error, notified, fingerprint, cache_hit, peak_memory, cpu_seconds, submit_latency FROM portfolio_run_unpartitioned;
+INSERT INTO portfolio_order SELECT id, portfolio_id, run_id, status, ticker, side, create_timestamp, notional, quantity, fill_timestamp, fill_quantity, fill_price, fill_fee, broker_order_id, notified FROM portfolio_order_unpartitioned;
+INSERT INTO portfolio_cash SELECT id, portfolio_id, event, event_timestamp, amount, order_id FROM portfolio_cash_unpartitioned;
+INSERT INTO portfolio_position SELECT id, portfolio_id, event, event_timestamp, ticker, amount, order_id FROM portfolio_position_unpartitioned;
+
+SELECT setval('portfolio_run_id_seq', COALESCE((SELECT MAX(id) FROM portfolio_run), 0) + 1, false);
+SELECT setval('portfolio_order_id_seq', COALESCE((SELECT MAX(id) FROM portfolio_order), 0) + 1, false);
+SELECT setval('portfolio_cash_id_seq', COALESCE((SELECT MAX(id) FROM portfolio_cash), 0) + 1, false);
+SELECT setval('portfolio_position_id_seq', COALESCE((SELECT MAX(id) FROM portfolio_position), 0) + 1, false);
+
+DROP TABLE portfolio_position_unpartitioned;
+DROP TABLE portfolio_cash_unpartitioned;
+DROP TABLE portfolio_order_unpartitioned;
+DROP TABLE portfolio_run_unpartitioned;
+
+CREATE OR REPLACE FUNCTION update_cash_and_position()
+  RETURNS trigger
+AS
+$$
+  BEGIN
+    IF (NEW.status <> 'filled') THEN
+        RETURN NEW;
+    END IF;
+    IF (TG_OP = 'UPDATE') THEN
+        IF (OLD.status = 'filled'
+            AND (OLD.side, OLD.fill_timestamp, OLD.fill_quantity, OLD.fill_price, OLD.fill_fee)
+                IS NOT DISTINCT FROM (NEW.side, NEW.fill_timestamp, NEW.fill_quantity, NEW.fill_price, NEW.fill_fee)) THEN
+            RETURN NEW;
+        END IF;
+    END IF;
+    DELETE FROM portfolio_position WHERE order_id = NEW.id;
+    DELETE FROM portfolio_cash WHERE order_id = NEW.id;
+    IF (NEW.side = 'buy') THEN
+        INSERT INTO portfolio_position (event, event_timestamp, portfolio_id, ticker, amount, order_id) values ('purchase', NEW.fill_timestamp, NEW.portfolio_id, NEW.ticker, NEW.fill_quantity, NEW.id);
+        INSERT INTO portfolio_cash (event, event_timestamp, portfolio_id, amount, order_id) values ('purchase', NEW.fill_timestamp, NEW.portfolio_id, -(NEW.fill_quantity * NEW.fill_price + NEW.fill_fee), NEW.id);
+    ELSIF (NEW.side = 'sell') THEN
+        INSERT INTO portfolio_position (event, event_timestamp, portfolio_id, ticker, amount, order_id) values ('sale', NEW.fill_timestamp, NEW.portfolio_id, NEW.ticker, -NEW.fill_quantity, NEW.id);
+        INSERT INTO portfolio_cash (event, event_timestamp, portfolio_id, amount, order_id) values ('sale', NEW.fill_timestamp, NEW.portfolio_id, NEW.fill_quantity * NEW.fill_price - NEW.fill_fee, NEW.id);
+    END IF;
+    RETURN NEW;
+  END;
+$$
+LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER cash_and_position_update AFTER INSERT OR UPDATE ON portfolio_order FOR EACH ROW EXECUTE FUNCTION update_cash_and_position();
+
+COMMIT;
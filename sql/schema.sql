@@ -30,23 +30,89 @@ CREATE TABLE portfolio (
 
 CREATE TYPE run_status AS ENUM ('succeeded', 'failed');
 
+-- The history tables below are range partitioned by month on their timestamp, see
+-- create_monthly_partitions and archive.py. Partitioned tables can't be referenced by foreign keys
+-- without their partition key, so runs, orders, cash and positions reference each other by id only.
+CREATE OR REPLACE FUNCTION create_monthly_partitions(parent TEXT, from_month DATE, to_month DATE)
+  RETURNS VOID
+AS
+$$
+  DECLARE
+    month DATE := date_trunc('month', from_month);
+    month_partition TEXT;
+    default_partition TEXT;
+    partition_key TEXT;
+  BEGIN
+    -- Trader nodes and archive.py all create upcoming months
+    PERFORM pg_advisory_xact_lock(hashtext('create_monthly_partitions'), hashtext(parent));
+    SELECT d.relname, a.attname INTO default_partition, partition_key
+    FROM pg_partitioned_table p
+    INNER JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+    LEFT JOIN pg_class d ON d.oid = p.partdefid
+    WHERE p.partrelid = parent::regclass;
+    WHILE month <= to_month LOOP
+        month_partition := parent || '_p' || to_char(month, 'YYYYMM');
+        IF to_regclass(quote_ident(month_partition)) IS NULL THEN
+            -- Rows for a month that had no partition yet sit in the default one, which can't be
+            -- attached next to while it has them. Move them over before attaching the new month.
+            EXECUTE format('CREATE TABLE %I (LIKE %I)', month_partition, parent);
+            IF default_partition IS NOT NULL THEN
+                EXECUTE format('LOCK TABLE %I IN SHARE ROW EXCLUSIVE MODE', default_partition);
+                EXECUTE format(
+                    'WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                    default_partition, partition_key, month, partition_key, month + interval '1 month', month_partition
+                );
+            END IF;
+            EXECUTE format(
+                'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                parent, month_partition, month, month + interval '1 month'
+            );
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+  END;
+$$
+LANGUAGE plpgsql;
+
+CREATE SEQUENCE portfolio_run_id_seq AS INT;
+
 CREATE TABLE portfolio_run (
-    id INT GENERATED ALWAYS AS IDENTITY,
+    id INT NOT NULL DEFAULT nextval('portfolio_run_id_seq'),
     portfolio_id INT NOT NULL,
     status run_status NOT NULL,
     timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
     error TEXT,
     notified BOOLEAN NOT NULL,
+    fingerprint TEXT,
+    cache_hit BOOLEAN NOT NULL DEFAULT FALSE,
+    peak_memory BIGINT, -- bytes
+    cpu_seconds DOUBLE PRECISION,
+    submit_latency DOUBLE PRECISION, -- seconds from the scheduled run time to the order being submitted
 
-    PRIMARY KEY(id),
+    PRIMARY KEY(id, timestamp),
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (timestamp);
+ALTER SEQUENCE portfolio_run_id_seq OWNED BY portfolio_run.id;
+CREATE INDEX ON portfolio_run (portfolio_id, notified);
+
+-- Result (order intents and last prices) of a run, keyed by the fingerprint of its inputs
+CREATE TABLE portfolio_run_memo (
+    portfolio_id INT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    result JSON NOT NULL,
+
+    PRIMARY KEY(portfolio_id, fingerprint),
     CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
 );
 
 CREATE TYPE order_status AS ENUM ('open', 'filled', 'unfilled');
 CREATE TYPE order_side AS ENUM ('buy', 'sell');
 
+CREATE SEQUENCE portfolio_order_id_seq AS INT;
+
 CREATE TABLE portfolio_order (
-    id INT GENERATED ALWAYS AS IDENTITY,
+    id INT NOT NULL DEFAULT nextval('portfolio_order_id_seq'),
     portfolio_id INT NOT NULL,
     run_id INT NOT NULL,
     status order_status NOT NULL,
@@ -62,77 +128,133 @@ CREATE TABLE portfolio_order (
     broker_order_id TEXT,
     notified BOOLEAN NOT NULL,
 
-    PRIMARY KEY(id),
-    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id),
-    CONSTRAINT fk_portfolio_run FOREIGN KEY (run_id) REFERENCES portfolio_run(id)
-);
+    -- No primary key since it would have to include the nullable create_timestamp
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (create_timestamp);
+ALTER SEQUENCE portfolio_order_id_seq OWNED BY portfolio_order.id;
+CREATE INDEX ON portfolio_order (id);
+CREATE INDEX ON portfolio_order (portfolio_id, status);
+
+-- 'balance' rows carry forward the sum of archived partitions, see archive.py
+--                                  +           -            -         +         +        -       +/-
+CREATE TYPE cash_event AS ENUM ('deposit', 'withdrawal', 'purchase', 'sale', 'dividend', 'fee', 'balance');
 
---                                  +           -            -         +         +        -
-CREATE TYPE cash_event AS ENUM ('deposit', 'withdrawal', 'purchase', 'sale', 'dividend', 'fee');
+CREATE SEQUENCE portfolio_cash_id_seq AS INT;
 
 CREATE TABLE portfolio_cash (
-    id INT GENERATED ALWAYS AS IDENTITY,
+    id INT NOT NULL DEFAULT nextval('portfolio_cash_id_seq'),
     portfolio_id INT NOT NULL,
     event cash_event NOT NULL,
     event_timestamp TIMESTAMP WITHOUT TIME ZONE,
     amount DECIMAL NOT NULL,
-    order_id INT UNIQUE,
+    order_id INT,
 
-    PRIMARY KEY(id),
-    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id),
-    CONSTRAINT fk_order FOREIGN KEY (order_id) REFERENCES portfolio_order(id)
-);
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (event_timestamp);
+ALTER SEQUENCE portfolio_cash_id_seq OWNED BY portfolio_cash.id;
+CREATE INDEX ON portfolio_cash (id);
+CREATE INDEX ON portfolio_cash (portfolio_id);
+CREATE INDEX ON portfolio_cash (order_id);
 
---                                      +         -        +        -           +                 -
-CREATE TYPE position_event AS ENUM ('purchase', 'sale', 'borrow', 'loan', 'forward_split', 'reverse_split');
+--                                      +         -        +        -           +                 -               +/-
+CREATE TYPE position_event AS ENUM ('purchase', 'sale', 'borrow', 'loan', 'forward_split', 'reverse_split', 'balance');
+
+CREATE SEQUENCE portfolio_position_id_seq AS INT;
 
 CREATE TABLE portfolio_position (
-    id INT GENERATED ALWAYS AS IDENTITY,
+    id INT NOT NULL DEFAULT nextval('portfolio_position_id_seq'),
     portfolio_id INT NOT NULL,
     event position_event NOT NULL,
     event_timestamp TIMESTAMP WITHOUT TIME ZONE,
     ticker TEXT NOT NULL,
     amount DECIMAL NOT NULL,
-    order_id INT UNIQUE,
+    order_id INT,
+
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+) PARTITION BY RANGE (event_timestamp);
+ALTER SEQUENCE portfolio_position_id_seq OWNED BY portfolio_position.id;
+CREATE INDEX ON portfolio_position (id);
+CREATE INDEX ON portfolio_position (portfolio_id, ticker);
+CREATE INDEX ON portfolio_position (order_id);
+
+-- Nullable timestamps and anything outside the created months land in the default partitions
+CREATE TABLE portfolio_run_default PARTITION OF portfolio_run DEFAULT;
+CREATE TABLE portfolio_order_default PARTITION OF portfolio_order DEFAULT;
+CREATE TABLE portfolio_cash_default PARTITION OF portfolio_cash DEFAULT;
+CREATE TABLE portfolio_position_default PARTITION OF portfolio_position DEFAULT;
+SELECT create_monthly_partitions(parent, CURRENT_DATE, (CURRENT_DATE + interval '3 months')::date)
+FROM unnest(ARRAY['portfolio_run', 'portfolio_order', 'portfolio_cash', 'portfolio_position']) AS parent;
+
+CREATE TABLE portfolio_snapshot (
+    id INT GENERATED ALWAYS AS IDENTITY,
+    portfolio_id INT NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    cash DECIMAL NOT NULL,
+    equity DECIMAL NOT NULL,
+    market_values JSON NOT NULL, -- {ticker: {"amount": ..., "price": ..., "value": ...}}
 
     PRIMARY KEY(id),
-    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id),
-    CONSTRAINT fk_order FOREIGN KEY (order_id) REFERENCES portfolio_order(id)
+    UNIQUE (portfolio_id, timestamp),
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+);
+
+-- Trader processes sharing the load, see trader.claim_portfolios
+CREATE TABLE trader_node (
+    id TEXT NOT NULL,
+    heartbeat_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+
+    PRIMARY KEY(id)
+);
+
+CREATE TABLE portfolio_lease (
+    portfolio_id INT NOT NULL,
+    node_id TEXT NOT NULL,
+    expire_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+
+    PRIMARY KEY(portfolio_id),
+    CONSTRAINT fk_portfolio FOREIGN KEY (portfolio_id) REFERENCES portfolio(id)
+);
+
+-- Token buckets shared by every process calling a broker account, see ratelimit.DbBucket
+CREATE TABLE broker_rate_limit (
+    account TEXT NOT NULL,
+    tokens DOUBLE PRECISION NOT NULL,
+    update_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    blocked_until TIMESTAMP WITHOUT TIME ZONE,
+
+    PRIMARY KEY(account)
 );
 
+-- Orders are partitioned so there's no unique constraint on order_id to upsert against,
+-- replace the order's cash and position rows instead. Only when the order becomes filled or its fill
+-- changes, archive.py may have already folded the rows into balances and dropped them.
 CREATE OR REPLACE FUNCTION update_cash_and_position()
   RETURNS trigger 
 AS
 $$
   BEGIN
-    IF (NEW.status = 'filled') AND (NEW.side = 'buy') THEN
-        INSERT INTO portfolio_position (event, event_timestamp, portfolio_id, ticker, amount, order_id) values ('purchase', NEW.fill_timestamp, NEW.portfolio_id, NEW.ticker, NEW.fill_quantity, NEW.id) ON CONFLICT (order_id) DO UPDATE
-            SET event = EXCLUDED.event,
-                event_timestamp = EXCLUDED.event_timestamp,
-                portfolio_id = EXCLUDED.portfolio_id,
-                ticker = EXCLUDED.ticker,
-                amount = EXCLUDED.amount;
-        INSERT INTO portfolio_cash (event, event_timestamp, portfolio_id, amount, order_id) values ('purchase', NEW.fill_timestamp, NEW.portfolio_id, -(NEW.fill_quantity * NEW.fill_price + NEW.fill_fee), NEW.id) ON CONFLICT (order_id) DO UPDATE
-            SET event = EXCLUDED.event,
-                event_timestamp = EXCLUDED.event_timestamp,
-                portfolio_id = EXCLUDED.portfolio_id,
-                amount = EXCLUDED.amount;
-    ELSIF (NEW.status = 'filled') AND (NEW.side = 'sell') THEN
-        INSERT INTO portfolio_position (event, event_timestamp, portfolio_id, ticker, amount, order_id) values ('sale', NEW.fill_timestamp, NEW.portfolio_id, NEW.ticker, -NEW.fill_quantity, NEW.id) ON CONFLICT (order_id) DO UPDATE
-            SET event = EXCLUDED.event,
-                event_timestamp = EXCLUDED.event_timestamp,
-                portfolio_id = EXCLUDED.portfolio_id,
-                ticker = EXCLUDED.ticker,
-                amount = EXCLUDED.amount;
-        INSERT INTO portfolio_cash (event, event_timestamp, portfolio_id, amount, order_id) values ('sale', NEW.fill_timestamp, NEW.portfolio_id, NEW.fill_quantity * NEW.fill_price - NEW.fill_fee, NEW.id) ON CONFLICT (order_id) DO UPDATE
-            SET event = EXCLUDED.event,
-                event_timestamp = EXCLUDED.event_timestamp,
-                portfolio_id = EXCLUDED.portfolio_id,
-                amount = EXCLUDED.amount;
+    IF (NEW.status <> 'filled') THEN
+        RETURN NEW;
+    END IF;
+    IF (TG_OP = 'UPDATE') THEN
+        IF (OLD.status = 'filled'
+            AND (OLD.side, OLD.fill_timestamp, OLD.fill_quantity, OLD.fill_price, OLD.fill_fee)
+                IS NOT DISTINCT FROM (NEW.side, NEW.fill_timestamp, NEW.fill_quantity, NEW.fill_price, NEW.fill_fee)) THEN
+            RETURN NEW;
+        END IF;
+    END IF;
+    DELETE FROM portfolio_position WHERE order_id = NEW.id;
+    DELETE FROM portfolio_cash WHERE order_id = NEW.id;
+    IF (NEW.side = 'buy') THEN
+        INSERT INTO portfolio_position (event, event_timestamp, portfolio_id, ticker, amount, order_id) values ('purchase', NEW.fill_timestamp, NEW.portfolio_id, NEW.ticker, NEW.fill_quantity, NEW.id);
+        INSERT INTO portfolio_cash (event, event_timestamp, portfolio_id, amount, order_id) values ('purchase', NEW.fill_timestamp, NEW.portfolio_id, -(NEW.fill_quantity * NEW.fill_price + NEW.fill_fee), NEW.id);
+    ELSIF (NEW.side = 'sell') THEN
+        INSERT INTO portfolio_position (event, event_timestamp, portfolio_id, ticker, amount, order_id) values ('sale', NEW.fill_timestamp, NEW.portfolio_id, NEW.ticker, -NEW.fill_quantity, NEW.id);
+        INSERT INTO portfolio_cash (event, event_timestamp, portfolio_id, amount, order_id) values ('sale', NEW.fill_timestamp, NEW.portfolio_id, NEW.fill_quantity * NEW.fill_price - NEW.fill_fee, NEW.id);
     END IF;
     RETURN NEW;
   END;
 $$
 LANGUAGE plpgsql;
 
-CREATE OR REPLACE TRIGGER cash_and_position_update AFTER INSERT OR UPDATE ON portfolio_order FOR EACH ROW EXECUTE FUNCTION update_cash_and_position();
\ No newline at end of file
+CREATE OR REPLACE TRIGGER cash_and_position_update AFTER INSERT OR UPDATE ON portfolio_order FOR EACH ROW EXECUTE FUNCTION update_cash_and_position();
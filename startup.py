@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Logged by the trader at the end of every tick
+TICK_FINISHED = "Finished tick in"
+
+def import_times(module):
+    """
+    Import a module in a fresh interpreter with -X importtime and return its wall time in seconds
+    along with (cumulative us, self us, depth, name) for every module imported
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    wall_time = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((int(cumulative_us), int(self_us), depth, name.strip()))
+    return wall_time, times
+
+def first_tick_time(timeout=300):
+    """
+    Start the trader in a fresh interpreter and return the wall time until it finished its first
+    tick, i.e. imports, connecting, claiming portfolios and running whatever is due. It runs against
+    the database in TRADEBOT_DB_CONN, so point that at a staging database.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "trader.py"], cwd=REPO_DIR, stderr=subprocess.PIPE, text=True)
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    output = []
+    try:
+        for line in process.stderr:
+            if TICK_FINISHED in line:
+                return time.perf_counter() - start
+            output.append(line)
+        raise RuntimeError(f"The trader stopped before finishing a tick (exit code {process.wait()}):\n{''.join(output[-20:])}")
+    finally:
+        timer.cancel()
+        # Shut down like on Ctrl-C so the node gives its leases back
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        process.stderr.close()
+
+def print_breakdown(module, wall_time, times, top=25, max_depth=1):
+    print(f"{module}: {wall_time:.3f}s wall time to import in a fresh interpreter")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    shown = [t for t in times if t[2] <= max_depth]
+    for cumulative_us, self_us, depth, name in sorted(shown, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>10.1f}ms {self_us / 1000:>8.1f}ms  {'  ' * depth}{name}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile how long the entry points take to import")
+    parser.add_argument("modules", nargs="*", default=["trader", "chatter"])
+    parser.add_argument("--top", type=int, default=25, help="number of slowest imports to show")
+    parser.add_argument("--depth", type=int, default=1, help="deepest nesting level of imports to show")
+    parser.add_argument("--budget", type=float, default=None, help="fail if any module takes longer than this many seconds to import, or the trader to finish its first tick with --first-tick")
+    parser.add_argument("--first-tick", action="store_true", help="also time the trader from startup to the end of its first tick, against TRADEBOT_DB_CONN")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the trader's first tick")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        wall_time, times = import_times(module)
+        print_breakdown(module, wall_time, times, args.top, args.depth)
+        print()
+        if args.budget is not None and wall_time > args.budget:
+            over_budget.append(f"{module} took {wall_time:.3f}s to import, over the {args.budget:.3f}s budget")
+
+    if args.first_tick:
+        tick_time = first_tick_time(args.timeout)
+        print(f"trader: {tick_time:.3f}s wall time from startup to the end of its first tick")
+        if args.budget is not None and tick_time > args.budget:
+            over_budget.append(f"trader took {tick_time:.3f}s to finish its first tick, over the {args.budget:.3f}s budget")
+
+    for message in over_budget:
+        print(message)
+    sys.exit(1 if over_budget else 0)
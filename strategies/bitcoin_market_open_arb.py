@@ -1,37 +1,37 @@
 import vectorbtpro as vbt
 import numpy as np
 import pandas as pd
-from util import current_1h_signals
+from util import current_1h_signals, fetch_bars
 
-def create_portfolio(params):
-    live = params.get("live", False)
+# Params that change which bars are fetched, a sweep only needs to reload data when these differ
+DATA_PARAMS = ("start", "end", "btc_ticker", "deriv_ticker")
+# Live signals only change when a new hourly candle starts (see current_1h_signals), and only look at
+# the bars completed by then
+CANDLE_FREQ = "H"
+
+def load_data(params):
     start = params.get("start", "2021-10")
     end = params.get("end", None)
     btc_ticker = params.get("btc_ticker", "BTC/USD")
     deriv_ticker = params.get("deriv_ticker", "BITO")
+
+    btc_close = fetch_bars(btc_ticker, "1 hour", start=start, end=end, adjustment="all", client_type="crypto")["Close"]
+    deriv_close = fetch_bars(deriv_ticker, "1 hour", start=start, end=end, adjustment="all")["Close"]
+    # BTC trades around the clock so its bars normally cover the derivative's. Building the frame on its
+    # index keeps that column a view of the fetched bars instead of concatenating copies of both.
+    if deriv_close.index.isin(btc_close.index).all():
+        index = btc_close.index
+    else:
+        index = btc_close.index.union(deriv_close.index)
+        btc_close = btc_close.reindex(index)
+    return pd.DataFrame({btc_ticker: btc_close, deriv_ticker: deriv_close.reindex(index)}, copy=False)
+
+def signals(close, params):
+    btc_ticker = params.get("btc_ticker", "BTC/USD")
+    deriv_ticker = params.get("deriv_ticker", "BITO")
     mean_window = params.get("mean_window", 5)
     trade_duration = params.get("trade_duration", 1) # the arb seems to last for only an hour
-    
-    data = [
-        vbt.AlpacaData.fetch(
-            btc_ticker,
-            timeframe="1 hour",
-            adjustment="all",
-            start=start,
-            end=end,
-            client_type="crypto",
-        ),
-        vbt.AlpacaData.fetch(
-            deriv_ticker,
-            timeframe="1 hour",
-            adjustment="all",
-            start=start,
-            end=end,
-        )
-    ]
-
-    close = vbt.AlpacaData.merge(*data).get("Close")
-    
+
     basis = close[btc_ticker] / close[deriv_ticker].ffill() # forward fill close price at end of trading day up til next trading open
 
     business_days = pd.date_range(start=close.index.min(), end=close.index.max(), freq="B")
@@ -43,6 +43,20 @@ def create_portfolio(params):
     exits = entries.vbt.signals.fshift(trade_duration)
     short_entries = (market_open_basis.vbt < basis.vbt.rolling_mean(mean_window)).vbt.signals.fshift()
     short_exits = short_entries.vbt.signals.fshift(trade_duration)
+    return entries, exits, short_entries, short_exits
+
+def create_portfolio(params, close=None):
+    if close is None:
+        close = load_data(params)
+    return create_portfolio_from_signals(params, close, signals(close, params))
+
+def create_portfolio_from_signals(params, close, signals):
+    """
+    Simulates signals already computed with signals(close, params)
+    """
+    live = params.get("live", False)
+    deriv_ticker = params.get("deriv_ticker", "BITO")
+    entries, exits, short_entries, short_exits = signals
 
     pf = vbt.Portfolio.from_signals(
         close[deriv_ticker],
@@ -60,3 +74,38 @@ def create_portfolio(params):
         **params.get("pf_kwargs", {})
     )
     return pf
+
+def create_portfolios(params, combinations, close=None):
+    """
+    Simulate every parameter combination as one column of a single portfolio.
+    Combinations must share the same DATA_PARAMS. Columns are keyed by the swept params,
+    and each column is its own cash sharing group.
+    """
+    deriv_ticker = params.get("deriv_ticker", "BITO")
+    if close is None:
+        close = load_data(params)
+
+    keys = sorted(combinations[0].keys())
+    columns = pd.MultiIndex.from_tuples([tuple(combination[key] for key in keys) for combination in combinations], names=keys)
+    all_signals = [signals(close, {**params, **combination}) for combination in combinations]
+
+    def stack(i):
+        return pd.concat([s[i].reindex(close.index, fill_value=False) for s in all_signals], axis=1, keys=columns)
+
+    pf = vbt.Portfolio.from_signals(
+        close[deriv_ticker],
+        entries=stack(0),
+        exits=stack(1),
+        short_entries=stack(2),
+        short_exits=stack(3),
+        freq="1h",
+        size_type="valuepercent",
+        size=1,
+        min_size=0.01,
+        cash_sharing=True,
+        group_by=keys,
+        call_seq="auto",
+        attach_call_seq=True,
+        **params.get("pf_kwargs", {})
+    )
+    return pf
@@ -1,4 +1,19 @@
-import pandas as pd
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# Replaced with a simulated clock when replaying the trader against historical bars
+clock = None
+
+def set_clock(fn):
+    global clock
+    clock = fn
+
+def utcnow():
+    return pd.Timestamp.utcnow() if clock is None else pd.Timestamp(clock())
 
 def current_1w_signals(signals):
     return current_candle_signals(signals, "W")
@@ -30,7 +45,123 @@ def current_1m_signals(signals):
 def current_candle_signals(signals, timeframe):
     if signals is None:
         return None
-    current_candle = pd.Timestamp.utcnow().floor(freq=timeframe)
+    current_candle = utcnow().floor(freq=timeframe)
     if current_candle not in signals.index:
         return (signals & False)
-    return (signals & False) | signals.loc[[current_candle]]
\ No newline at end of file
+    return (signals & False) | signals.loc[[current_candle]]
+
+# Market data access shared by every portfolio run in the process. Identical requests are coalesced
+# into a single broker call (single-flight), overlapping ranges are widened into one call and sliced
+# per caller. Each trader tick starts a new generation: bars cached in an earlier generation are
+# refreshed by fetching only from their last (possibly still forming) bar onwards.
+BarRequest = namedtuple("BarRequest", ["start", "end", "future", "generation"])
+bar_cache = {}
+bar_cache_lock = threading.Lock()
+bar_generation = 0
+bar_stats = {"hits": 0, "misses": 0, "coalesced": 0, "incremental": 0, "shared": 0}
+
+# Set in strategy workers, keeps the bars of open-ended requests in shared memory so a recycled worker
+# only has to fetch the newest ones (see marketdata.SharedBarStore)
+bar_store = None
+
+def set_bar_store(store):
+    global bar_store
+    bar_store = store
+
+def clear_bar_cache():
+    with bar_cache_lock:
+        bar_cache.clear()
+
+def new_bar_generation():
+    global bar_generation
+    with bar_cache_lock:
+        bar_generation += 1
+
+def to_utc(timestamp):
+    if timestamp is None:
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize("UTC") if timestamp.tz is None else timestamp.tz_convert("UTC")
+
+def covers(request, start, end):
+    starts_before = request.start is None or (start is not None and request.start <= start)
+    ends_after = request.end is None or (end is not None and request.end >= end)
+    return starts_before and ends_after
+
+def widen(request, start, end):
+    start = None if request.start is None or start is None else min(request.start, start)
+    end = None if request.end is None or end is None else max(request.end, end)
+    return start, end
+
+def slice_bars(bars, start, end):
+    if start is None and end is None:
+        return bars
+    return bars.loc[start:end]
+
+def alpaca_fetcher(ticker, timeframe, start, end, **kwargs):
+    import vectorbtpro as vbt
+    return vbt.AlpacaData.fetch(ticker, timeframe=timeframe, start=start, end=end, **kwargs).get()
+
+# Replaced with a stub serving synthetic bars when benchmarking strategies
+default_fetcher = alpaca_fetcher
+
+def set_fetcher(fn):
+    global default_fetcher
+    default_fetcher = fn if fn is not None else alpaca_fetcher
+
+def fetch_bars(ticker, timeframe, start=None, end=None, fetcher=None, **kwargs):
+    """
+    Fetch OHLCV bars for a ticker, sharing the result with every other caller in this tick
+    """
+    fetcher = fetcher if fetcher is not None else default_fetcher
+    start = to_utc(start)
+    end = to_utc(end)
+
+    key = (ticker, timeframe, tuple(sorted(kwargs.items())))
+    previous = None
+    with bar_cache_lock:
+        request = bar_cache.get(key)
+        if request is None and bar_store is not None:
+            # Fetched by an earlier worker, refreshed below like bars cached in an earlier generation
+            stored = bar_store.get(key)
+            if stored is not None:
+                bar_stats["shared"] += 1
+                request = BarRequest(stored[0], None, Future(), None)
+                request.future.set_result(stored[1])
+        if request is not None and request.generation == bar_generation and covers(request, start, end):
+            owner = False
+            bar_stats["hits" if request.future.done() else "coalesced"] += 1
+        else:
+            owner = True
+            if request is not None and request.end is None and end is None and covers(request, start, end) \
+                    and request.future.done() and request.future.exception() is None:
+                # Only the bars since the last cached one are new
+                bar_stats["incremental"] += 1
+                previous = request.future.result()
+                fetch_start, fetch_end = request.start, None
+            else:
+                bar_stats["misses"] += 1
+                fetch_start, fetch_end = (start, end) if request is None else widen(request, start, end)
+            request = BarRequest(fetch_start, fetch_end, Future(), bar_generation)
+            bar_cache[key] = request
+
+    if owner:
+        try:
+            if previous is not None and not previous.empty:
+                last_bar = previous.index[-1]
+                bars = fetcher(ticker, timeframe, last_bar, None, **kwargs)
+                if bar_store is not None:
+                    bars = bar_store.append(key, previous, bars, request.start)
+                else:
+                    bars = pd.concat([previous[previous.index < last_bar], bars])
+            else:
+                bars = fetcher(ticker, timeframe, request.start, request.end, **kwargs)
+                if bar_store is not None and request.end is None:
+                    bars = bar_store.put(key, bars, request.start)
+            request.future.set_result(bars)
+        except BaseException as e:
+            request.future.set_exception(e)
+            with bar_cache_lock:
+                if bar_cache.get(key) is request:
+                    del bar_cache[key]
+    return slice_bars(request.future.result(), start, end)
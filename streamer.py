@@ -0,0 +1,131 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+import aiohttp
+import psycopg
+import model
+import ratelimit
+import trader
+from brokers import (
+    AsyncAlpacaBroker,
+    alpaca_stream_url,
+    parse_client_order_id,
+    from_order_json,
+    resolve_order
+)
+from model import fetch_brokers_by_type
+
+# Logging is set up by trader, which is imported for its fill handling
+log = logging.getLogger()
+
+DB_CONN_STRING = os.environ.get("TRADEBOT_DB_CONN")
+RECONNECT_MIN_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+HEARTBEAT_SECONDS = 30
+
+# Trade update events after which the order won't change anymore
+TERMINAL_EVENTS = ("fill", "canceled", "expired", "rejected")
+
+def connect_db():
+    return psycopg.connect(DB_CONN_STRING, autocommit=True)
+
+def apply_order_update(conn, order_json, ledger=model):
+    """
+    Writes a terminal broker order update through to the matching open portfolio order.
+    Returns the updated order, or None if the update isn't for one of our open orders.
+    """
+    parsed = parse_client_order_id(order_json["client_order_id"])
+    if parsed is None:
+        return None
+    shortname, pf_id, order_id = parsed
+    with conn.cursor() as cursor:
+        open_order = ledger.fetch_order(cursor, order_id)
+        if open_order is None or open_order.portfolio_id != pf_id or open_order.status != "open":
+            return None
+        portfolio = ledger.fetch_portfolio_by_id(cursor, pf_id)
+    order = resolve_order(open_order, from_order_json(order_json))
+    if order is not None:
+        log.info(f"Order {order_json['client_order_id']} is now {order.status}")
+        # Same as the trader's polling, so a snapshot is still taken after each fill
+        trader.apply_resolved_orders(conn, portfolio, [order], datetime.now(timezone.utc), ledger)
+    return order
+
+def fetch_open_orders(broker_record, connect=connect_db, ledger=model):
+    with connect() as conn:
+        with conn.cursor() as cursor:
+            portfolios = [p for p in ledger.fetch_enabled_portfolios(cursor) if p.broker_id == broker_record.id]
+            return [(p, ledger.fetch_orders_by_status(cursor, p.id, "open")) for p in portfolios]
+
+def apply_resolved_orders(portfolio, orders, connect=connect_db, ledger=model):
+    with connect() as conn:
+        trader.apply_resolved_orders(conn, portfolio, orders, datetime.now(timezone.utc), ledger)
+
+def apply_stream_update(order_json, connect=connect_db, ledger=model):
+    with connect() as conn:
+        return apply_order_update(conn, order_json, ledger)
+
+# The DB calls are synchronous, they run in threads so they don't hold up the other accounts' streams
+async def catch_up(broker, broker_record, connect=connect_db, ledger=model):
+    """
+    Resolve open orders over REST, covering any updates missed while disconnected
+    """
+    for portfolio, open_orders in await asyncio.to_thread(fetch_open_orders, broker_record, connect, ledger):
+        if not open_orders:
+            continue
+        log.info(f"Catching up on {len(open_orders)} open orders for portfolio '{portfolio.name}'...")
+        resolved_orders = await broker.resolve_orders(portfolio, open_orders)
+        await asyncio.to_thread(apply_resolved_orders, portfolio, resolved_orders, connect, ledger)
+
+async def consume(broker_record, url=None, rest_url=None, connect=connect_db, ledger=model):
+    """
+    Consume the trade updates stream of one Alpaca account forever, reconnecting with backoff.
+    The trader's polling of open orders stays in place as the fallback.
+    """
+    credentials = broker_record.credentials if broker_record.credentials else {}
+    url = url if url else alpaca_stream_url(credentials)
+    broker = AsyncAlpacaBroker(log, credentials, base_url=rest_url)
+    delay = RECONNECT_MIN_SECONDS
+    try:
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(url, heartbeat=HEARTBEAT_SECONDS) as ws:
+                        await ws.send_json({"action": "auth", "key": credentials["api_key"], "secret": credentials["secret_key"]})
+                        await ws.send_json({"action": "listen", "data": {"streams": ["trade_updates"]}})
+                        log.info(f"Listening for trade updates on broker '{broker_record.name}'...")
+                        # Subscribe before catching up so nothing falls between the two
+                        await catch_up(broker, broker_record, connect, ledger)
+                        delay = RECONNECT_MIN_SECONDS
+                        async for message in ws:
+                            if message.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                                break
+                            update = json.loads(message.data)
+                            if update.get("stream") == "authorization" and update["data"].get("status") != "authorized":
+                                raise PermissionError(f"Trade updates stream authorization failed for broker '{broker_record.name}'")
+                            if update.get("stream") != "trade_updates" or update["data"].get("event") not in TERMINAL_EVENTS:
+                                continue
+                            await asyncio.to_thread(apply_stream_update, update["data"]["order"], connect, ledger)
+            except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+                raise
+            except:
+                log.exception(f"Trade updates stream failed for broker '{broker_record.name}'")
+            log.info(f"Reconnecting to broker '{broker_record.name}' in {delay}s...")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+    finally:
+        await broker.close()
+
+async def main():
+    ratelimit.share_via_db(DB_CONN_STRING)
+    with psycopg.connect(DB_CONN_STRING) as conn:
+        with conn.cursor() as cursor:
+            broker_records = fetch_brokers_by_type(cursor, "alpaca")
+    await asyncio.gather(*[consume(broker_record) for broker_record in broker_records])
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        log.info("Shutting down...")
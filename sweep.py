@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import importlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "strategies"))
+
+log = logging.getLogger()
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s:%(levelname)s %(message)s')
+handler.setFormatter(formatter)
+log.addHandler(handler)
+log.setLevel(logging.INFO)
+
+DEFAULT_METRICS = ["total_return", "sharpe_ratio", "max_drawdown"]
+
+def param_combinations(grid):
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+def data_key(pf_module, combination):
+    data_params = getattr(pf_module, "DATA_PARAMS", ())
+    return tuple((key, combination[key]) for key in data_params if key in combination)
+
+def pf_metrics(pf, metrics):
+    return {metric: getattr(pf, metric) for metric in metrics}
+
+def run_combination(module, params, combination, data, metrics):
+    pf_module = importlib.import_module(module)
+    pf_params = {**params, **combination}
+    if data is None:
+        pf = pf_module.create_portfolio(pf_params)
+    else:
+        pf = pf_module.create_portfolio(pf_params, data)
+    return {**combination, **pf_metrics(pf, metrics)}
+
+def run_vectorized(pf_module, params, combinations, data, metrics):
+    pf = pf_module.create_portfolios(params, combinations, data)
+    results = pd.DataFrame({metric: getattr(pf, metric) for metric in metrics})
+    return results.reset_index().to_dict("records")
+
+def run_sweep(module, grid, params=None, metrics=None, rank_by=None, ascending=False, processes=None):
+    """
+    Evaluate every combination of the parameter grid against a strategy module and rank them.
+
+    Data is loaded once per distinct set of the module's DATA_PARAMS if the module exposes
+    `load_data`. Combinations sharing data are simulated in one multi-column portfolio if the
+    module exposes `create_portfolios`, otherwise they're spread over a process pool.
+    """
+    params = dict(params) if params else {}
+    metrics = list(metrics) if metrics else DEFAULT_METRICS
+    rank_by = list(rank_by) if rank_by else metrics[:1]
+    pf_module = importlib.import_module(module)
+
+    groups = {}
+    for combination in param_combinations(grid):
+        groups.setdefault(data_key(pf_module, combination), []).append(combination)
+
+    results = []
+    for key, combinations in groups.items():
+        group_params = {**params, **dict(key)}
+        combinations = [{k: v for k, v in combination.items() if (k, v) not in key} for combination in combinations]
+        data = None
+        if hasattr(pf_module, "load_data"):
+            log.info(f"Loading data for {dict(key) if key else module}...")
+            data = pf_module.load_data(group_params)
+
+        if hasattr(pf_module, "create_portfolios") and all(combinations):
+            log.info(f"Simulating {len(combinations)} combinations in one portfolio...")
+            group_results = run_vectorized(pf_module, group_params, combinations, data, metrics)
+        else:
+            log.info(f"Simulating {len(combinations)} combinations in a process pool...")
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [
+                    executor.submit(run_combination, module, group_params, combination, data, metrics)
+                    for combination in combinations
+                ]
+                group_results = [future.result() for future in futures]
+
+        for result in group_results:
+            results.append({**dict(key), **result})
+
+    results = pd.DataFrame(results)
+    return results.sort_values(by=rank_by, ascending=ascending).reset_index(drop=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep a strategy module over a parameter grid")
+    parser.add_argument("module", help="strategy module name, e.g. bitcoin_market_open_arb")
+    parser.add_argument("grid", help='JSON object of param name to list of values, e.g. \'{"mean_window": [3, 5, 10]}\'')
+    parser.add_argument("output", help="path of the Parquet file to write results to")
+    parser.add_argument("--params", default="{}", help="JSON object of fixed params passed to every combination")
+    parser.add_argument("--metric", action="append", dest="metrics", help="Portfolio metric to record, can be repeated")
+    parser.add_argument("--rank-by", action="append", help="metric to rank by, can be repeated (defaults to the first metric)")
+    parser.add_argument("--ascending", action="store_true")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    results = run_sweep(
+        args.module,
+        json.loads(args.grid),
+        params=json.loads(args.params),
+        metrics=args.metrics,
+        rank_by=args.rank_by,
+        ascending=args.ascending,
+        processes=args.processes,
+    )
+    results.to_parquet(args.output)
+    log.info(f"Wrote {len(results)} results to {args.output}")
+    print(results.head(20).to_string())
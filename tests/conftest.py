@@ -0,0 +1,123 @@
+import os
+import sys
+import uuid
+import asyncio
+from decimal import Decimal
+from datetime import datetime
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "strategies"))
+
+from model import Portfolio, PortfolioOrder
+
+try:
+    from aiohttp import web
+except ImportError:
+    # Tests using the stand-in importorskip aiohttp themselves
+    web = None
+
+# A throwaway Postgres database for the tests that need one, each test gets its own schema in it
+TEST_DB_CONN_STRING = os.environ.get("TRADEBOT_TEST_DB_CONN")
+SCHEMA_PATH = os.path.join(REPO_DIR, "sql", "schema.sql")
+
+def connect_schema(schema):
+    import psycopg
+    return psycopg.connect(TEST_DB_CONN_STRING, autocommit=True, options=f"-c search_path={schema}")
+
+@pytest.fixture
+def db_schema():
+    if not TEST_DB_CONN_STRING:
+        pytest.skip("set TRADEBOT_TEST_DB_CONN to a throwaway Postgres database")
+    psycopg = pytest.importorskip("psycopg")
+    name = f"tradebot_test_{uuid.uuid4().hex[:12]}"
+    with psycopg.connect(TEST_DB_CONN_STRING, autocommit=True) as conn:
+        conn.execute(f"CREATE SCHEMA {name}")
+    try:
+        with connect_schema(name) as conn:
+            with open(SCHEMA_PATH) as f:
+                conn.execute(f.read())
+        yield name
+    finally:
+        with psycopg.connect(TEST_DB_CONN_STRING, autocommit=True) as conn:
+            conn.execute(f"DROP SCHEMA {name} CASCADE")
+
+# Shared by the broker and streamer tests
+CREDENTIALS = {"api_key": "key", "secret_key": "secret", "paper": True}
+
+def portfolio(id):
+    return Portfolio(id, "me", True, 1, f"Portfolio {id}", f"pf{id}", "bitcoin_market_open_arb", "0 * * * *", datetime(2022, 1, 1), None)
+
+def open_order(pf, id, side="buy"):
+    return PortfolioOrder(id, pf.id, 1, "open", "BITO", side, datetime(2022, 1, 1), Decimal("100"), Decimal("1"), None, None, None, None, None, False)
+
+def order_json(client_order_id, status="filled", side="buy", filled_qty="2", submitted_at="2022-01-01T00:00:00Z"):
+    return {
+        "id": f"alpaca-{client_order_id}",
+        "symbol": "BITO",
+        "client_order_id": client_order_id,
+        "side": side,
+        "status": status,
+        "filled_at": "2022-01-01T00:00:01Z" if status == "filled" else None,
+        "filled_qty": filled_qty,
+        "filled_avg_price": "50",
+        "submitted_at": submitted_at,
+    }
+
+class StandIn:
+    """
+    Local aiohttp server answering the Alpaca order endpoints the async broker uses
+    """
+    def __init__(self, orders=(), failures=None, delay=0):
+        self.orders = {order["client_order_id"]: order for order in orders}
+        # client_order_id -> list of statuses to answer with before the real response
+        self.failures = failures if failures else {}
+        self.delay = delay
+        self.requests = []
+        self.submitted = []
+
+    async def lookup(self, request):
+        client_order_id = request.query["client_order_id"]
+        self.requests.append(client_order_id)
+        await asyncio.sleep(self.delay)
+        failures = self.failures.get(client_order_id)
+        if failures:
+            status = failures.pop(0)
+            return web.json_response({"message": "nope"}, status=status, headers={"Retry-After": "0"})
+        if client_order_id not in self.orders:
+            return web.json_response({"message": "order not found"}, status=404)
+        return web.json_response(self.orders[client_order_id])
+
+    async def list_orders(self, request):
+        orders = sorted(self.orders.values(), key=lambda order: order["submitted_at"], reverse=True)
+        until = request.query["until"]
+        orders = [order for order in orders if order["submitted_at"] <= until.replace("+00:00", "Z")]
+        return web.json_response(orders[:int(request.query["limit"])])
+
+    async def submit(self, request):
+        body = await request.json()
+        self.submitted.append(body)
+        failures = self.failures.get(body["client_order_id"])
+        if failures:
+            return web.json_response({"message": "nope"}, status=failures.pop(0))
+        return web.json_response(order_json(body["client_order_id"], status="new", filled_qty="0"))
+
+    def add_routes(self, app):
+        app.router.add_get("/v2/orders:by_client_order_id", self.lookup)
+        app.router.add_get("/v2/orders", self.list_orders)
+        app.router.add_post("/v2/orders", self.submit)
+
+    async def __aenter__(self):
+        app = web.Application()
+        self.add_routes(app)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *args):
+        await self.runner.cleanup()
@@ -0,0 +1,194 @@
+import time
+import asyncio
+import logging
+import threading
+from decimal import Decimal
+import pytest
+
+pytest.importorskip("aiohttp.web")
+pytest.importorskip("pandas")
+pytest.importorskip("alpaca_trade_api")
+
+import brokers
+import ratelimit
+from model import Broker
+from conftest import CREDENTIALS, StandIn, portfolio, open_order, order_json
+
+log = logging.getLogger()
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(ratelimit, "RETRY_BASE_SECONDS", 0.01)
+
+def broker_for(stand_in, rate=1000):
+    limiter = ratelimit.RateLimiter(ratelimit.LocalBucket(rate, rate))
+    return brokers.AsyncAlpacaBroker(log, CREDENTIALS, base_url=stand_in.url, limiter=limiter)
+
+def test_resolve_orders():
+    pf = portfolio(1)
+    orders = [open_order(pf, 1), open_order(pf, 2), open_order(pf, 3), open_order(pf, 4)]
+
+    async def run():
+        async with StandIn([
+            order_json("pf1_1_1"),
+            order_json("pf1_1_2", status="new", filled_qty="0"),
+            order_json("pf1_1_4"),
+        ], failures={"pf1_1_4": [500] * ratelimit.RETRY_ATTEMPTS}) as stand_in:
+            broker = broker_for(stand_in)
+            try:
+                return await broker.resolve_orders(pf, orders)
+            finally:
+                await broker.close()
+
+    resolved = {order.id: order for order in asyncio.run(run())}
+    assert resolved[1].status == "filled"
+    assert resolved[1].fill_quantity == "2"
+    # Still open at Alpaca
+    assert 2 not in resolved
+    # Alpaca never heard of it
+    assert resolved[3].status == "unfilled"
+    # Failing lookups leave the order open instead of calling it unfilled
+    assert 4 not in resolved
+
+def test_rate_limited_lookup_is_retried():
+    pf = portfolio(1)
+
+    async def run():
+        async with StandIn([order_json("pf1_1_1")], failures={"pf1_1_1": [429, 429]}) as stand_in:
+            broker = broker_for(stand_in)
+            try:
+                return await broker.resolve_orders(pf, [open_order(pf, 1)]), stand_in.requests
+            finally:
+                await broker.close()
+
+    resolved, requests = asyncio.run(run())
+    assert [order.status for order in resolved] == ["filled"]
+    assert requests == ["pf1_1_1"] * 3
+
+def test_lookups_overlap():
+    pf = portfolio(1)
+    orders = [open_order(pf, i) for i in range(1, 11)]
+
+    async def run():
+        async with StandIn([order_json(f"pf1_1_{i}") for i in range(1, 11)], delay=0.2) as stand_in:
+            broker = broker_for(stand_in)
+            try:
+                start = time.monotonic()
+                resolved = await broker.resolve_orders(pf, orders)
+                return resolved, time.monotonic() - start
+            finally:
+                await broker.close()
+
+    resolved, elapsed = asyncio.run(run())
+    assert len(resolved) == 10
+    assert elapsed < 1
+
+def test_positions_pages_through_orders():
+    pf = portfolio(1)
+    orders = [order_json(f"pf1_1_{i}", submitted_at=f"2022-01-01T{i // 3600:02d}:{i // 60 % 60:02d}:{i % 60:02d}Z") for i in range(600)]
+    orders.append(order_json("other_2_1", submitted_at="2022-01-01T00:00:00Z"))
+    orders.append(order_json("pf1_1_600", side="sell", filled_qty="3", submitted_at="2022-01-01T01:00:00Z"))
+
+    async def run():
+        async with StandIn(orders) as stand_in:
+            broker = broker_for(stand_in)
+            try:
+                return await broker.positions(pf)
+            finally:
+                await broker.close()
+
+    assert asyncio.run(run()) == {"BITO": Decimal(600 * 2 - 3)}
+
+def test_missing_order_list_raises_not_found():
+    async def run():
+        async with StandIn() as stand_in:
+            # Every path under here is a 404
+            stand_in.url += "/missing"
+            broker = broker_for(stand_in)
+            try:
+                with pytest.raises(brokers.NotFoundError):
+                    await broker.positions(portfolio(1))
+            finally:
+                await broker.close()
+
+    asyncio.run(run())
+
+def test_submit_orders():
+    pf = portfolio(1)
+    orders = [open_order(pf, 1, "buy"), open_order(pf, 2, "sell")]
+
+    async def run():
+        async with StandIn() as stand_in:
+            broker = broker_for(stand_in)
+            try:
+                await broker.submit_orders(pf, orders)
+                return stand_in.submitted
+            finally:
+                await broker.close()
+
+    buy, sell = asyncio.run(run())
+    assert buy["client_order_id"] == "pf1_1_1" and buy["notional"] == "100" and "qty" not in buy
+    assert sell["client_order_id"] == "pf1_1_2" and sell["qty"] == "1" and "notional" not in sell
+
+def test_failed_submission_is_not_retried():
+    pf = portfolio(1)
+
+    async def run():
+        async with StandIn(failures={"pf1_1_1": [500, 500]}) as stand_in:
+            broker = broker_for(stand_in)
+            try:
+                with pytest.raises(ratelimit.RetryableError):
+                    await broker.submit_orders(pf, [open_order(pf, 1)])
+                return stand_in.submitted
+            finally:
+                await broker.close()
+
+    # It may have gone through, so submitting again could double the order
+    assert len(asyncio.run(run())) == 1
+
+def test_sync_broker_adapter():
+    class SlowBroker(brokers.Broker):
+        def __init__(self):
+            super().__init__(log, {})
+            self.threads = set()
+
+        def positions(self, portfolio):
+            self.threads.add(threading.get_ident())
+            time.sleep(0.2)
+            return {"BITO": Decimal(portfolio.id)}
+
+    broker = SlowBroker()
+    adapter = brokers.SyncBrokerAdapter(broker)
+
+    async def run():
+        start = time.monotonic()
+        positions = await asyncio.gather(*[adapter.positions(portfolio(i)) for i in range(5)])
+        return positions, time.monotonic() - start
+
+    positions, elapsed = asyncio.run(run())
+    assert positions == [{"BITO": Decimal(i)} for i in range(5)]
+    assert threading.get_ident() not in broker.threads
+    assert elapsed < 1
+
+def test_trader_resolves_portfolios_concurrently():
+    trader = pytest.importorskip("trader")
+    replay = pytest.importorskip("replay")
+    pfs = [portfolio(1), portfolio(2)]
+    broker_record = Broker(1, "me", "Alpaca", "alpaca", CREDENTIALS)
+
+    class Ledger(replay.MemoryLedger):
+        def fetch_orders_by_status(self, cursor, pf_id, status):
+            return [order for order in self.orders if order.status == status and order.portfolio_id == pf_id]
+
+    ledger = Ledger(broker_record, pfs[0])
+    ledger.orders = [open_order(pfs[0], 1), open_order(pfs[1], 2), open_order(pfs[1], 3)]
+
+    async def run():
+        async with StandIn([order_json("pf1_1_1"), order_json("pf2_2_2"), order_json("pf2_2_3", status="new", filled_qty="0")], delay=0.3) as stand_in:
+            start = time.monotonic()
+            await trader.resolve_open_orders(replay.MemoryConnection(), pfs, ledger=ledger, broker_factory=lambda record: broker_for(stand_in))
+            return time.monotonic() - start
+
+    elapsed = asyncio.run(run())
+    assert {order.id: order.status for order in ledger.orders} == {1: "filled", 2: "filled", 3: "open"}
+    assert elapsed < 0.6
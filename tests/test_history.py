@@ -0,0 +1,73 @@
+from datetime import datetime
+from decimal import Decimal
+import pytest
+
+psycopg = pytest.importorskip("psycopg")
+
+import model
+from conftest import connect_schema as connect
+
+@pytest.fixture
+def conn(db_schema):
+    with connect(db_schema) as conn:
+        broker_id = conn.execute("""
+            INSERT INTO broker (author, name, type) VALUES ('test', 'test', 'manual') RETURNING id
+        """).fetchone()[0]
+        conn.execute("""
+            INSERT INTO portfolio (author, enabled, broker_id, name, shortname, module, schedule)
+            VALUES ('test', TRUE, %s, 'Portfolio', 'pf', 'test', '* * * * *')
+        """, (broker_id,))
+        yield conn
+
+def filled_order(conn, **fill):
+    now = datetime.utcnow()
+    order_id = conn.execute("""
+        INSERT INTO portfolio_order (portfolio_id, run_id, status, ticker, side, create_timestamp, notional, notified)
+        VALUES (1, 1, 'open', 'BTC/USD', 'buy', %s, 100, FALSE)
+        RETURNING id
+    """, (now,)).fetchone()[0]
+    fill = {"fill_timestamp": now, "fill_quantity": Decimal(2), "fill_price": Decimal(50), "fill_fee": Decimal(1), **fill}
+    conn.execute("""
+        UPDATE portfolio_order
+        SET status = 'filled', fill_timestamp = %s, fill_quantity = %s, fill_price = %s, fill_fee = %s
+        WHERE id = %s
+    """, (fill["fill_timestamp"], fill["fill_quantity"], fill["fill_price"], fill["fill_fee"], order_id))
+    return order_id
+
+def balances(conn):
+    cash = conn.execute("SELECT COALESCE(SUM(amount), 0) FROM portfolio_cash").fetchone()[0]
+    position = conn.execute("SELECT COALESCE(SUM(amount), 0) FROM portfolio_position").fetchone()[0]
+    return cash, position
+
+def test_fill_is_booked_once(conn):
+    order_id = filled_order(conn)
+    assert balances(conn) == (Decimal(-101), Decimal(2))
+
+    # What archive.py leaves behind once the fill's month is folded into balances and dropped
+    for table in ("portfolio_cash", "portfolio_position"):
+        conn.execute(f"UPDATE {table} SET event = 'balance', order_id = NULL WHERE order_id = %s", (order_id,))
+    conn.execute("UPDATE portfolio_order SET notified = TRUE WHERE id = %s", (order_id,))
+    assert balances(conn) == (Decimal(-101), Decimal(2))
+
+def test_corrected_fill_replaces_the_booking(conn):
+    order_id = filled_order(conn)
+    conn.execute("UPDATE portfolio_order SET fill_price = 60 WHERE id = %s", (order_id,))
+    assert balances(conn) == (Decimal(-121), Decimal(2))
+
+def test_new_partitions_take_over_default_rows(conn):
+    # Past the months schema.sql creates, so the row lands in the default partition
+    month = datetime(datetime.utcnow().year + 2, 1, 1)
+    conn.execute("""
+        INSERT INTO portfolio_cash (portfolio_id, event, event_timestamp, amount) VALUES (1, 'deposit', %s, 100)
+    """, (month,))
+    assert conn.execute("SELECT COUNT(*) FROM portfolio_cash_default").fetchone()[0] == 1
+
+    with conn.cursor() as cursor:
+        model.create_history_partitions(cursor, 36)
+    assert conn.execute("SELECT COUNT(*) FROM portfolio_cash_default").fetchone()[0] == 0
+    partition = f"portfolio_cash_p{month:%Y%m}"
+    assert conn.execute(f"SELECT COUNT(*) FROM {partition}").fetchone()[0] == 1
+    assert balances(conn) == (Decimal(100), Decimal(0))
+    # Already there, so nothing to do the second time
+    with conn.cursor() as cursor:
+        model.create_history_partitions(cursor, 36)
@@ -0,0 +1,33 @@
+import sys
+import threading
+import pytest
+
+from lazy import lazy_import
+
+@pytest.fixture
+def slow_module(tmp_path, monkeypatch):
+    # Takes a while to execute and only defines its attribute at the end, like a heavy package
+    (tmp_path / "tradebot_slow_module.py").write_text("import time\ntime.sleep(0.2)\nVALUE = 42\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield "tradebot_slow_module"
+    sys.modules.pop("tradebot_slow_module", None)
+
+def test_module_loads_on_first_access(slow_module):
+    module = lazy_import(slow_module)
+    assert "VALUE" not in module.__spec__.loader_state["__dict__"]
+    assert module.VALUE == 42
+
+def test_threads_wait_for_the_module_to_load(slow_module):
+    module = lazy_import(slow_module)
+    values = []
+    def read():
+        try:
+            values.append(module.VALUE)
+        except AttributeError as e:
+            values.append(e)
+    threads = [threading.Thread(target=read) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert values == [42] * 8
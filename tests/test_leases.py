@@ -0,0 +1,183 @@
+import time
+import queue
+import traceback
+import multiprocessing
+import pytest
+
+psycopg = pytest.importorskip("psycopg")
+pytest.importorskip("trader")
+
+from conftest import connect_schema as connect
+
+PORTFOLIOS = 10
+ROUND_SECONDS = 0.05
+
+@pytest.fixture
+def schema(db_schema):
+    with connect(db_schema) as conn:
+        broker_id = conn.execute("""
+            INSERT INTO broker (author, name, type) VALUES ('test', 'test', 'manual') RETURNING id
+        """).fetchone()[0]
+        for i in range(PORTFOLIOS):
+            conn.execute("""
+                INSERT INTO portfolio (author, enabled, broker_id, name, shortname, module, schedule)
+                VALUES ('test', TRUE, %s, %s, %s, 'test', '* * * * *')
+            """, (broker_id, f"Portfolio {i}", f"pf{i}"))
+    return db_schema
+
+def node(schema, node_id, lease_seconds, ready, stop, results):
+    """
+    A trader node's claim loop. Reports (node, claim start, claim end, portfolio ids held) after
+    every round, and gives its leases back when stopped (but not when killed).
+    """
+    try:
+        import trader
+        trader.NODE_ID = node_id
+        trader.LEASE_SECONDS = lease_seconds
+        with connect(schema) as conn:
+            with conn.cursor() as cursor:
+                portfolios = trader.fetch_enabled_portfolios(cursor)
+            ready.wait()
+            while not stop.is_set():
+                start = time.monotonic()
+                held = trader.claim_portfolios(conn, portfolios)
+                results.put((node_id, start, time.monotonic(), frozenset(portfolio.id for portfolio in held)))
+                time.sleep(ROUND_SECONDS)
+            start = time.monotonic()
+            with conn.cursor() as cursor:
+                trader.delete_node(cursor, node_id)
+            results.put((node_id, start, time.monotonic(), frozenset()))
+    except Exception:
+        results.put((node_id, None, None, traceback.format_exc()))
+
+class Nodes:
+    """
+    Runs trader nodes in their own processes against the test schema and collects their rounds
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self.context = multiprocessing.get_context("spawn")
+        # One queue per node, a node killed mid-put would leave a shared one locked
+        self.results = {}
+        self.processes = {}
+        self.rounds = []
+
+    def start(self, *node_ids, lease_seconds=60):
+        ready = self.context.Barrier(len(node_ids))
+        for node_id in node_ids:
+            stop = self.context.Event()
+            self.results[node_id] = self.context.Queue()
+            process = self.context.Process(target=node, args=(self.schema, node_id, lease_seconds, ready, stop, self.results[node_id]), daemon=True)
+            process.start()
+            # The barrier has to outlive the start, the children only open it once they're up
+            self.processes[node_id] = (process, stop, ready)
+
+    def stop(self, node_id, kill=False):
+        process, stop, ready = self.processes.pop(node_id)
+        if kill:
+            process.kill()
+            process.join(10)
+            # A dead node runs nothing, whatever its leases say
+            killed = time.monotonic()
+            self.collect()
+            self.rounds.append((node_id, killed, killed, frozenset()))
+        else:
+            stop.set()
+            process.join(10)
+            self.collect()
+
+    def close(self):
+        for node_id in list(self.processes):
+            self.stop(node_id, kill=True)
+
+    def collect(self, timeout=0):
+        time.sleep(timeout)
+        for results in self.results.values():
+            while True:
+                try:
+                    result = results.get_nowait()
+                except queue.Empty:
+                    break
+                assert result[1] is not None, f"Node {result[0]} failed:\n{result[3]}"
+                self.rounds.append(result)
+
+    def wait_for(self, condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline, "timed out waiting for the nodes"
+            self.collect(0.1)
+
+    def latest(self, node_id):
+        rounds = [r for r in self.rounds if r[0] == node_id]
+        return rounds[-1][3] if rounds else None
+
+    def assert_never_shared(self):
+        """
+        A node runs the portfolios it holds between the end of one claim round and the start of
+        the next, no two nodes may ever do that for the same portfolio at the same time
+        """
+        held = []
+        by_node = {}
+        for r in self.rounds:
+            by_node.setdefault(r[0], []).append(r)
+        for rounds in by_node.values():
+            rounds.sort(key=lambda r: r[1])
+            for r, following in zip(rounds, rounds[1:] + [None]):
+                held.append((r[0], r[2], following[1] if following else float("inf"), r[3]))
+        for a in held:
+            for b in held:
+                if a[0] < b[0] and a[1] < b[2] and b[1] < a[2]:
+                    assert not a[3] & b[3], f"{a[0]} and {b[0]} both held {sorted(a[3] & b[3])}"
+
+@pytest.fixture
+def nodes(schema):
+    nodes = Nodes(schema)
+    try:
+        yield nodes
+    finally:
+        nodes.close()
+
+def test_nodes_split_the_portfolios(nodes):
+    nodes.start("a", "b")
+    # Both nodes start out alone, they settle on half each once they see each other
+    nodes.wait_for(lambda: nodes.latest("a") is not None and nodes.latest("b") is not None
+                   and len(nodes.latest("a")) == len(nodes.latest("b")) == PORTFOLIOS // 2)
+    # Let them keep renewing for a while
+    time.sleep(1)
+    nodes.collect()
+    assert nodes.latest("a") | nodes.latest("b") == set(range(1, PORTFOLIOS + 1))
+    nodes.assert_never_shared()
+
+def test_third_node_gets_a_share(nodes):
+    nodes.start("a", "b")
+    nodes.wait_for(lambda: nodes.latest("a") and nodes.latest("b") and len(nodes.latest("a") | nodes.latest("b")) == PORTFOLIOS)
+    nodes.start("c")
+    # The others give up their extras first, so the portfolios are briefly split over fewer nodes
+    nodes.wait_for(lambda: nodes.latest("c") and max(len(nodes.latest(n)) for n in "abc") <= 4
+                   and len(nodes.latest("a") | nodes.latest("b") | nodes.latest("c")) == PORTFOLIOS)
+    nodes.assert_never_shared()
+
+def test_stopped_node_hands_over_right_away(nodes):
+    nodes.start("a")
+    nodes.wait_for(lambda: nodes.latest("a") and len(nodes.latest("a")) == PORTFOLIOS)
+    nodes.start("b")
+    nodes.wait_for(lambda: nodes.latest("b") and len(nodes.latest("b")) == PORTFOLIOS // 2)
+    nodes.stop("a")
+    stopped = time.monotonic()
+    # Well within the 60s lease, since the stopped node gave its leases back
+    nodes.wait_for(lambda: len(nodes.latest("b")) == PORTFOLIOS, timeout=5)
+    assert time.monotonic() - stopped < 5
+    nodes.assert_never_shared()
+
+def test_crashed_node_is_taken_over_after_its_leases_expire(nodes):
+    lease_seconds = 2
+    nodes.start("a", lease_seconds=lease_seconds)
+    nodes.wait_for(lambda: nodes.latest("a") and len(nodes.latest("a")) == PORTFOLIOS)
+    nodes.stop("a", kill=True)
+    last_renewal = max(r[1] for r in nodes.rounds if r[0] == "a")
+    nodes.start("b", lease_seconds=lease_seconds)
+    nodes.wait_for(lambda: nodes.latest("b") and len(nodes.latest("b")) == PORTFOLIOS)
+    first_claim = min(r[2] for r in nodes.rounds if r[0] == "b" and r[3])
+    # Nothing was taken while the dead node's leases were still valid
+    assert first_claim >= last_renewal + lease_seconds - 0.5
+    nodes.assert_never_shared()
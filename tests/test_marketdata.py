@@ -0,0 +1,111 @@
+import os
+import uuid
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+import util
+import marketdata
+
+def bars(start, periods, close=100.0):
+    index = pd.date_range(start, periods=periods, freq="1h", tz="UTC", name="Open time")
+    values = close + np.arange(periods, dtype=float)
+    return pd.DataFrame({"Open": values, "Close": values}, index=index)
+
+class Fetcher:
+    """
+    Serves bars from a frame that tests extend between ticks, recording each requested range
+    """
+    def __init__(self, frame):
+        self.frame = frame
+        self.calls = []
+
+    def __call__(self, ticker, timeframe, start, end, **kwargs):
+        self.calls.append((start, end))
+        return self.frame.loc[start:end]
+
+def assert_bars_equal(left, right):
+    # Stored bars always come back in nanoseconds, whatever unit they were fetched in
+    assert list(left.index.as_unit("ns")) == list(right.index.as_unit("ns"))
+    assert list(left.columns) == list(right.columns)
+    assert np.array_equal(left.to_numpy(), right.to_numpy())
+
+@pytest.fixture
+def prefix():
+    prefix = f"tradebot_test_{uuid.uuid4().hex[:8]}_"
+    yield prefix
+    util.set_bar_store(None)
+    util.clear_bar_cache()
+    marketdata.sweep(prefix)
+
+def blocks(prefix):
+    return sorted(name for name in os.listdir("/dev/shm") if name.startswith(prefix))
+
+def test_refresh_writes_new_bars_in_place(prefix):
+    store = marketdata.SharedBarStore(prefix)
+    util.set_bar_store(store)
+    fetcher = Fetcher(bars("2024-01-01", 48))
+    first = util.fetch_bars("BTC/USD", "1 hour", start="2024-01-01", fetcher=fetcher)
+    assert len(first) == 48
+    names = blocks(prefix)
+
+    # The last bar was still forming, and two more came in since
+    fetcher.frame = pd.concat([fetcher.frame.iloc[:-1], bars(fetcher.frame.index[-1], 3, close=500.0)])
+    util.new_bar_generation()
+    refreshed = util.fetch_bars("BTC/USD", "1 hour", start="2024-01-01", fetcher=fetcher)
+
+    assert fetcher.calls[-1][0] == first.index[-1]
+    assert_bars_equal(refreshed, fetcher.frame)
+    assert blocks(prefix) == names
+    # A read-only view of the shared blocks, not a copy
+    assert not refreshed["Close"].to_numpy().flags.writeable
+    store.close()
+
+def test_outgrown_blocks_are_replaced(prefix, monkeypatch):
+    monkeypatch.setattr(marketdata, "MIN_HEADROOM", 2)
+    store = marketdata.SharedBarStore(prefix)
+    util.set_bar_store(store)
+    fetcher = Fetcher(bars("2024-01-01", 8))
+    util.fetch_bars("BTC/USD", "1 hour", fetcher=fetcher)
+    names = blocks(prefix)
+
+    fetcher.frame = bars("2024-01-01", 20)
+    util.new_bar_generation()
+    refreshed = util.fetch_bars("BTC/USD", "1 hour", fetcher=fetcher)
+
+    assert_bars_equal(refreshed, fetcher.frame)
+    assert len(blocks(prefix)) == 2
+    assert not set(blocks(prefix)) & set(names)
+    store.close()
+
+def test_next_worker_only_fetches_the_newest_bars(prefix):
+    store = marketdata.SharedBarStore(prefix)
+    util.set_bar_store(store)
+    fetcher = Fetcher(bars("2024-01-01", 48))
+    util.fetch_bars("BTC/USD", "1 hour", start="2024-01-01", fetcher=fetcher, client_type="crypto")
+    descriptors = store.descriptors()
+    store.close()
+
+    # What a recycled worker starts out with
+    util.clear_bar_cache()
+    util.set_bar_store(marketdata.SharedBarStore(prefix, descriptors))
+    fetcher.frame = bars("2024-01-01", 50)
+    fetched = util.fetch_bars("BTC/USD", "1 hour", start="2024-01-02", fetcher=fetcher, client_type="crypto")
+
+    assert fetcher.calls[-1] == (pd.Timestamp("2024-01-02 23:00", tz="UTC"), None)
+    assert_bars_equal(fetched, fetcher.frame.loc["2024-01-02":])
+    # Asking for more history than was stored fetches it all again
+    util.fetch_bars("BTC/USD", "1 hour", start="2023-12-01", fetcher=fetcher, client_type="crypto")
+    assert fetcher.calls[-1] == (pd.Timestamp("2023-12-01", tz="UTC"), None)
+    util.bar_store.close()
+
+def test_sweep_keeps_reported_blocks(prefix):
+    store = marketdata.SharedBarStore(prefix)
+    store.put("a", bars("2024-01-01", 4), None)
+    kept = marketdata.block_names(store.descriptors())
+    store.put("b", bars("2024-01-01", 4), None)
+    store.close()
+
+    marketdata.sweep(prefix, keep=kept)
+    assert blocks(prefix) == sorted(kept)
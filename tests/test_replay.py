@@ -0,0 +1,50 @@
+import types
+from datetime import datetime, timezone
+from decimal import Decimal
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("alpaca_trade_api")
+
+import util
+import replay
+
+def bars(periods):
+    index = pd.date_range("2024-01-01", periods=periods, freq="1h", tz="UTC", name="Open time")
+    close = 100.0 + np.arange(periods)
+    return pd.DataFrame({"Open": close - 0.5, "Close": close}, index=index)
+
+def strategy(frame):
+    def load_data(params):
+        return pd.DataFrame({"BTC/USD": util.fetch_bars("BTC/USD", "1 hour", start=params["start"])["Close"]})
+    return types.SimpleNamespace(load_data=load_data)
+
+@pytest.fixture
+def fetcher():
+    frame = bars(6)
+    util.set_fetcher(lambda ticker, timeframe, start, end, **kwargs: frame)
+    yield frame
+    util.set_fetcher(None)
+    util.clear_bar_cache()
+
+def test_runs_only_see_completed_bars(fetcher):
+    close, opens = replay.load_replay_data(strategy(fetcher), {"start": "2024-01-01"})
+    now = datetime(2024, 1, 1, 3, 20, tzinfo=timezone.utc)
+    data = replay.bars_at(close, opens, now, "1h")
+
+    # 00:00 to 02:00 are over, 03:00 is in progress and only its open is known
+    assert list(data["BTC/USD"]) == [100.0, 101.0, 102.0, 102.5]
+    assert data.index[-1] == pd.Timestamp("2024-01-01 03:00", tz="UTC")
+
+def test_fills_at_the_open_of_the_bar_in_progress(fetcher):
+    close, opens = replay.load_replay_data(strategy(fetcher), {"start": "2024-01-01"})
+    now = datetime(2024, 1, 1, 3, 0, 10, tzinfo=timezone.utc)
+    broker = replay.ReplayBroker(None, None, close, opens, "1h", lambda: now)
+    assert broker.price("BTC/USD") == Decimal("102.5")
+
+def test_opens_fall_back_to_the_previous_close():
+    close = bars(3)[["Close"]].rename(columns={"Close": "BITO"})
+    module = types.SimpleNamespace(load_data=lambda params: close)
+    _, opens = replay.load_replay_data(module, {})
+    assert list(opens["BITO"].iloc[1:]) == [100.0, 101.0]
@@ -0,0 +1,93 @@
+import types
+from datetime import datetime, timezone
+from decimal import Decimal
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+trader = pytest.importorskip("trader")
+
+import util
+
+PORTFOLIO = types.SimpleNamespace(module="hourly")
+MODULE = types.SimpleNamespace(CANDLE_FREQ="h")
+
+def close(periods, last=None):
+    index = pd.date_range("2024-01-01", periods=periods, freq="1h", tz="UTC", name="Open time")
+    values = 100.0 + np.arange(periods)
+    if last is not None:
+        values[-1] = last
+    return pd.DataFrame({"BTC/USD": values}, index=index)
+
+def fingerprint(data, now):
+    util.set_clock(lambda: now)
+    try:
+        return trader.run_fingerprint(PORTFOLIO, MODULE, data, Decimal(1000), {"BTC/USD": Decimal(1)})
+    finally:
+        util.set_clock(None)
+
+def test_fingerprint_ignores_the_bar_in_progress():
+    # 03:00 is still forming at 03:20 and 03:50, its value changes but nothing the signals see does
+    first = fingerprint(close(4, last=103.0), datetime(2024, 1, 1, 3, 20, tzinfo=timezone.utc))
+    assert fingerprint(close(4, last=110.0), datetime(2024, 1, 1, 3, 50, tzinfo=timezone.utc)) == first
+
+def test_fingerprint_changes_once_a_bar_completes():
+    before = fingerprint(close(4), datetime(2024, 1, 1, 3, 59, tzinfo=timezone.utc))
+    # Even before the new bar shows up
+    assert fingerprint(close(4), datetime(2024, 1, 1, 4, 0, 5, tzinfo=timezone.utc)) != before
+    assert fingerprint(close(5), datetime(2024, 1, 1, 4, 0, 5, tzinfo=timezone.utc)) != before
+
+def test_reused_result_takes_the_latest_prices():
+    result = {
+        "intents": [{"ticker": "BTC/USD", "side": "buy", "size": "2", "price": "100.0"}],
+        "prices": {"BTC/USD": "100.0", "BITO": "20.0"},
+    }
+    repriced = trader.reprice_result(result, trader.latest_prices(close(4, last=110.0)))
+    assert repriced["intents"] == [{"ticker": "BTC/USD", "side": "buy", "size": "2", "price": "110.0"}]
+    assert repriced["prices"] == {"BTC/USD": "110.0", "BITO": "20.0"}
+    # The memo itself is left as it was
+    assert result["intents"][0]["price"] == "100.0"
+
+def schedule_portfolio(id, schedule):
+    return trader.Portfolio(id, "me", True, 1, f"Portfolio {id}", f"pf{id}", "hourly", schedule, datetime(2024, 1, 1), None)
+
+def test_due_portfolios_go_first():
+    # 12:00:30 in New York, where schedules are
+    now = datetime(2024, 1, 2, 17, 0, 30, tzinfo=timezone.utc)
+    portfolios = [schedule_portfolio(1, "0 9 * * *"), schedule_portfolio(2, "0 12 * * *"), schedule_portfolio(3, "not a schedule")]
+    due, others = trader.split_due_portfolios(portfolios, now)
+    assert [p.id for p in due] == [2]
+    assert [p.id for p in others] == [1, 3]
+
+class Runner:
+    def __init__(self):
+        self.calls = []
+
+    def prewarm(self, portfolio):
+        self.calls.append("prewarm")
+
+    def is_market_open(self, portfolio):
+        self.calls.append("is_market_open")
+        return True
+
+class Broker:
+    def __init__(self, positions):
+        self.positions_seen = positions
+
+    def positions(self, portfolio):
+        return self.positions_seen
+
+def test_run_checks_broker_positions_after_prewarm():
+    replay = pytest.importorskip("replay")
+    portfolio = schedule_portfolio(1, "0 12 * * *")
+    ledger = replay.MemoryLedger(trader.model.Broker(1, "me", "Alpaca", "alpaca", None), portfolio)
+    runner = Runner()
+    broker = Broker({})
+    run_time = datetime(2024, 1, 2, 17, 0, tzinfo=timezone.utc)
+    trader.prewarm_portfolio(replay.MemoryConnection(), portfolio, run_time, ledger=ledger, broker_factory=lambda record: broker, runner=runner)
+
+    # Someone traded in the account between the pre-warm and the run, which has to notice
+    broker.positions_seen = {"BITO": Decimal(5)}
+    trader.run_portfolio(replay.MemoryConnection(), portfolio, now=run_time, ledger=ledger, broker_factory=lambda record: broker, runner=runner, scheduled_time=run_time)
+    assert runner.calls == ["prewarm"]
+    assert ledger.runs == []
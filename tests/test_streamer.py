@@ -0,0 +1,152 @@
+import time
+import asyncio
+from contextlib import nullcontext
+from decimal import Decimal
+from datetime import datetime
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+pytest.importorskip("pandas")
+pytest.importorskip("alpaca_trade_api")
+
+import replay
+import streamer
+from model import Broker
+from conftest import CREDENTIALS, StandIn, portfolio, open_order, order_json
+
+BROKER = Broker(1, "me", "Alpaca", "alpaca", CREDENTIALS)
+
+class Ledger(replay.MemoryLedger):
+    def __init__(self, portfolios):
+        super().__init__(BROKER, portfolios[0])
+        self.portfolios = {p.id: p for p in portfolios}
+
+    def fetch_enabled_portfolios(self, cursor):
+        return list(self.portfolios.values())
+
+    def fetch_portfolio_by_id(self, cursor, id):
+        return self.portfolios.get(id)
+
+    def fetch_order(self, cursor, id):
+        return self.orders[id - 1] if 0 < id <= len(self.orders) else None
+
+    def fetch_orders_by_status(self, cursor, pf_id, status):
+        return [order for order in self.orders if order.status == status and order.portfolio_id == pf_id]
+
+class StreamStandIn(StandIn):
+    """
+    Adds a trade updates websocket to the REST stand-in. Each connection streams the next list
+    of updates, then applies the next REST order changes and drops. Once both run out the
+    connection is held open.
+    """
+    def __init__(self, connections, orders=()):
+        super().__init__(orders)
+        self.connections = list(connections)
+        self.auths = []
+
+    def add_routes(self, app):
+        super().add_routes(app)
+        app.router.add_get("/stream", self.stream)
+
+    async def stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.auths.append(await ws.receive_json())
+        await ws.receive_json()
+        await ws.send_json({"stream": "authorization", "data": {"status": "authorized", "action": "authenticate"}})
+        if not self.connections:
+            # Until the streamer goes away
+            async for message in ws:
+                pass
+            return ws
+        updates, order_changes = self.connections.pop(0)
+        for update in updates:
+            await ws.send_json(update)
+        # Closing waits for the streamer to read up to the close, so it's done catching up by now
+        await ws.close()
+        self.orders.update({order["client_order_id"]: order for order in order_changes})
+        return ws
+
+def trade_update(event, order):
+    return {"stream": "trade_updates", "data": {"event": event, "order": order}}
+
+def consume_until(stand_in, ledger, done, timeout=5):
+    async def run():
+        async with stand_in:
+            task = asyncio.create_task(streamer.consume(
+                BROKER,
+                url=stand_in.url + "/stream",
+                rest_url=stand_in.url,
+                connect=lambda: nullcontext(replay.MemoryConnection()),
+                ledger=ledger,
+            ))
+            try:
+                deadline = asyncio.get_running_loop().time() + timeout
+                while not done():
+                    assert asyncio.get_running_loop().time() < deadline, "timed out waiting for the streamer"
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+    asyncio.run(run())
+
+@pytest.fixture(autouse=True)
+def fast_reconnect(monkeypatch):
+    monkeypatch.setattr(streamer, "RECONNECT_MIN_SECONDS", 0.01)
+
+def test_fills_are_written_with_a_snapshot():
+    pf = portfolio(1)
+    ledger = Ledger([pf])
+    ledger.deposit(1000, datetime(2022, 1, 1))
+    ledger.orders = [open_order(pf, 1), open_order(pf, 2)]
+    stand_in = StreamStandIn([([
+        trade_update("new", order_json("pf1_1_2", status="new", filled_qty="0")),
+        trade_update("fill", order_json("someone_else_1")),
+        trade_update("fill", order_json("pf1_1_1")),
+    ], [])], orders=[order_json("pf1_1_1", status="new", filled_qty="0"), order_json("pf1_1_2", status="new", filled_qty="0")])
+
+    consume_until(stand_in, ledger, lambda: ledger.orders[0].status == "filled")
+    assert stand_in.auths[0] == {"action": "auth", "key": "key", "secret": "secret"}
+    assert [order.status for order in ledger.orders] == ["filled", "open"]
+    assert ledger.fetch_positions(None, pf.id) == {"BITO": Decimal("2")}
+    snapshot = ledger.snapshots[-1]
+    assert snapshot.cash == Decimal(1000 - 2 * 50)
+    assert snapshot.equity == Decimal(1000)
+
+def test_catches_up_over_rest_after_reconnecting():
+    pf = portfolio(1)
+    ledger = Ledger([pf])
+    ledger.orders = [open_order(pf, 1), open_order(pf, 2)]
+    # The second order fills while the stream is down, so only the catch up after reconnecting sees it
+    stand_in = StreamStandIn(
+        [([trade_update("fill", order_json("pf1_1_1"))], [order_json("pf1_1_2")])],
+        orders=[order_json("pf1_1_1", status="new", filled_qty="0"), order_json("pf1_1_2", status="new", filled_qty="0")],
+    )
+
+    consume_until(stand_in, ledger, lambda: ledger.orders[1].status == "filled")
+    assert [order.status for order in ledger.orders] == ["filled", "filled"]
+    assert len(stand_in.auths) == 2
+
+def test_db_work_runs_off_the_event_loop():
+    class SlowLedger(Ledger):
+        def fetch_enabled_portfolios(self, cursor):
+            time.sleep(0.3)
+            return super().fetch_enabled_portfolios(cursor)
+
+    async def run():
+        # Stands in for the other accounts' streams sharing the loop
+        loop = asyncio.get_running_loop()
+        gaps = []
+        async def ticker(catching_up):
+            last = loop.time()
+            while not catching_up.done():
+                await asyncio.sleep(0.01)
+                gaps.append(loop.time() - last)
+                last = loop.time()
+
+        catching_up = asyncio.create_task(streamer.catch_up(None, BROKER, lambda: nullcontext(replay.MemoryConnection()), SlowLedger([portfolio(1)])))
+        await asyncio.gather(catching_up, ticker(catching_up))
+        return gaps
+
+    assert max(asyncio.run(run())) < 0.2
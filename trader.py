@@ -1,5 +1,12 @@
 from decimal import Decimal
 import os
+import json
+import asyncio
+import hashlib
+import math
+import socket
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 import pytz
 import time
@@ -8,25 +15,33 @@ import importlib
 import logging
 import traceback
 from ast import literal_eval
-import pandas as pd
-import crontabula
-import psycopg
+from lazy import lazy_import
+import model
 from model import (
-    insert_run,
-    insert_order, 
     fetch_enabled_portfolios, 
-    fetch_portfolio_broker, 
-    fetch_orders_by_status,
-    update_order, 
-    fetch_available_cash, 
-    fetch_positions, 
-    update_portfolio,
+    update_node_heartbeat,
+    delete_node,
+    fetch_live_node_count,
+    claim_portfolio,
+    renew_leases,
+    release_portfolio,
+    create_history_partitions,
     Portfolio,
     PortfolioRun,
-    PortfolioOrder
+    PortfolioOrder,
+    PortfolioSnapshot,
+    PortfolioRunMemo
 )
-from brokers import AlpacaBroker
+from brokers import AlpacaBroker, AsyncAlpacaBroker, SyncBrokerAdapter
+from workers import InProcessRunner, StrategyWorker
+import ratelimit
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "strategies"))
+import util
+
+# Only the polling loop's own dependencies load at startup, the rest load the first time they're used
+pd = lazy_import("pandas")
+crontabula = lazy_import("crontabula")
+psycopg = lazy_import("psycopg")
 
 log = logging.getLogger()
 handler = logging.StreamHandler()
@@ -36,6 +51,18 @@ log.addHandler(handler)
 log.setLevel(logging.INFO)
 
 DB_CONN_STRING = os.environ.get("TRADEBOT_DB_CONN")
+POLL_SECONDS = 10
+RUN_MEMO_SIZE = 256
+# Newest memos kept in the DB per portfolio, older fingerprints (e.g. past candles) won't come up again
+RUN_MEMO_DB_SIZE = 16
+# How long before a scheduled run to start loading its data and reconciling with the broker
+PREWARM_SECONDS = 60
+# Several trader processes can share the portfolios, each one leasing its share through the DB
+NODE_ID = os.environ.get("TRADEBOT_NODE_ID", f"{socket.gethostname()}:{os.getpid()}")
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = 15
+# Months of history partitions kept ready ahead of time, so new rows don't pile up in the default ones
+PARTITION_MONTHS_AHEAD = 3
 
 def order_summary(o):
     return f"{o.side.upper()} " + (f"${o.notional} of {o.ticker}" if o.side == "buy" else f"{o.quantity} of {o.ticker}")
@@ -71,44 +98,224 @@ def column_to_ticker(column):
         pass
     return column
         
+# Kept around so connections made while pre-warming are reused by the run itself
+broker_instances = {}
 def instantiate_broker(broker):
     if broker.type == "alpaca":
         creds = broker.credentials if broker.credentials else {}
-        return AlpacaBroker(log, creds)
+        key = (broker.id, json.dumps(creds, sort_keys=True, default=str))
+        if key not in broker_instances:
+            broker_instances[key] = AlpacaBroker(log, creds)
+        return broker_instances[key]
     return None
+
+def instantiate_async_broker(broker):
+    if broker.type == "alpaca":
+        creds = broker.credentials if broker.credentials else {}
+        return AsyncAlpacaBroker(log, creds)
+    sync_broker = instantiate_broker(broker)
+    return SyncBrokerAdapter(sync_broker) if sync_broker else None
             
 def is_market_open(portfolio):
     pf_module = importlib.import_module(portfolio.module)
+    # Strategies that trade around the clock (e.g. crypto) don't need to define this
+    if not hasattr(pf_module, "is_market_open"):
+        return True
     return pf_module.is_market_open()
 
+def create_portfolio(pf_module, pf_params, data=None):
+    if data is None:
+        return pf_module.create_portfolio(pf_params)
+    return pf_module.create_portfolio(pf_params, data)
+
 pf_modules = {}
-def instantiate_pf(portfolio, available_cash, positions):
+pf_module_versions = {}
+def load_pf_module(portfolio):
     global pf_modules
     if portfolio.module not in pf_modules:
         pf_module = importlib.import_module(portfolio.module)
         pf_modules[portfolio.module] = pf_module
-    pf_module = pf_modules[portfolio.module]
+        with open(pf_module.__file__, "rb") as f:
+            pf_module_versions[portfolio.module] = hashlib.sha256(f.read()).hexdigest()
+    return pf_modules[portfolio.module]
+
+def instantiate_pf(portfolio, available_cash, positions, data=None):
+    pf_module = load_pf_module(portfolio)
     pf_params = {"live": True, "pf_kwargs": {}}
-    pf = pf_module.create_portfolio(pf_params)
+    pf = create_portfolio(pf_module, pf_params, data)
     pf_params["pf_kwargs"]["init_cash"] = available_cash
     pf_params["pf_kwargs"]["init_position"] = [
         positions[ticker] if ticker in positions else 0 
         for ticker in list(pf.wrapper.columns)
     ]
-    if not pf_module.can_trade(pf_params):
+    if hasattr(pf_module, "can_trade") and not pf_module.can_trade(pf_params):
         return None
-    return pf_module.create_portfolio(pf_params)
+    return create_portfolio(pf_module, pf_params, data)
+
+# Latest known price per ticker, from the close of the last simulated bar or the last fill
+last_prices = {}
+
+def latest_prices(close):
+    if isinstance(close, pd.Series):
+        close = close.to_frame()
+    prices = {}
+    for column in close.columns:
+        column_prices = close[column].dropna()
+        if not column_prices.empty:
+            prices[column_to_ticker(column)] = str(column_prices.iloc[-1])
+    return prices
 
-def run_portfolio(conn, portfolio):
+def run_fingerprint(portfolio, pf_module, close, available_cash, positions):
+    """
+    Hash of everything a live run depends on, so identical runs can reuse the previous result.
+    Live signals only look at completed bars, those that started before the current candle (which
+    modules set to the length of their bars with CANDLE_FREQ), so only their timestamps are hashed.
+    The value of the bar in progress keeps changing and is applied to a reused result instead,
+    see reprice_result.
+    """
+    if isinstance(close, pd.Series):
+        close = close.to_frame()
+    current_candle = util.utcnow().floor(freq=getattr(pf_module, "CANDLE_FREQ", "min"))
+    completed_bars = []
+    for column in close.columns:
+        index = close[column].dropna().index
+        index = index[:index.searchsorted(current_candle)]
+        completed_bars.append((str(column), len(index), str(index[0]) if len(index) else None, str(index[-1]) if len(index) else None))
+    inputs = {
+        "module": portfolio.module,
+        "version": pf_module_versions.get(portfolio.module),
+        "bars": completed_bars,
+        "cash": str(available_cash),
+        "positions": sorted((ticker, str(amount)) for ticker, amount in positions.items()),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def reprice_result(result, prices):
+    """
+    A reused result was simulated on an earlier value of the bar in progress, take the prices (and
+    so the notional of buys) from its latest value instead
+    """
+    intents = [{**intent, "price": prices.get(intent["ticker"], intent["price"])} for intent in result["intents"]]
+    return {"intents": intents, "prices": {**result["prices"], **prices}}
+
+def pf_result(pf):
+    records = pf.orders.records_readable
+    # Sort so sells come before buys
+    records = records.sort_values(by=["Side"], ascending=False)
+    intents = [
+        {
+            "ticker": column_to_ticker(record["Column"]),
+            "side": record["Side"].lower(),
+            "size": str(record["Size"]),
+            "price": str(record["Price"]),
+        }
+        for i, record in records.iterrows()
+    ]
+    return {"intents": intents, "prices": latest_prices(pf.close)}
+
+def prepare_run(portfolio, available_cash, positions, data=None):
+    pf_module = load_pf_module(portfolio)
+    if data is None and hasattr(pf_module, "load_data"):
+        data = pf_module.load_data({"live": True})
+    if data is None:
+        return None, {}, data
+    return run_fingerprint(portfolio, pf_module, data, available_cash, positions), latest_prices(data), data
+
+def prewarm_run(portfolio):
+    # Loading the data fills the bar cache, so the run itself only has to fetch the newest bar
+    pf_module = load_pf_module(portfolio)
+    if hasattr(pf_module, "load_data"):
+        pf_module.load_data({"live": True})
+
+def simulate_run(portfolio, available_cash, positions, data=None):
+    pf = instantiate_pf(portfolio, available_cash, positions, data)
+    return None if pf is None else pf_result(pf)
+
+# In-memory LRU in front of the portfolio_run_memo table, keyed by (portfolio id, fingerprint)
+run_memos = OrderedDict()
+def fetch_run_memo(conn, portfolio, fingerprint, ledger=model):
+    key = (portfolio.id, fingerprint)
+    if key in run_memos:
+        run_memos.move_to_end(key)
+        return run_memos[key]
+    with conn.cursor() as cursor:
+        memo = ledger.fetch_run_memo(cursor, portfolio.id, fingerprint)
+    if memo is not None:
+        store_run_memo(conn, portfolio, fingerprint, memo.result, ledger, persist=False)
+        return memo.result
+    return None
+
+def store_run_memo(conn, portfolio, fingerprint, result, ledger=model, persist=True):
+    run_memos[(portfolio.id, fingerprint)] = result
+    run_memos.move_to_end((portfolio.id, fingerprint))
+    while len(run_memos) > RUN_MEMO_SIZE:
+        run_memos.popitem(last=False)
+    if persist:
+        with conn.cursor() as cursor:
+            ledger.insert_run_memo(cursor, PortfolioRunMemo(portfolio.id, fingerprint, datetime.now(timezone.utc), result))
+            ledger.delete_old_run_memos(cursor, portfolio.id, RUN_MEMO_DB_SIZE)
+
+def record_snapshot(conn, portfolio, now, ledger=model):
+    try:
+        with conn.cursor() as cursor:
+            cash = ledger.fetch_available_cash(cursor, portfolio.id)
+            positions = ledger.fetch_positions(cursor, portfolio.id)
+            latest = ledger.fetch_latest_snapshot(cursor, portfolio.id)
+
+        market_values = {}
+        for ticker, amount in positions.items():
+            if amount == 0:
+                continue
+            price = last_prices.get(ticker)
+            if price is None and latest is not None and ticker in latest.market_values:
+                price = Decimal(latest.market_values[ticker]["price"])
+            if price is None:
+                log.warning(f"No cached price for {ticker}, skipping snapshot")
+                return
+            market_values[ticker] = {"amount": str(amount), "price": str(price), "value": str(amount * price)}
+
+        snapshot = PortfolioSnapshot(
+            0,
+            portfolio.id,
+            now,
+            cash,
+            cash + sum((Decimal(value["value"]) for value in market_values.values()), Decimal(0)),
+            market_values
+        )
+        log.info("Recording portfolio snapshot...")
+        with conn.cursor() as cursor:
+            ledger.insert_snapshot(cursor, snapshot)
+    except:
+        log.exception("Failed to record portfolio snapshot")
+
+# Scheduled run each portfolio was last pre-warmed for, successfully or not, so it's only tried once
+prewarm_attempts = {}
+def prewarm_portfolio(conn, portfolio, run_time, ledger=model, broker_factory=instantiate_broker, runner=None):
+    # The market is often still closed ahead of a run at the open, so that's only checked by the run itself
+    runner = runner if runner else InProcessRunner()
+    prewarm_attempts[portfolio.id] = run_time
+    with conn.cursor() as cursor:
+        broker_record = ledger.fetch_portfolio_broker(cursor, portfolio.id)
+        available_cash = ledger.fetch_available_cash(cursor, portfolio.id)
+        positions = ledger.fetch_positions(cursor, portfolio.id)
+
+    runner.prewarm(portfolio)
+    broker = broker_factory(broker_record)
+    if broker and broker.positions(portfolio) != positions:
+        log.error("Positions do not match ahead of the run, it will skip unless they're fixed by then")
+
+def run_portfolio(conn, portfolio, now=None, ledger=model, broker_factory=instantiate_broker, data=None, runner=None, scheduled_time=None):
+    runner = runner if runner else InProcessRunner()
     with conn.cursor() as cursor:
         log.info("Fetching broker...")
-        broker_record = fetch_portfolio_broker(cursor, portfolio.id)
+        broker_record = ledger.fetch_portfolio_broker(cursor, portfolio.id)
         log.info("Fetching available cash...")
-        available_cash = fetch_available_cash(cursor, portfolio.id)
+        available_cash = ledger.fetch_available_cash(cursor, portfolio.id)
         log.info("Fetching positions...")
-        positions = fetch_positions(cursor, portfolio.id)
+        positions = ledger.fetch_positions(cursor, portfolio.id)
 
-    broker = instantiate_broker(broker_record)
+    broker = broker_factory(broker_record)
+    # Even after pre-warming, something outside the ledger may have changed the broker's positions since
     if broker:
         log.info("Verifying broker positions match ours...")
         broker_positions = broker.positions(portfolio)
@@ -120,25 +327,44 @@ def run_portfolio(conn, portfolio):
             log.error("Positions do not match! Skipping...")
             return
         
-    if not is_market_open(portfolio):
+    if not runner.is_market_open(portfolio):
         log.info("Outside market hours for this portfolio. Skipping...")
         return
     
     log.info("Instantiating (running) portfolio...")
     status = "succeeded"
     err = None
-    pf = None
+    result = None
+    fingerprint = None
+    cache_hit = False
     try:
-        pf = instantiate_pf(portfolio, available_cash, positions)
-        if pf is None:
-            log.info("Unable to trade the portfolio right now, skipping")
-            return
+        fingerprint, prices = runner.prepare(portfolio, available_cash, positions, data)
+        if fingerprint is not None:
+            result = fetch_run_memo(conn, portfolio, fingerprint, ledger)
+            cache_hit = result is not None
+        if cache_hit:
+            log.info("Inputs unchanged since a previous run, reusing its result")
+            result = reprice_result(result, prices)
+        else:
+            result = runner.simulate(portfolio, available_cash, positions)
+            if result is None:
+                log.info("Unable to trade the portfolio right now, skipping")
+                runner.finish()
+                return
+            if fingerprint is not None:
+                store_run_memo(conn, portfolio, fingerprint, result, ledger)
     except:
         log.exception("Error encountered instantiating portfolio...")
         status = "failed"
         err = traceback.format_exc()
+
+    usage = {}
+    try:
+        usage = runner.finish()
+    except:
+        log.exception("Failed to collect resource usage of the run")
         
-    now = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc) if now is None else now
                             
     run = PortfolioRun(
         0,
@@ -146,10 +372,14 @@ def run_portfolio(conn, portfolio):
         status,
         now,
         err,
-        False
+        False,
+        fingerprint,
+        cache_hit,
+        usage.get("peak_memory"),
+        usage.get("cpu_seconds")
     )
     with conn.cursor() as cursor:
-        run_id = insert_run(cursor, run)
+        run_id = ledger.insert_run(cursor, run)
         
     if err is not None:
         return
@@ -159,22 +389,22 @@ def run_portfolio(conn, portfolio):
         portfolio_list[portfolio._fields.index("last_run_timestamp")] = now
         portfolio = Portfolio(*portfolio_list)
         log.info("Updating last run time for portfolio")
-        update_portfolio(cursor, portfolio)
+        ledger.update_portfolio(cursor, portfolio)
+
+    for ticker, price in result["prices"].items():
+        last_prices[ticker] = Decimal(price)
+    record_snapshot(conn, portfolio, now, ledger)
         
-    records = pf.orders.records_readable
-    if records.empty:
+    if not result["intents"]:
         log.info("No orders to create. Done!")
         return
-    
-    # Sort so sells come before buys
-    records = records.sort_values(by=["Side"], ascending=False)
                     
     # Grab the next order to generate
-    record = records.iloc[0]
+    record = result["intents"][0]
     
-    side = record["Side"].lower()
-    notional = Decimal.min(Decimal(record["Size"]) * Decimal(record["Price"]), available_cash) if side == "buy" else None
-    quantity = Decimal(record["Size"]) if side == "sell" else None
+    side = record["side"]
+    notional = Decimal.min(Decimal(record["size"]) * Decimal(record["price"]), available_cash) if side == "buy" else None
+    quantity = Decimal(record["size"]) if side == "sell" else None
 
     # Only notify for open order if manual broker (broker is none)
     notified = broker is not None
@@ -183,7 +413,7 @@ def run_portfolio(conn, portfolio):
         portfolio.id,
         run_id,
         "open",
-        column_to_ticker(record["Column"]),
+        record["ticker"],
         side,
         now,
         notional,
@@ -198,89 +428,307 @@ def run_portfolio(conn, portfolio):
     log.info(f"Creating order to {order_summary(order)}...")
         
     with conn.cursor() as cursor:
-        order_id = insert_order(cursor, order)
+        order_id = ledger.insert_order(cursor, order)
         order = PortfolioOrder(order_id, *(list(order)[1:]))
 
         if broker:
             broker.submit_orders(portfolio, [order])
 
+        # Only meaningful against the real clock, not when replaying
+        if scheduled_time is not None and util.clock is None:
+            submit_latency = (datetime.now(timezone.utc) - scheduled_time).total_seconds()
+            log.info(f"Order submitted {submit_latency:.3f}s after the scheduled run time")
+            ledger.update_run_submit_latency(cursor, run_id, submit_latency)
+
+
+
+def scheduled_run_time(portfolio, now):
+    """
+    Returns the scheduled run time the portfolio is currently due for, or None if it isn't due
+    """
+    # NOTE: All timestamps in the DB and elsewhere in the codebase are in UTC. 
+    #       However, the one exception is that cron schedules are assumed to be
+    #       in America/New_York because NYSE always opens and closes at the same
+    #       times in America/New_York. Therefore, we need to convert times
+    #       to America/New_York before checking if now is the right time to run.
+    crontab = crontabula.parse(portfolio.schedule)
+    now_ny = now.astimezone(pytz.timezone('US/Eastern'))
+    start = (portfolio.start_timestamp if portfolio.last_run_timestamp is None else portfolio.last_run_timestamp).replace(tzinfo=pytz.UTC)
+    start_ny = start.astimezone(pytz.timezone('US/Eastern'))
+    # Round up to the nearest minute since crontabula ignores seconds when determining the next date time,
+    # which could result in running a portfolio 59 times in a row...
+    start_ny = round_time(start_ny)
+    # Crontabula always returns tz-unaware/tz-naive datetimes, so we have to explicitly say that the time 
+    # is America/New_York in order to compare with our _ny datetimes
+    run_times = crontab.date_times(start=start_ny)
+    next_run = pytz.timezone('US/Eastern').localize(next(run_times))
+    previous_next_run = next_run
+    while next_run < now_ny:
+        previous_next_run = next_run
+        next_run = pytz.timezone('US/Eastern').localize(next(run_times))
+    next_run = previous_next_run
+    # Make sure to only run the portfolio when we're exactly at after the next run time 
+    # AND we're still within the same hour. The latter is important so we don't run the portfolio at the
+    # wrong time of day if it fell behind somehow.
+    if now_ny >= next_run and now_ny.replace(minute=0, second=0, microsecond=0) == next_run.replace(minute=0, second=0, microsecond=0):
+        return next_run
+    return None
+
+def next_scheduled_run_time(portfolio, now):
+    """
+    Returns the first scheduled run time strictly after now, in UTC
+    """
+    crontab = crontabula.parse(portfolio.schedule)
+    now_ny = now.astimezone(pytz.timezone('US/Eastern'))
+    start_ny = round_time(now_ny)
+    for run_time in crontab.date_times(start=start_ny):
+        run_time = pytz.timezone('US/Eastern').localize(run_time)
+        if run_time > now_ny:
+            return run_time.astimezone(timezone.utc)
+
+def apply_resolved_orders(conn, portfolio, orders, now, ledger=model):
+    filled = False
+    with conn.cursor() as cursor:
+        for order in orders:
+            ledger.update_order(cursor, order)
+            if order.status == "filled":
+                last_prices[order.ticker] = Decimal(order.fill_price)
+                filled = True
+    if filled:
+        record_snapshot(conn, portfolio, now, ledger)
+
+async def resolve_open_orders(conn, portfolios, now=None, ledger=model, broker_factory=instantiate_async_broker):
+    """
+    Resolve the open orders of every portfolio at once, overlapping the broker calls instead of
+    making them one portfolio after another. tick_portfolio still picks up whatever is left.
+    """
+    now = datetime.now(timezone.utc) if now is None else now
+    with conn.cursor() as cursor:
+        pending = [
+            (portfolio, ledger.fetch_portfolio_broker(cursor, portfolio.id), ledger.fetch_orders_by_status(cursor, portfolio.id, "open"))
+            for portfolio in portfolios
+        ]
+
+    # One broker per account so its portfolios share a session and a rate limiter
+    brokers = {}
+    lookups = []
+    try:
+        for portfolio, broker_record, open_orders in pending:
+            if broker_record is None or not open_orders:
+                continue
+            if broker_record.id not in brokers:
+                brokers[broker_record.id] = broker_factory(broker_record)
+            broker = brokers[broker_record.id]
+            if broker:
+                lookups.append((portfolio, broker.resolve_orders(portfolio, open_orders)))
+        results = await asyncio.gather(*[lookup for portfolio, lookup in lookups], return_exceptions=True)
+    finally:
+        await asyncio.gather(*[broker.close() for broker in brokers.values() if broker])
+
+    for (portfolio, lookup), result in zip(lookups, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            log.error(f"Failed to resolve open orders of portfolio '{portfolio.name}'", exc_info=result)
+            continue
+        apply_resolved_orders(conn, portfolio, result, now, ledger)
+
+def tick_portfolio(conn, portfolio, now=None, ledger=model, broker_factory=instantiate_broker, data=None, runner=None):
+    now = datetime.now(timezone.utc) if now is None else now
+
+    # Try to resolve the status of existing open orders
+    open_orders = []
+    with conn.cursor() as cursor:
+        broker_record = ledger.fetch_portfolio_broker(cursor, portfolio.id)
+        open_orders = ledger.fetch_orders_by_status(cursor, portfolio.id, "open")
+
+    if open_orders:
+        broker = broker_factory(broker_record)
+        if broker:
+            log.info("Attempting to automatically resolve open orders...")
+            apply_resolved_orders(conn, portfolio, broker.resolve_orders(portfolio, open_orders), now, ledger)
+    
+    # Check for any remaining open orders after resolving
+    with conn.cursor() as cursor:
+        if ledger.fetch_orders_by_status(cursor, portfolio.id, "open"):
+            log.info("Portfolio has open orders that need to be resolved first, skipping.")
+            return
+
+    run_time = scheduled_run_time(portfolio, now)
+    if run_time is not None:
+        log.info("Running the portfolio to look for new orders...")
+        run_portfolio(conn, portfolio, now=now, ledger=ledger, broker_factory=broker_factory, data=data, runner=runner, scheduled_time=run_time)
+        return
+
+    next_run_time = next_scheduled_run_time(portfolio, now)
+    if data is None and next_run_time - now <= timedelta(seconds=PREWARM_SECONDS) \
+            and prewarm_attempts.get(portfolio.id) != next_run_time:
+        log.info(f"Pre-warming the portfolio ahead of its run at {next_run_time}...")
+        try:
+            prewarm_portfolio(conn, portfolio, next_run_time, ledger=ledger, broker_factory=broker_factory, runner=runner)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            log.exception("Failed to pre-warm the portfolio, it will run cold")
+    else:
+        log.info("Nothing to do right now")
+
+def claim_portfolios(conn, portfolios):
+    """
+    Lease this node's fair share of the enabled portfolios and return the ones it holds.
+    Portfolios of nodes that stopped heartbeating are taken over once their leases expire.
+    """
+    enabled_ids = set(portfolio.id for portfolio in portfolios)
+    with conn.cursor() as cursor:
+        update_node_heartbeat(cursor, NODE_ID)
+        node_count = max(fetch_live_node_count(cursor, LEASE_SECONDS), 1)
+        target = math.ceil(len(portfolios) / node_count)
+        held = set(renew_leases(cursor, NODE_ID, LEASE_SECONDS))
+
+        # Give back disabled portfolios, and extras after other nodes joined
+        for pf_id in sorted(held, key=lambda pf_id: pf_id in enabled_ids):
+            if pf_id in enabled_ids and len(held) <= target:
+                break
+            release_portfolio(cursor, pf_id, NODE_ID)
+            held.discard(pf_id)
+
+        for portfolio in portfolios:
+            if len(held) >= target:
+                break
+            if portfolio.id not in held and claim_portfolio(cursor, portfolio.id, NODE_ID, LEASE_SECONDS):
+                held.add(portfolio.id)
+    return [portfolio for portfolio in portfolios if portfolio.id in held]
 
-try:
+def heartbeat():
+    # Keeps leases alive while a long portfolio run blocks the main loop
     while True:
-        time.sleep(10)
-        
-        # Fetch all active portfolios
-        portfolios = []
+        time.sleep(HEARTBEAT_SECONDS)
         try:
-            with psycopg.connect(DB_CONN_STRING) as conn:
+            with psycopg.connect(DB_CONN_STRING, autocommit=True) as conn:
                 with conn.cursor() as cursor:
-                    portfolios = fetch_enabled_portfolios(cursor)
+                    update_node_heartbeat(cursor, NODE_ID)
+                    renew_leases(cursor, NODE_ID, LEASE_SECONDS)
+        except:
+            log.exception("Failed to heartbeat")
+
+def split_due_portfolios(portfolios, now):
+    """
+    Returns the portfolios due for a scheduled run and the others
+    """
+    due = []
+    others = []
+    for portfolio in portfolios:
+        try:
+            run_time = scheduled_run_time(portfolio, now)
+        except:
+            log.exception(f"Failed to work out whether portfolio '{portfolio.name}' is due")
+            run_time = None
+        (due if run_time is not None else others).append(portfolio)
+    return due, others
+
+def tick_claimed_portfolio(portfolio, runner):
+    # Each portfolio runs inside its own DB connection
+    with psycopg.connect(DB_CONN_STRING) as conn:
+        log.info(f"Looking at portfolio '{portfolio.name}'...")
+        try:
+            # Make sure the lease didn't lapse (e.g. the DB was unreachable) and another node took over
+            with psycopg.connect(DB_CONN_STRING, autocommit=True) as lease_conn:
+                with lease_conn.cursor() as cursor:
+                    if not claim_portfolio(cursor, portfolio.id, NODE_ID, LEASE_SECONDS):
+                        log.info(f"Lost the lease on portfolio '{portfolio.name}', skipping")
+                        return
+            tick_portfolio(conn, portfolio, runner=runner)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
-            log.exception("Failed to fetch enabled portfolios")
-            continue
+            log.exception(f"Exception thrown trying to run portfolio '{portfolio.name}'")
+
+def ensure_partitions():
+    try:
+        with psycopg.connect(DB_CONN_STRING, autocommit=True) as conn:
+            with conn.cursor() as cursor:
+                create_history_partitions(cursor, PARTITION_MONTHS_AHEAD)
+        return True
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        log.exception("Failed to create upcoming history partitions")
+        return False
+
+def main():
+    log.info(f"Starting trader node '{NODE_ID}'...")
+    # Trader nodes and the streamer share each broker account's request quota
+    ratelimit.share_via_db(DB_CONN_STRING)
+    threading.Thread(target=heartbeat, daemon=True).start()
+    worker = StrategyWorker()
+    partitions_date = datetime.now(timezone.utc).date() if ensure_partitions() else None
+    # The first tick runs right away, see startup.py --first-tick
+    sleep_seconds = 0
+    try:
+        while True:
+            time.sleep(sleep_seconds)
+            sleep_seconds = POLL_SECONDS
+            tick_start = time.monotonic()
+            util.new_bar_generation()
+            try:
+                worker.new_tick()
+            except:
+                log.exception("Failed to start a new tick in the strategy worker")
             
-        # Try to run each portfolio inside its own DB connection
-        for portfolio in portfolios:
-            with psycopg.connect(DB_CONN_STRING) as conn:
-                log.info(f"Looking at portfolio '{portfolio.name}'...")
-                
-                try:
-                    # Try to resolve the status of existing open orders
-                    open_orders = []
-                    with conn.cursor() as cursor:
-                        broker_record = fetch_portfolio_broker(cursor, portfolio.id)
-                        open_orders = fetch_orders_by_status(cursor, portfolio.id, "open")
-
-                    if open_orders:
-                        broker = instantiate_broker(broker_record)
-                        if broker:
-                            log.info("Attempting to automatically resolve open orders...")
-                            with conn.cursor() as cursor:
-                                for order in broker.resolve_orders(portfolio, open_orders):
-                                    update_order(cursor, order)
-                    
-                    # Check for any remaining open orders after resolving
+            # Fetch all active portfolios
+            portfolios = []
+            try:
+                with psycopg.connect(DB_CONN_STRING, autocommit=True) as conn:
                     with conn.cursor() as cursor:
-                        if fetch_orders_by_status(cursor, portfolio.id, "open"):
-                            log.info("Portfolio has open orders that need to be resolved first, skipping.")
-                            continue
-                    
-                    # NOTE: All timestamps in the DB and elsewhere in the codebase are in UTC. 
-                    #       However, the one exception is that cron schedules are assumed to be
-                    #       in America/New_York because NYSE always opens and closes at the same
-                    #       times in America/New_York. Therefore, we need to convert times
-                    #       to America/New_York before checking if now is the right time to run.
-                    crontab = crontabula.parse(portfolio.schedule)
-                    now = datetime.now(timezone.utc)
-                    now_ny = now.astimezone(pytz.timezone('US/Eastern'))
-                    start = (portfolio.start_timestamp if portfolio.last_run_timestamp is None else portfolio.last_run_timestamp).replace(tzinfo=pytz.UTC)
-                    start_ny = start.astimezone(pytz.timezone('US/Eastern'))
-                    # Round up to the nearest minute since crontabula ignores seconds when determining the next date time,
-                    # which could result in running a portfolio 59 times in a row...
-                    start_ny = round_time(start_ny)
-                    # Crontabula always returns tz-unaware/tz-naive datetimes, so we have to explicitly say that the time 
-                    # is America/New_York in order to compare with our _ny datetimes
-                    run_times = crontab.date_times(start=start_ny)
-                    next_run = pytz.timezone('US/Eastern').localize(next(run_times))
-                    previous_next_run = next_run
-                    while next_run < now_ny:
-                        previous_next_run = next_run
-                        next_run = pytz.timezone('US/Eastern').localize(next(run_times))
-                    next_run = previous_next_run
-                    # Make sure to only run the portfolio when we're exactly at after the next run time 
-                    # AND we're still within the same hour. The latter is important so we don't run the portfolio at the
-                    # wrong time of day if it fell behind somehow.
-                    if now_ny >= next_run and pd.Timestamp(now_ny).floor(freq="H") == pd.Timestamp(next_run).floor(freq="H"):
-                        log.info("Running the portfolio to look for new orders...")
-                        run_portfolio(conn, portfolio)
-                    else:
-                        log.info("Nothing to do right now")
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except:
-                    log.exception(f"Exception thrown trying to run portfolio '{portfolio.name}'")
-except (KeyboardInterrupt, SystemExit):
-    log.info("Shutting down...")
-    sys.exit()
+                        portfolios = fetch_enabled_portfolios(cursor)
+                    portfolios = claim_portfolios(conn, portfolios)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                log.exception("Failed to fetch and claim enabled portfolios")
+                continue
+
+            # Portfolios due for a run go first, so nothing else this tick adds to their latency.
+            # Ticking them resolves their own open orders.
+            due, others = split_due_portfolios(portfolios, datetime.now(timezone.utc))
+            for portfolio in due:
+                tick_claimed_portfolio(portfolio, worker)
+
+            try:
+                with psycopg.connect(DB_CONN_STRING, autocommit=True) as conn:
+                    asyncio.run(resolve_open_orders(conn, others))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                log.exception("Failed to resolve open orders")
+
+            for portfolio in others:
+                tick_claimed_portfolio(portfolio, worker)
+            log.info(f"Market data requests: {util.bar_stats}")
+            log.info(f"Finished tick in {time.monotonic() - tick_start:.3f}s")
+
+            # Once a day, after the portfolios so it never holds up a scheduled run
+            if partitions_date != datetime.now(timezone.utc).date() and ensure_partitions():
+                partitions_date = datetime.now(timezone.utc).date()
+
+            # Wake up right at the next scheduled run instead of up to a poll later
+            now = datetime.now(timezone.utc)
+            try:
+                next_run_times = [next_scheduled_run_time(portfolio, now) for portfolio in portfolios]
+                if next_run_times:
+                    sleep_seconds = min(POLL_SECONDS, max(0, (min(next_run_times) - now).total_seconds()) + 0.05)
+            except:
+                log.exception("Failed to work out the next scheduled run time")
+    except (KeyboardInterrupt, SystemExit):
+        log.info("Shutting down...")
+        worker.close()
+        try:
+            with psycopg.connect(DB_CONN_STRING, autocommit=True) as conn:
+                with conn.cursor() as cursor:
+                    delete_node(cursor, NODE_ID)
+        except:
+            log.exception("Failed to release portfolio leases")
+        sys.exit()
+
+if __name__ == "__main__":
+    main()
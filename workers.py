@@ -0,0 +1,243 @@
+import os
+import time
+import logging
+import resource
+import traceback
+import tracemalloc
+import multiprocessing
+import marketdata
+
+log = logging.getLogger()
+
+# Imported once by the forkserver so every recycled worker starts with them already loaded
+WORKER_PRELOAD = ["pandas", "vectorbtpro"]
+WORKER_MAX_RSS_MB = int(os.environ.get("TRADEBOT_WORKER_MAX_RSS_MB", 2048))
+WORKER_MAX_RUNS = int(os.environ.get("TRADEBOT_WORKER_MAX_RUNS", 50))
+# A worker over this is killed mid-run, before a runaway run can take the host down with it
+WORKER_KILL_RSS_MB = int(os.environ.get("TRADEBOT_WORKER_KILL_RSS_MB", 4096))
+WATCHDOG_SECONDS = 0.5
+RUN_MEMORY_BUDGET_MB = int(os.environ.get("TRADEBOT_RUN_MEMORY_BUDGET_MB", 0)) or None
+RUN_TRACEMALLOC = os.environ.get("TRADEBOT_RUN_TRACEMALLOC", "") not in ("", "0")
+TRACEMALLOC_TOP = 20
+
+def proc_status_bytes(field, pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    # Resets VmHWM on Linux, elsewhere the peak is for the worker's lifetime
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+def peak_rss():
+    peak = proc_status_bytes("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_rss():
+    rss = proc_status_bytes("VmRSS")
+    return rss if rss is not None else peak_rss()
+
+def worker_main(conn, memory_budget, trace, bar_prefix, shared_bars):
+    import trader
+    trader.util.set_bar_store(marketdata.SharedBarStore(bar_prefix, shared_bars))
+    if trace:
+        tracemalloc.start()
+    data = None
+    cpu_start = time.process_time()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        kind, args = task[0], task[1:]
+        try:
+            if kind == "new_tick":
+                trader.util.new_bar_generation()
+                value = None
+            elif kind == "prewarm":
+                value = trader.prewarm_run(*args)
+            elif kind == "is_market_open":
+                value = trader.is_market_open(*args)
+            elif kind == "prepare":
+                reset_peak_rss()
+                cpu_start = time.process_time()
+                fingerprint, prices, data = trader.prepare_run(*args)
+                value = (fingerprint, prices)
+            elif kind == "simulate":
+                value = trader.simulate_run(*args, data)
+            elif kind == "finish":
+                data = None
+                value = {
+                    "cpu_seconds": time.process_time() - cpu_start,
+                    "peak_memory": peak_rss(),
+                    "rss": current_rss(),
+                    "dump": None,
+                    "shared_bars": trader.util.bar_store.descriptors(),
+                }
+                if memory_budget is not None and value["peak_memory"] > memory_budget and tracemalloc.is_tracing():
+                    stats = tracemalloc.take_snapshot().statistics("lineno")[:TRACEMALLOC_TOP]
+                    value["dump"] = "\n".join(str(stat) for stat in stats)
+            else:
+                raise ValueError(f"Unknown worker task '{kind}'")
+            conn.send((True, value))
+        except:
+            conn.send((False, traceback.format_exc()))
+
+class InProcessRunner:
+    """
+    Runs strategies inside the calling process, the default when no worker is given
+    """
+    def __init__(self):
+        self.data = None
+
+    def new_tick(self):
+        pass
+
+    def is_market_open(self, portfolio):
+        import trader
+        return trader.is_market_open(portfolio)
+
+    def prewarm(self, portfolio):
+        import trader
+        return trader.prewarm_run(portfolio)
+
+    def prepare(self, portfolio, available_cash, positions, data=None):
+        import trader
+        fingerprint, prices, self.data = trader.prepare_run(portfolio, available_cash, positions, data)
+        return fingerprint, prices
+
+    def simulate(self, portfolio, available_cash, positions):
+        import trader
+        return trader.simulate_run(portfolio, available_cash, positions, self.data)
+
+    def finish(self):
+        self.data = None
+        return {}
+
+class StrategyWorker:
+    """
+    Runs strategies in a separate process so the trader itself never holds strategy modules,
+    DataFrames or Portfolio objects. The worker is recycled once its RSS goes over max_rss or it
+    has done max_runs runs, and replaced if it dies (e.g. killed for running out of memory).
+    """
+    def __init__(self, max_rss=WORKER_MAX_RSS_MB * 1024 * 1024, max_runs=WORKER_MAX_RUNS,
+                 memory_budget=RUN_MEMORY_BUDGET_MB * 1024 * 1024 if RUN_MEMORY_BUDGET_MB else None,
+                 trace=RUN_TRACEMALLOC, kill_rss=WORKER_KILL_RSS_MB * 1024 * 1024):
+        self.max_rss = max_rss
+        self.kill_rss = kill_rss
+        self.max_runs = max_runs
+        self.memory_budget = memory_budget
+        self.trace = trace
+        self.process = None
+        self.conn = None
+        self.runs = 0
+        # Bars the worker keeps in shared memory, handed to its replacement when it's recycled
+        self.bar_prefix = f"tradebot_{os.getpid()}_"
+        self.shared_bars = {}
+
+    def start(self):
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(WORKER_PRELOAD)
+        parent_conn, child_conn = context.Pipe()
+        # Blocks a dead worker created but never reported
+        marketdata.sweep(self.bar_prefix, keep=marketdata.block_names(self.shared_bars))
+        self.process = context.Process(
+            target=worker_main,
+            args=(child_conn, self.memory_budget, self.trace, self.bar_prefix, self.shared_bars),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.runs = 0
+        log.info(f"Started strategy worker {self.process.pid}")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def call(self, *task):
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self.start()
+        try:
+            self.conn.send(task)
+            while not self.conn.poll(WATCHDOG_SECONDS):
+                self.watchdog()
+            ok, value = self.conn.recv()
+        except (EOFError, OSError):
+            exitcode = self.process.exitcode
+            self.stop()
+            raise RuntimeError(f"Strategy worker died during '{task[0]}' (exit code {exitcode})")
+        if not ok:
+            raise RuntimeError(f"Strategy worker failed during '{task[0]}':\n{value}")
+        return value
+
+    def watchdog(self):
+        # Only works where /proc is available, elsewhere runs are just checked once they finish
+        rss = proc_status_bytes("VmRSS", self.process.pid)
+        if rss is not None and rss > self.kill_rss:
+            log.error(f"Killing strategy worker {self.process.pid} at {rss / 2**20:.0f}MB, over the {self.kill_rss / 2**20:.0f}MB limit")
+            self.process.kill()
+            self.process.join()
+
+    def new_tick(self):
+        if self.process is not None:
+            self.call("new_tick")
+
+    def close(self):
+        self.stop()
+        marketdata.unlink(marketdata.block_names(self.shared_bars))
+        marketdata.sweep(self.bar_prefix)
+        self.shared_bars = {}
+
+    def is_market_open(self, portfolio):
+        return self.call("is_market_open", portfolio)
+
+    def prewarm(self, portfolio):
+        return self.call("prewarm", portfolio)
+
+    def prepare(self, portfolio, available_cash, positions, data=None):
+        return self.call("prepare", portfolio, available_cash, positions, data)
+
+    def simulate(self, portfolio, available_cash, positions):
+        return self.call("simulate", portfolio, available_cash, positions)
+
+    def finish(self):
+        if self.process is None:
+            return {}
+        usage = self.call("finish")
+        self.runs += 1
+        self.shared_bars = usage["shared_bars"]
+        if self.memory_budget is not None and usage["peak_memory"] > self.memory_budget:
+            log.warning(f"Run peaked at {usage['peak_memory'] / 2**20:.0f}MB, over the {self.memory_budget / 2**20:.0f}MB budget")
+            if usage["dump"]:
+                log.warning(f"Top allocations:\n{usage['dump']}")
+        if usage["rss"] > self.max_rss or self.runs >= self.max_runs:
+            log.info(f"Recycling strategy worker {self.process.pid} after {self.runs} runs at {usage['rss'] / 2**20:.0f}MB")
+            self.stop()
+        return usage